@@ -1,36 +1,153 @@
+import functools
+import logging
 import os
+import time
 from datetime import datetime
-from flask import Flask, redirect, render_template, request, session, url_for, jsonify
-from classifier import MovieReviewClassifier
+from flask import Flask, Response, g, redirect, render_template, request, session, url_for, jsonify
+from werkzeug.middleware.proxy_fix import ProxyFix
+from classifier import REVIEW_MAP, MovieReviewClassifier
+from logging_utils import configure_logging
+from login_guard import LoginGuard
+from maintenance import MaintenanceScheduler
+from metrics import CONTENT_TYPE, HTTP_REQUEST_SECONDS, LOGIN_ATTEMPTS, REGISTRY, REQUESTS_REJECTED, Gauge
+from micro_batcher import MicroBatcher
+from model_registry import candidate_registry, model_registry
+from model_store import ModelEventListener
+from password_hashing import PasswordHashingBusy
 from user import User
-from postgres_utils import UserDB, TokensDB, ActivityLogDB
-import redis 
+from postgres_utils import (UserDB, TokensDB, ActivityLogDB, DatabaseCommunicationError, TokenEventListener,
+                            auth_from_env, create_schema)
+from prediction_cache import PredictionCache
+from rate_limiter import RateLimiter
+from redis_utils import REDIS_HOST, get_redis_client
+from shadow_scoring import ShadowScorer
+from training_jobs import TrainingJobs
 
 
 DEBUG_FLAG= os.getenv('debug', 'False')=='True'
+# 'batch' fits TF-IDF + LogisticRegression in memory, 'streaming' fits chunk by chunk,
+# 'search' cross-validates a parameter grid first and fits the best candidate,
+# 'incremental' updates the active model with the reviews of INCREMENTAL_DATA_PATH only.
+TRAINING_MODE = os.getenv('TRAINING_MODE', 'batch')
+TRAINING_MODES = ('batch', 'streaming', 'search', 'incremental')
+# 'direct' scores each /infer on its own thread, 'microbatch' pools concurrent queries into one call.
+INFERENCE_MODE = os.getenv('INFERENCE_MODE', 'direct')
+MICROBATCH_TIMEOUT = float(os.getenv('MICROBATCH_TIMEOUT', 10))
+# Reverse proxies in front of the app appending to X-Forwarded-For. Client addresses, which key the
+# anonymous rate limit and the login throttle, are read from that header instead of the socket,
+# otherwise every client behind the proxy shares its address. Leave 0 when clients connect directly,
+# the header would let them pick their own address.
+TRUSTED_PROXIES = int(os.getenv('TRUSTED_PROXIES', 0))
+configure_logging()
+logger = logging.getLogger(__name__)
 app = Flask(__name__)
+if TRUSTED_PROXIES:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXIES)
 
 try:
-    redis_host= os.environ.get('REDIS_HOST', 'localhost')
-    print("redis_host is ", redis_host)
-    redis_client = redis.StrictRedis(host=redis_host, port=6379, password="redis123", db=1)
-    print("Connected to Redis! host = %s".format(redis_host))
+    redis_client = get_redis_client()
+    logger.info(f"Connected to Redis host={REDIS_HOST}")
 except Exception as e:
-    print(f"Error connecting to Redis: {e}")
-
-auth = {
-        'dbname' : 'sentiment_analyzer_db',
-        'username' : os.environ.get('POSTGRES_USERNAME', 'root'),
-        'password' : os.environ.get('POSTGRES_PASSWORD', 'root'),
-        'host' : os.environ.get('POSTGRES_HOST', '0.0.0.0'),
-        'port' : os.environ.get('POSTGRES_PORT', 5432)
-    }
+    logger.error(f"Error connecting to Redis: {e}")
+
+training_jobs = TrainingJobs(redis_client)
+login_guard = LoginGuard(redis_client)
+rate_limiter = RateLimiter(redis_client)
+
+auth = auth_from_env()
+prediction_cache = PredictionCache(redis_client)
+shadow_scorer = ShadowScorer(candidate_registry, REVIEW_MAP, redis_client=redis_client)
+classifier = MovieReviewClassifier(prediction_cache=prediction_cache, shadow=shadow_scorer)
+model_events = ModelEventListener(redis_client, [model_registry, candidate_registry])
+micro_batcher = MicroBatcher(classifier.infer_batch)
 user_obj = UserDB(auth)
-token_obj = TokensDB(auth)
+token_obj = TokensDB(auth, redis_client=redis_client)
+token_events = TokenEventListener(redis_client, token_obj)
 activitylog_obj = ActivityLogDB(auth)
+maintenance_scheduler = MaintenanceScheduler(redis_client, token_obj, activitylog_obj)
+
+cache_stats_gauge = Gauge('sentiment_prediction_cache_entries', 'Entries in the local prediction cache.')
+cache_stats_gauge.set_function(lambda: prediction_cache.stats()['local_entries'])
 
 ################################################################
 
+@app.before_request
+def start_timer():
+    g.request_start = time.perf_counter()
+    maintenance_scheduler.start()
+    model_events.start()
+    token_events.start()
+
+
+@app.after_request
+def record_request(response):
+    start = g.get('request_start')
+    if start is not None:
+        HTTP_REQUEST_SECONDS.labels(
+            endpoint=request.endpoint or 'unknown', method=request.method, status=response.status_code
+        ).observe(time.perf_counter() - start)
+    return response
+
+
+def too_many_requests(reason, retry_after):
+    REQUESTS_REJECTED.labels(endpoint=request.endpoint, reason=reason).inc()
+    return jsonify(error='Too many requests, retry later'), 429, {'Retry-After': str(retry_after)}
+
+
+def admit_request(endpoint, token, address):
+    """
+    Authenticates a request and charges it to its caller's budget.
+    Returns (username or None, seconds to wait before retrying, 0 when admitted).
+    Tokens missing from the token cache are first charged to the tight 'anonymous' budget of the
+    client address, so random tokens can not reach postgres faster than that budget.
+    Args:
+        endpoint: name of the endpoint, see rate_limiter.DEFAULT_RATE_LIMITS.
+        token: session token sent with the request, may be None.
+        address: address of the client.
+    """
+    cached = token_obj.lookup_cached_token(token) if token else None
+    if cached is not None:
+        username = cached[0]
+    else:
+        retry_after = rate_limiter.retry_after('anonymous', address or '')
+        if retry_after:
+            return None, retry_after
+        username = token_obj.authenticate(token) if token else None
+    if username is None:
+        return None, 0
+    return username, rate_limiter.retry_after(endpoint, username)
+
+
+def authenticate(token):
+    # Reuses the lookup rate_limited made for this request's token. Any other token, e.g. a query
+    # string token next to an admitted header, reaches postgres only within the anonymous budget.
+    if 'auth_token' in g and g.auth_token == token:
+        return g.auth_username
+    cached = token_obj.lookup_cached_token(token) if token else None
+    if cached is not None:
+        return cached[0]
+    if not token or rate_limiter.retry_after('anonymous', request.remote_addr or ''):
+        return None
+    return token_obj.authenticate(token)
+
+
+def rate_limited(view):
+    """
+    Rejects requests over their user's budget for the endpoint, or over the budget of their
+    address when the token is unknown, before any work is done for them.
+    """
+    @functools.wraps(view)
+    def limited_view(*args, **kwargs):
+        token = request.headers.get('Authorization') or request.args.get('token')
+        username, retry_after = admit_request(request.endpoint, token, request.remote_addr)
+        if retry_after:
+            logger.info(f'Rate limited endpoint={request.endpoint} username={username} retry_after={retry_after}')
+            return too_many_requests('rate_limit', retry_after)
+        g.auth_token, g.auth_username = str(token), username
+        return view(*args, **kwargs)
+    return limited_view
+
+
 @app.route('/', methods = ['GET'])
 @app.route('/login_page', methods=['GET'])
 def loginpage():
@@ -41,14 +158,29 @@ def loginpage():
 def login():
     username = request.args.get('loginUsername')
     password = request.args.get('loginPassword')
-    print('~', username, password)
-    if user_obj.validate_user(User(username, password)):
-        print('Login successful')
+    # Throttled attempts are turned away before any bcrypt work is spent on them.
+    retry_after = login_guard.retry_after(username, request.remote_addr)
+    if retry_after:
+        LOGIN_ATTEMPTS.labels(result='throttled').inc()
+        logger.info(f'Login throttled username={username} ip={request.remote_addr}')
+        return render_template('login.html'), 429, {'Retry-After': str(retry_after)}
+    try:
+        is_valid = user_obj.validate_user(User(username, password))
+    except PasswordHashingBusy:
+        LOGIN_ATTEMPTS.labels(result='busy').inc()
+        logger.warning(f'Login rejected, password checks saturated username={username}')
+        return render_template('login.html'), 503, {'Retry-After': '1'}
+    if is_valid:
+        LOGIN_ATTEMPTS.labels(result='success').inc()
+        login_guard.record_success(username)
+        logger.debug(f'Login successful username={username}')
         token = token_obj.generate_token(username=username)
         activitylog_obj.update_activity(username=username, activity='login')
         return render_template('index.html', token=token)
     else:
-        print('Login failed')
+        LOGIN_ATTEMPTS.labels(result='failure').inc()
+        login_guard.record_failure(username, request.remote_addr)
+        logger.info(f'Login failed username={username}')
         return render_template('login.html')
 
 
@@ -57,7 +189,7 @@ def register():
     username = request.args.get('regUsername')
     password = request.args.get('regPassword')
     if not username or not password:
-        print('Both username and password are required')
+        logger.info('Registration rejected: both username and password are required')
     else:
         new_user = User(username=username, password=password)
         user_obj.insert_user(new_user)
@@ -65,65 +197,88 @@ def register():
 
 
 @app.route('/logout', methods=['GET'])
+@rate_limited
 def logout():
-    # TBD: delete the token from table if not needed anymore.
-    return redirect(url_for('login.html'))
+    token = request.args.get('token')
+    # Only known tokens cost a delete.
+    if token and authenticate(token):
+        try:
+            token_obj.invalidate_token(token)
+        except DatabaseCommunicationError:
+            logger.warning('Failed to invalidate token on logout')
+    return redirect(url_for('loginpage'))
 
 
 @app.route('/index', methods = ['GET'])
+@rate_limited
 def home_page():
     token = request.args.get('token')
-    if token_obj.verify_token(token):
+    if authenticate(token):
         inference_response = request.args.get('inference_response')
         return render_template('index.html', token=token, inference_response=inference_response)
     else:
-        print('Session Expired : Invalid token')
+        logger.debug('Session Expired : Invalid token')
         return render_template('login.html')
 
 
 @app.route('/train', methods = ['POST'])
+@rate_limited
 def train():
     token = str(request.headers.get('Authorization'))
-    username = token_obj.get_username(token)
-    #print(token, token_obj.verify_token(token))
-    if token_obj.verify_token(token):
-        lock_key="training_lock"
-        acquired_lock = redis_client.set(lock_key, 'locked', nx=True, ex=300)
-        print("acquired_lock: ", acquired_lock)
-        if acquired_lock:
-            try:
-                print("Training started")
-                obj = MovieReviewClassifier()
-                obj.train_data()
-                result = 'Training completed'
-                activitylog_obj.update_activity(username=username, activity='training')
-            except Exception as e:
-                result = f'Training failed with {e}'
-            finally:
-                # Release the lock
-                redis_client.delete(lock_key)
-        else:
+    username = authenticate(token)
+    if username:
+        payload = request.get_json(silent=True) or {}
+        mode = payload.get('mode', TRAINING_MODE)
+        if mode not in TRAINING_MODES:
+            return jsonify(error=f'Unknown training mode {mode!r}, expected one of {", ".join(TRAINING_MODES)}',
+                           token=token), 400
+        try:
+            job_id = training_jobs.submit(username=username, streaming=mode == 'streaming', search=mode == 'search',
+                                          incremental=mode == 'incremental')
+        except Exception as e:
+            return jsonify(status=f'Training failed with {e}', token=token), 500
+        if job_id is None:
             result = 'Training is already in progress'
-            print("here", result, acquired_lock)
-        return jsonify(status=result, token=token)
+            logger.info(result)
+            return jsonify(status=result, token=token), 409
+        activitylog_obj.update_activity(username=username, activity='training')
+        return jsonify(status='Training queued', job_id=job_id, token=token), 202
     else:
-        print('Session Expired : Invalid token')
+        logger.debug('Session Expired : Invalid token')
         return render_template('login.html')
-    
+
+
+@app.route('/train/<job_id>', methods = ['GET'])
+@rate_limited
+def train_status(job_id):
+    token = str(request.headers.get('Authorization'))
+    if not authenticate(token):
+        return jsonify(error='Session Expired : Invalid token'), 401
+    job = training_jobs.status(job_id)
+    if job is None:
+        return jsonify(error=f'Unknown training job {job_id}'), 404
+    return jsonify(job)
 
 
 @app.route('/infer', methods=['GET'])
+@rate_limited
 def infer():
     token = str(request.args.get('token')) 
-    username = token_obj.get_username(token)
-    if token_obj.verify_token(token):
+    username = authenticate(token)
+    if username:
         try:
             query = request.args.get('query')
-            print("Predicting your query : ", query)
+            logger.debug(f"Predicting query length={len(query or '')}")
 
-            obj = MovieReviewClassifier()
             if query:
-                result = f'{query} - {obj.infer(query)}'
+                with rate_limiter.inflight_slot() as admitted:
+                    if not admitted:
+                        return too_many_requests('overloaded', 1)
+                    if INFERENCE_MODE == 'microbatch':
+                        label = micro_batcher.submit(query).result(timeout=MICROBATCH_TIMEOUT)['label']
+                    else:
+                        label = classifier.infer(query)
+                result = f'{query} - {label}'
                 activitylog_obj.update_activity(username=username, activity='inference')
             else:
                 result = "No query passed"
@@ -131,9 +286,43 @@ def infer():
             result = f"Exception : {e}"
         return redirect(url_for('home_page', inference_response=result, token=token))
     else:
-        print('Session Expired : Invalid token')
+        logger.debug('Session Expired : Invalid token')
         return render_template('login.html')
 
+
+@app.route('/infer_batch', methods=['POST'])
+@rate_limited
+def infer_batch():
+    token = str(request.headers.get('Authorization'))
+    username = authenticate(token)
+    if not username:
+        return jsonify(error='Session Expired : Invalid token'), 401
+    payload = request.get_json(silent=True) or {}
+    texts = payload.get('texts')
+    if not isinstance(texts, list) or not all(isinstance(text, str) for text in texts):
+        return jsonify(error='Expected a JSON body like {"texts": ["review", ...]}'), 400
+    with rate_limiter.inflight_slot() as admitted:
+        if not admitted:
+            return too_many_requests('overloaded', 1)
+        try:
+            predictions = classifier.infer_batch(texts)
+        except Exception as e:
+            return jsonify(error=f'Exception : {e}'), 500
+    activitylog_obj.update_activity(username=username, activity='inference')
+    return jsonify(predictions=predictions, count=len(predictions))
+
+
+@app.route('/cache/stats', methods=['GET'])
+def cache_stats():
+    return jsonify(prediction_cache.stats())
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return Response(REGISTRY.render(), content_type=CONTENT_TYPE)
+
+
 if __name__ == "__main__":
-    print("starting the application")
+    logger.info("starting the application")
+    create_schema(auth)
     app.run(host="0.0.0.0", debug=True, port=5002)
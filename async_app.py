@@ -0,0 +1,115 @@
+"""
+asyncio entry point serving inference through the micro-batcher, alongside the Flask app.
+
+POST /async/infer with {"query": "..."} and the token in the Authorization header is handled on
+the event loop: many requests wait on the shared batcher without holding a thread each. Every
+other path is forwarded to the Flask app. Create the schema once, then run it with any ASGI server, e.g.
+
+    python postgres_utils.py
+    uvicorn async_app:app --host 0.0.0.0 --port 5001
+
+Behind a reverse proxy, add --proxy-headers --forwarded-allow-ips <proxy address> so /async/infer
+rate limits the client address rather than the proxy's.
+"""
+import asyncio
+import json
+import os
+
+from asgiref.wsgi import WsgiToAsgi
+
+from app import (activitylog_obj, admit_request, app as flask_app, classifier, micro_batcher, model_events,
+                 rate_limiter, token_events)
+from metrics import REQUESTS_REJECTED
+
+
+ASYNC_INFER_TIMEOUT = float(os.getenv('MICROBATCH_TIMEOUT', 10))
+MAX_BODY_BYTES = int(os.getenv('ASYNC_MAX_BODY_BYTES', 1024 * 1024))
+
+wsgi_app = WsgiToAsgi(flask_app)
+
+
+async def _read_body(receive) -> bytes:
+    body = b''
+    while True:
+        message = await receive()
+        body += message.get('body', b'')
+        if len(body) > MAX_BODY_BYTES:
+            raise ValueError('Request body too large')
+        if not message.get('more_body'):
+            return body
+
+
+async def _send_json(send, status: int, payload: dict, headers: dict = None):
+    body = json.dumps(payload).encode('utf-8')
+    extra_headers = [(name.lower().encode('latin-1'), str(value).encode('latin-1'))
+                     for name, value in (headers or {}).items()]
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode())]
+                   + extra_headers,
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def _too_many_requests(send, reason: str, retry_after: int):
+    REQUESTS_REJECTED.labels(endpoint='async_infer', reason=reason).inc()
+    return await _send_json(send, 429, {'error': 'Too many requests, retry later'}, {'Retry-After': retry_after})
+
+
+async def async_infer(scope, receive, send):
+    headers = dict(scope.get('headers', []))
+    token = headers.get(b'authorization', b'').decode('latin-1')
+    address = (scope.get('client') or [None])[0]
+    loop = asyncio.get_running_loop()
+    # Token lookups may reach postgres and rate limits redis, keep them off the event loop.
+    # Charged to the same budget as /infer.
+    username, retry_after = await loop.run_in_executor(None, admit_request, 'infer', token or None, address)
+    if retry_after:
+        return await _too_many_requests(send, 'rate_limit', retry_after)
+    if not username:
+        return await _send_json(send, 401, {'error': 'Session Expired : Invalid token'})
+    try:
+        query = json.loads(await _read_body(receive) or b'{}').get('query')
+    except (ValueError, AttributeError):
+        query = None
+    if not isinstance(query, str) or not query:
+        return await _send_json(send, 400, {'error': 'Expected a JSON body like {"query": "review"}'})
+    admitted, slot = await loop.run_in_executor(None, rate_limiter.acquire_slot)
+    if not admitted:
+        return await _too_many_requests(send, 'overloaded', 1)
+    try:
+        prediction = await asyncio.wait_for(
+            asyncio.wrap_future(micro_batcher.submit(query)), timeout=ASYNC_INFER_TIMEOUT)
+    except asyncio.TimeoutError:
+        return await _send_json(send, 504, {'error': 'Inference timed out'})
+    except Exception as e:
+        return await _send_json(send, 500, {'error': f'Exception : {e}'})
+    finally:
+        if slot is not None:
+            await loop.run_in_executor(None, rate_limiter.release_slot, slot)
+    activitylog_obj.update_activity(username=username, activity='inference')
+    await _send_json(send, 200, dict(prediction, query=query))
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await asyncio.get_running_loop().run_in_executor(None, classifier.warm_up)
+            # Started by Flask requests too, /async/infer alone never reaches them.
+            model_events.start()
+            token_events.start()
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            activitylog_obj.flush()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+    if scope['type'] == 'http' and scope['path'] == '/async/infer' and scope['method'] == 'POST':
+        return await async_infer(scope, receive, send)
+    return await wsgi_app(scope, receive, send)
@@ -0,0 +1,62 @@
+import csv
+import random
+from typing import List, Tuple
+
+
+POSITIVE_WORDS = [
+    'brilliant', 'moving', 'wonderful', 'superb', 'masterpiece', 'delightful', 'gripping',
+    'charming', 'excellent', 'loved', 'beautifully', 'outstanding', 'memorable', 'hilarious',
+]
+NEGATIVE_WORDS = [
+    'boring', 'awful', 'terrible', 'waste', 'dull', 'predictable', 'horrible', 'poorly',
+    'disappointing', 'hated', 'mess', 'pointless', 'worst', 'annoying',
+]
+FILLER_WORDS = [
+    'the', 'movie', 'film', 'acting', 'plot', 'story', 'characters', 'director', 'scene',
+    'was', 'and', 'it', 'this', 'of', 'with', 'ending', 'cast', 'performance', 'watching',
+    'screenplay', 'cinematography', 'soundtrack', 'dialogue', 'actors', 'really', 'quite',
+]
+
+
+def make_review(rng: random.Random, positive: bool, length: int) -> str:
+    """
+    Builds a review of roughly length words: mostly filler, some sentiment words and IMDB style markup.
+    """
+    sentiment, opposite = (POSITIVE_WORDS, NEGATIVE_WORDS) if positive else (NEGATIVE_WORDS, POSITIVE_WORDS)
+    words = []
+    for _ in range(length):
+        draw = rng.random()
+        if draw < 0.12:
+            words.append(rng.choice(sentiment))
+        elif draw < 0.15:
+            words.append(rng.choice(opposite))
+        else:
+            words.append(rng.choice(FILLER_WORDS))
+        if rng.random() < 0.02:
+            words.append('<br /><br />')
+    words[0] = words[0].capitalize()
+    return ' '.join(words) + rng.choice(['.', '!', '...', '. 10/10', '. 2/10'])
+
+
+def make_corpus(n_docs: int, seed: int = 0, mean_length: int = 230) -> List[Tuple[str, str]]:
+    """
+    Returns n_docs (review, sentiment) pairs, balanced between the two classes.
+    Review lengths follow the long tailed distribution of the IMDB set.
+    """
+    rng = random.Random(seed)
+    corpus = []
+    for index in range(n_docs):
+        positive = index % 2 == 0
+        length = max(10, int(rng.lognormvariate(0, 0.6) * mean_length * 0.85))
+        corpus.append((make_review(rng, positive, length), 'positive' if positive else 'negative'))
+    return corpus
+
+
+def write_corpus_csv(path: str, n_docs: int, seed: int = 0):
+    """
+    Writes a synthetic corpus with the header and columns of IMDB Dataset.csv.
+    """
+    with open(path, 'w', newline='') as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(['review', 'sentiment'])
+        writer.writerows(make_corpus(n_docs, seed=seed))
@@ -0,0 +1,182 @@
+import datetime
+import threading
+import time
+import uuid
+from concurrent.futures import Future
+
+
+BENCHMARK_USER = 'benchmark'
+BENCHMARK_TOKEN = 'benchmark-token'
+
+
+class FakeRedis:
+    """
+    In-memory stand-in for the few redis commands the app uses. Lua scripts are not supported.
+    """
+    def __init__(self):
+        self._data = {}
+        self._expires = {}
+        self._lock = threading.Lock()
+
+    def _alive(self, key):
+        expires = self._expires.get(key)
+        if expires is not None and expires <= time.time():
+            self._data.pop(key, None)
+            self._expires.pop(key, None)
+        return key in self._data
+
+    @staticmethod
+    def _encode(value):
+        return value if isinstance(value, bytes) else str(value).encode('utf-8')
+
+    def get(self, key):
+        with self._lock:
+            return self._data.get(key) if self._alive(key) else None
+
+    def set(self, key, value, nx=False, ex=None):
+        with self._lock:
+            if nx and self._alive(key):
+                return None
+            self._data[key] = self._encode(value)
+            self._expires.pop(key, None)
+            if ex:
+                self._expires[key] = time.time() + ex
+            return True
+
+    def delete(self, *keys):
+        with self._lock:
+            removed = sum(1 for key in keys if self._alive(key))
+            for key in keys:
+                self._data.pop(key, None)
+                self._expires.pop(key, None)
+            return removed
+
+    def expire(self, key, seconds):
+        with self._lock:
+            if not self._alive(key):
+                return False
+            self._expires[key] = time.time() + seconds
+            return True
+
+    def hset(self, key, mapping):
+        with self._lock:
+            self._alive(key)
+            hash_value = self._data.setdefault(key, {})
+            hash_value.update({self._encode(field): self._encode(value) for field, value in mapping.items()})
+            return len(mapping)
+
+    def hgetall(self, key):
+        with self._lock:
+            return dict(self._data[key]) if self._alive(key) else {}
+
+    def pipeline(self):
+        return FakePipeline(self)
+
+    def publish(self, channel, message):
+        return 0
+
+    def pubsub(self, **kwargs):
+        return FakePubSub()
+
+    def eval(self, *args):
+        raise NotImplementedError('FakeRedis does not run Lua scripts')
+
+
+class FakePipeline:
+    def __init__(self, client):
+        self._client = client
+        self._calls = []
+
+    def __getattr__(self, name):
+        method = getattr(self._client, name)
+        def queue(*args, **kwargs):
+            self._calls.append((method, args, kwargs))
+            return self
+        return queue
+
+    def execute(self):
+        calls, self._calls = self._calls, []
+        return [method(*args, **kwargs) for method, args, kwargs in calls]
+
+
+class FakePubSub:
+    """
+    Subscription that never receives a message.
+    """
+    def subscribe(self, *channels):
+        pass
+
+    def listen(self):
+        threading.Event().wait()
+        yield from ()
+
+
+class FakeUserDB:
+    def __init__(self, auth):
+        self.users = {BENCHMARK_USER: 'benchmark'}
+
+    def insert_user(self, user):
+        self.users.setdefault(user.username, user.password)
+
+    def validate_user(self, user):
+        return self.users.get(user.username) == user.password
+
+    def delete_user(self, user):
+        self.users.pop(user.username, None)
+
+
+class FakeTokensDB:
+    def __init__(self, auth, redis_client=None):
+        expires_at = datetime.datetime.now() + datetime.timedelta(days=1)
+        self.tokens = {BENCHMARK_TOKEN: (BENCHMARK_USER, expires_at)}
+
+    def generate_token(self, username):
+        token = uuid.uuid4().hex
+        self.tokens[token] = (username, datetime.datetime.now() + datetime.timedelta(days=1))
+        return token
+
+    def lookup_token(self, token):
+        result = self.tokens.get(token)
+        if result and result[1] > datetime.datetime.now():
+            return result
+        return None
+
+    def lookup_cached_token(self, token, now=None):
+        return self.lookup_token(token)
+
+    def evict_cached_token(self, token):
+        pass
+
+    def authenticate(self, token):
+        result = self.lookup_token(token)
+        return result[0] if result else None
+
+    def get_username(self, token):
+        return self.authenticate(token) or ''
+
+    def verify_token(self, token):
+        return self.authenticate(token) is not None
+
+    def invalidate_token(self, token):
+        self.tokens.pop(token, None)
+
+
+class FakeActivityLogDB:
+    def __init__(self, auth):
+        self.activity = {}
+
+    def update_activity(self, username, activity):
+        self.activity[(username, activity)] = datetime.datetime.now()
+
+    def flush(self):
+        return 0
+
+
+class NoopExecutor:
+    """
+    Accepts training jobs without running them, /train is measured up to the enqueue.
+    """
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        future.set_result(None)
+        return future
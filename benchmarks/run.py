@@ -0,0 +1,263 @@
+"""
+Offline benchmarks of the hot paths: preprocessing, training, inference and the Flask routes.
+
+Runs on a synthetic IMDB-like corpus with in-memory stand-ins for postgres and redis:
+
+    python -m benchmarks.run --output bench.json
+    python -m benchmarks.run --baseline bench.json --tolerance 0.2
+
+With --baseline the run exits with status 1 if any metric regressed by more than the tolerance.
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+from typing import Callable, Dict, List
+
+
+# Metrics where a larger value is better, every other metric is a duration.
+HIGHER_IS_BETTER = ('docs_per_sec', 'requests_per_sec')
+
+
+def percentiles(samples: List[float]) -> Dict[str, float]:
+    """
+    p50/p95/p99 and mean of samples given in seconds, reported in milliseconds.
+    """
+    ordered = sorted(samples)
+    def pick(fraction):
+        return round(ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] * 1000, 4)
+    return {
+        'p50_ms': pick(0.50), 'p95_ms': pick(0.95), 'p99_ms': pick(0.99),
+        'mean_ms': round(statistics.mean(ordered) * 1000, 4),
+    }
+
+
+def time_calls(fn: Callable, args_list: List) -> List[float]:
+    samples = []
+    for args in args_list:
+        start = time.perf_counter()
+        fn(*args)
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def setup_environment(workdir: str, n_docs: int):
+    """
+    Points the app at a scratch directory holding a synthetic dataset, must run before app imports.
+    """
+    from benchmarks.corpus import write_corpus_csv
+
+    os.makedirs(os.path.join(workdir, 'model'))
+    data_path = os.path.join(workdir, 'reviews.csv')
+    write_corpus_csv(data_path, n_docs)
+    os.environ['DATA_PATH'] = data_path
+    os.environ['MODEL_PATH'] = os.path.join(workdir, 'model', 'model.pkl')
+    os.environ['MODEL_ARTIFACT_PATH'] = os.path.join(workdir, 'model', 'model_artifact')
+    os.environ['MODEL_STORE_DIR'] = os.path.join(workdir, 'model', 'store')
+    os.environ['CORPUS_CACHE_DIR'] = os.path.join(workdir, 'cache')
+    # Retention jobs would run against the fake databases in the middle of a measurement.
+    os.environ['MAINTENANCE_INTERVAL'] = '0'
+    # Every scenario is sent by one user far above its request budget.
+    os.environ['RATE_LIMITS_ENABLED'] = 'False'
+
+
+def bench_preprocessing(texts: List[str], workers: int) -> Dict:
+    import preprocessing
+
+    preprocessing.stem.cache_clear()
+    start = time.perf_counter()
+    preprocessing.preprocess_many(texts, workers=1)
+    serial = time.perf_counter() - start
+    # Second serial pass runs with a warm stem cache.
+    start = time.perf_counter()
+    preprocessing.preprocess_many(texts, workers=1)
+    serial_warm = time.perf_counter() - start
+    start = time.perf_counter()
+    preprocessing.preprocess_many(texts, workers=workers)
+    parallel = time.perf_counter() - start
+    return {
+        'serial_cold': {'docs_per_sec': round(len(texts) / serial, 1)},
+        'serial_warm': {'docs_per_sec': round(len(texts) / serial_warm, 1)},
+        f'parallel_{workers}_workers': {'docs_per_sec': round(len(texts) / parallel, 1)},
+    }
+
+
+def bench_training(corpus_sizes: List[int]) -> Dict:
+    from benchmarks.fakes import FakeRedis
+    from classifier import MovieReviewClassifier
+    from model_store import ModelStore
+
+    # Model events of the published model must not reach a real redis.
+    classifier = MovieReviewClassifier(model_store=ModelStore(redis_client=FakeRedis()))
+    full = classifier.read_data()
+    results = {}
+    for size in corpus_sizes:
+        df = full.head(size).copy()
+        start = time.perf_counter()
+        df = classifier.preprocess_data(df)
+        preprocessed = time.perf_counter()
+        classifier.get_model().fit(df.Preprocessed_review, df.sentiment_numeric)
+        fitted = time.perf_counter()
+        results[f'{size}_docs'] = {
+            'preprocess_seconds': round(preprocessed - start, 4),
+            'fit_seconds': round(fitted - preprocessed, 4),
+        }
+    start = time.perf_counter()
+    classifier.train_data()
+    results['train_data_seconds'] = round(time.perf_counter() - start, 4)
+    return results
+
+
+def bench_inference(texts: List[str], repeats: int) -> Dict:
+    from classifier import MovieReviewClassifier
+
+    classifier = MovieReviewClassifier()
+    classifier.infer(texts[0])  # loads the model into the registry
+    results = {'single': percentiles(time_calls(classifier.infer, [(text,) for text in texts[:repeats]]))}
+    for batch_size in (100, 1000):
+        batches = [(texts[i:i + batch_size],) for i in range(0, len(texts) - batch_size + 1, batch_size)]
+        batches = batches[:max(3, repeats // batch_size)]
+        samples = time_calls(classifier.infer_batch, batches)
+        results[f'batch_{batch_size}'] = percentiles(samples)
+        results[f'batch_{batch_size}']['docs_per_sec'] = round(
+            batch_size * len(samples) / sum(samples), 1)
+    return results
+
+
+def load_app():
+    """
+    Imports app.py with the postgres wrappers and redis client replaced by in-memory fakes.
+    """
+    import postgres_utils
+    import redis_utils
+    from benchmarks import fakes
+
+    postgres_utils.UserDB = fakes.FakeUserDB
+    postgres_utils.TokensDB = fakes.FakeTokensDB
+    postgres_utils.ActivityLogDB = fakes.FakeActivityLogDB
+    redis_client = fakes.FakeRedis()
+    redis_utils.get_redis_client = lambda: redis_client
+    import app as app_module
+    app_module.training_jobs._executor = fakes.NoopExecutor()
+    return app_module
+
+
+def bench_http(texts: List[str], repeats: int) -> Dict:
+    from benchmarks.fakes import BENCHMARK_TOKEN
+    from training_jobs import LOCK_KEY
+
+    app_module = load_app()
+    client = app_module.app.test_client()
+    headers = {'Authorization': BENCHMARK_TOKEN}
+    results = {}
+
+    def infer(text):
+        client.get('/infer', query_string={'token': BENCHMARK_TOKEN, 'query': text})
+    def infer_repeated():
+        client.get('/infer', query_string={'token': BENCHMARK_TOKEN, 'query': texts[0]})
+    def infer_batch(batch):
+        client.post('/infer_batch', json={'texts': batch}, headers=headers)
+    def train():
+        response = client.post('/train', headers=headers)
+        app_module.redis_client.delete(LOCK_KEY)
+        # Anything else would time an error path instead of the enqueue.
+        if response.status_code != 202:
+            raise RuntimeError(f'/train answered {response.status_code} : {response.get_data(as_text=True)}')
+
+    scenarios = {
+        'infer_unique': (infer, [(text,) for text in texts[:repeats]]),
+        'infer_repeated': (infer_repeated, [()] * repeats),
+        'infer_batch_100': (infer_batch, [(texts[i:i + 100],) for i in range(0, len(texts) - 99, 100)][:20]),
+        'train_enqueue': (train, [()] * min(repeats, 200)),
+    }
+    for name, (fn, args_list) in scenarios.items():
+        samples = time_calls(fn, args_list)
+        results[name] = percentiles(samples)
+        results[name]['requests_per_sec'] = round(len(samples) / sum(samples), 1)
+    return results
+
+
+def flatten(results: Dict, prefix: str = '') -> Dict[str, float]:
+    flat = {}
+    for key, value in results.items():
+        name = f'{prefix}.{key}' if prefix else key
+        if isinstance(value, dict):
+            flat.update(flatten(value, name))
+        elif isinstance(value, (int, float)):
+            flat[name] = value
+    return flat
+
+
+def compare(results: Dict, baseline: Dict, tolerance: float) -> List[str]:
+    """
+    Returns a description of every metric that is worse than the baseline by more than tolerance.
+    """
+    current, previous = flatten(results), flatten(baseline)
+    regressions = []
+    for name, value in current.items():
+        old = previous.get(name)
+        if not old:
+            continue
+        if name.endswith(HIGHER_IS_BETTER):
+            change = (old - value) / old
+        else:
+            change = (value - old) / old
+        if change > tolerance:
+            regressions.append(f'{name}: {old} -> {value} ({change:+.1%} worse)')
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--docs', type=int, default=10000, help='size of the synthetic corpus')
+    parser.add_argument('--train-sizes', type=int, nargs='+', default=[1000, 5000, 10000])
+    parser.add_argument('--repeats', type=int, default=500, help='requests per latency measurement')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--output', help='write results as JSON to this file')
+    parser.add_argument('--baseline', help='JSON results of an earlier run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed relative regression')
+    args = parser.parse_args(argv)
+
+    workdir = tempfile.mkdtemp(prefix='sentiment-bench-')
+    setup_environment(workdir, args.docs)
+    from benchmarks.corpus import make_corpus
+    texts = [review for review, _ in make_corpus(args.docs, seed=1)]
+
+    results = {
+        'preprocessing': bench_preprocessing(texts, args.workers),
+        'training': bench_training([size for size in args.train_sizes if size <= args.docs]),
+        'inference': bench_inference(texts, args.repeats),
+        'http': bench_http(texts, args.repeats),
+    }
+    report = {
+        'meta': {
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'args': {key: value for key, value in vars(args).items() if key not in ('output', 'baseline')},
+        },
+        'results': results,
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            output_file.write(output)
+    print(output)
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        regressions = compare(results, baseline['results'], args.tolerance)
+        for regression in regressions:
+            print(f'REGRESSION {regression}', file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,237 @@
+"""
+Scores a JSONL or CSV file of reviews offline, without going through the HTTP API.
+
+    python bulk_score.py reviews.jsonl scores.jsonl --workers 8
+    python bulk_score.py archive.csv scores.csv --text-field review --id-field id --resume
+
+Input is streamed chunk by chunk to a pool of processes that each load the model once, results are
+written in input order. Output rows hold the position of the input record, the optional id, the
+label and its probability. A checkpoint next to the output records the progress after every chunk,
+--resume continues from it.
+"""
+import argparse
+import csv
+import io
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import time
+from collections import deque
+from itertools import islice
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from file_utils import atomic_write_json
+from logging_utils import configure_logging
+
+
+BULK_CHUNK_SIZE = int(os.environ.get('BULK_CHUNK_SIZE', 2000))
+BULK_WORKERS = int(os.environ.get('BULK_WORKERS', os.cpu_count() or 1))
+# Chunks queued per worker, bounds memory to about workers * this * chunk size rows.
+CHUNKS_IN_FLIGHT_PER_WORKER = 2
+OUTPUT_FIELDS = ['record', 'id', 'label', 'probability']
+
+logger = logging.getLogger(__name__)
+
+
+def _file_format(path: str, file_format: Optional[str]) -> str:
+    file_format = file_format or os.path.splitext(path)[1].lstrip('.').lower()
+    if file_format not in ('jsonl', 'csv'):
+        raise ValueError(f'Can not tell the format of {path}, pass jsonl or csv explicitly')
+    return file_format
+
+
+def read_records(path: str, file_format: str) -> Iterator[Dict]:
+    """
+    Yields the records of a JSONL file (one object per line) or a CSV file with a header row.
+    Raises ValueError naming the line of a JSONL line that is not a JSON object.
+    """
+    with open(path, newline='' if file_format == 'csv' else None, encoding='utf-8') as source:
+        if file_format == 'csv':
+            yield from csv.DictReader(source)
+            return
+        for line_number, line in enumerate(source, 1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError as exc:
+                raise ValueError(f'{path} line {line_number} is not valid JSON : {exc}') from None
+            if not isinstance(record, dict):
+                raise ValueError(f'{path} line {line_number} is of type {type(record).__name__}, expected a JSON object')
+            yield record
+
+
+def _record_fields(position: int, record: Dict, text_field: str, id_field: Optional[str]) -> Tuple:
+    # Checked here, a bad record would otherwise crash preprocess inside a worker.
+    text = record.get(text_field)
+    if text is not None and not isinstance(text, str):
+        raise ValueError(f'Record {position + 1} field {text_field} is of type {type(text).__name__}, expected a string')
+    return position, record.get(id_field) if id_field else None, text or ''
+
+
+_worker = {}
+
+
+def _init_worker():
+    # Each process loads the model once and keeps scoring with it, even if a new one is published.
+    from classifier import MovieReviewClassifier
+    from model_registry import model_registry
+
+    configure_logging()
+    model, version = model_registry.current()
+    _worker.update(classifier=MovieReviewClassifier(), model=model, version=version)
+
+
+def _score_chunk(chunk: List[Tuple[int, Optional[str], str]]) -> Tuple[str, List[Dict]]:
+    # Raising from the initializer would make the pool respawn workers forever, fail the task instead.
+    if _worker['model'] is None:
+        raise RuntimeError('No model exist! Train the data')
+    texts = [text for _, _, text in chunk]
+    predictions = _worker['classifier'].infer_batch(texts, model=_worker['model'])
+    rows = [
+        {'record': position, 'id': record_id, 'label': prediction['label'], 'probability': prediction['probability']}
+        for (position, record_id, _), prediction in zip(chunk, predictions)
+    ]
+    return _worker['version'], rows
+
+
+class Checkpoint:
+    def __init__(self, output_path: str):
+        """
+        Progress of a run: input records done and output bytes written once they were flushed.
+        """
+        self.path = f'{output_path}.checkpoint'
+
+    def load(self) -> Optional[Dict]:
+        try:
+            with open(self.path) as checkpoint_file:
+                return json.load(checkpoint_file)
+        except FileNotFoundError:
+            return None
+
+    def save(self, state: Dict):
+        atomic_write_json(self.path, state)
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+def bulk_score(input_path: str, output_path: str, text_field: str = 'review', id_field: Optional[str] = None,
+               input_format: Optional[str] = None, output_format: Optional[str] = None,
+               chunk_size: int = BULK_CHUNK_SIZE, workers: int = BULK_WORKERS, resume: bool = False) -> Dict:
+    """
+    Scores every record of the input file and writes the results in order, returns a summary.
+    Args:
+        input_path: JSONL or CSV file of reviews.
+        output_path: JSONL or CSV file receiving one row per input record.
+        text_field: field holding the review text.
+        id_field: optional field copied to the output to identify records.
+        input_format: 'jsonl' or 'csv', guessed from the extension when None.
+        output_format: 'jsonl' or 'csv', guessed from the extension when None.
+        chunk_size: records scored per task.
+        workers: scoring processes.
+        resume: continue from the checkpoint of a previous run with the same output path.
+    """
+    from model_registry import model_registry
+
+    input_format = _file_format(input_path, input_format)
+    output_format = _file_format(output_path, output_format)
+    if not model_registry.has_model():
+        raise RuntimeError('No model exist! Train the data')
+    checkpoint = Checkpoint(output_path)
+    state = checkpoint.load() if resume else None
+    if state is not None and state['input_path'] != os.path.abspath(input_path):
+        raise ValueError(f'Checkpoint {checkpoint.path} belongs to {state["input_path"]}')
+    state = state or {'input_path': os.path.abspath(input_path), 'records_done': 0, 'output_bytes': 0,
+                      'model_version': None}
+    skipped = state['records_done']
+
+    records = islice(enumerate(read_records(input_path, input_format)), skipped, None)
+    chunks = (
+        [_record_fields(position, record, text_field, id_field) for position, record in chunk]
+        for chunk in iter(lambda: list(islice(records, chunk_size)), [])
+    )
+
+    with open(output_path, 'a+b' if skipped else 'wb') as output:
+        # Drop rows written after the last checkpoint, they are scored again.
+        output.truncate(state['output_bytes'])
+        output.seek(state['output_bytes'])
+        start = time.perf_counter()
+        scored = 0
+        pending = deque()
+        with multiprocessing.get_context('spawn').Pool(workers, initializer=_init_worker) as pool:
+            for chunk in chunks:
+                pending.append(pool.apply_async(_score_chunk, (chunk,)))
+                if len(pending) >= workers * CHUNKS_IN_FLIGHT_PER_WORKER:
+                    scored += _write_result(pending.popleft().get(), output, output_format, state, checkpoint)
+                    _report(scored, skipped, start)
+            while pending:
+                scored += _write_result(pending.popleft().get(), output, output_format, state, checkpoint)
+                _report(scored, skipped, start)
+    checkpoint.remove()
+    seconds = time.perf_counter() - start
+    summary = {
+        'records': state['records_done'],
+        'scored': scored,
+        'resumed_from': skipped,
+        'seconds': round(seconds, 3),
+        'records_per_second': round(scored / seconds, 1) if seconds else None,
+        'model_version': state['model_version'],
+    }
+    logger.info(f'Bulk scoring done {" ".join(f"{key}={value}" for key, value in summary.items())}')
+    return summary
+
+
+def _write_result(result: Tuple[str, List[Dict]], output, output_format: str, state: Dict,
+                  checkpoint: Checkpoint) -> int:
+    version, rows = result
+    if state['model_version'] not in (None, version):
+        raise RuntimeError(f'Model changed from version={state["model_version"]} to version={version} '
+                           f'during the run, start over without --resume')
+    if output_format == 'csv':
+        text_output = io.StringIO()
+        writer = csv.DictWriter(text_output, fieldnames=OUTPUT_FIELDS)
+        if state['output_bytes'] == 0:
+            writer.writeheader()
+        writer.writerows(rows)
+        data = text_output.getvalue()
+    else:
+        data = ''.join(json.dumps(row) + '\n' for row in rows)
+    output.write(data.encode('utf-8'))
+    output.flush()
+    os.fsync(output.fileno())
+    state.update(records_done=state['records_done'] + len(rows), output_bytes=output.tell(), model_version=version)
+    checkpoint.save(state)
+    return len(rows)
+
+
+def _report(scored: int, skipped: int, start: float):
+    seconds = time.perf_counter() - start
+    rate = scored / seconds if seconds else 0.0
+    logger.info(f'Bulk scoring progress records={skipped + scored} records_per_second={rate:.1f}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('input')
+    parser.add_argument('output')
+    parser.add_argument('--text-field', default='review')
+    parser.add_argument('--id-field', default=None)
+    parser.add_argument('--input-format', choices=('jsonl', 'csv'), default=None)
+    parser.add_argument('--output-format', choices=('jsonl', 'csv'), default=None)
+    parser.add_argument('--chunk-size', type=int, default=BULK_CHUNK_SIZE)
+    parser.add_argument('--workers', type=int, default=BULK_WORKERS)
+    parser.add_argument('--resume', action='store_true', help='continue from the checkpoint of an interrupted run')
+    args = parser.parse_args()
+
+    configure_logging()
+    try:
+        print(json.dumps(bulk_score(
+            args.input, args.output, text_field=args.text_field, id_field=args.id_field,
+            input_format=args.input_format, output_format=args.output_format,
+            chunk_size=args.chunk_size, workers=args.workers, resume=args.resume)))
+    except (ValueError, RuntimeError) as exc:
+        sys.exit(str(exc))
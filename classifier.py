@@ -1,78 +1,431 @@
+import logging
+import os
 import pandas as pd
-import pickle
-import re
+import time
+from concurrent.futures import ProcessPoolExecutor
 from io import BytesIO
+from itertools import islice
 import joblib
 
 ### Importing libraries
 from sklearn.pipeline import Pipeline
-from sklearn.linear_model import LogisticRegression
-from sklearn.feature_extraction.text import TfidfVectorizer
-from nltk.stem.porter import PorterStemmer
+from sklearn.linear_model import LogisticRegression, SGDClassifier
+from sklearn.feature_extraction.text import HashingVectorizer, TfidfVectorizer
+from sklearn.model_selection import train_test_split
 
 from flask import session
 
-### Preprocessing Function
-ps = PorterStemmer()
+from corpus_cache import CorpusCache, hash_file
+from incremental_training import (INCREMENTAL_DATA_PATH, INCREMENTAL_REPLAY_RATIO, IncrementalTrainingError,
+                                  check_accuracy, holdout_shortfall, update_model)
+from linear_scorer import get_scorer
+from metrics import INFERENCE_STAGE_SECONDS
+from model_registry import model_registry
+from model_store import ModelStore
+from model_search import SEARCH_FOLDS, SEARCH_JOBS, run_search, save_scores
+from preprocessing import PREPROCESS_WORKERS, iter_tokens, iter_windows, preprocess, preprocess_many
+
+DATA_PATH = os.environ.get('DATA_PATH', './data/IMDB Dataset.csv')
+BATCH_CHUNK_SIZE = int(os.environ.get('BATCH_CHUNK_SIZE', 1000))
+STREAMING_CHUNK_SIZE = int(os.environ.get('STREAMING_CHUNK_SIZE', 10000))
+HASHING_N_FEATURES = int(os.environ.get('HASHING_N_FEATURES', 2 ** 20))
+CORPUS_CACHE = os.environ.get('CORPUS_CACHE', 'True') == 'True'
+# Share of the dataset held out to measure the accuracy of a batch trained model, 0 fits on everything.
+VALIDATION_FRACTION = float(os.environ.get('VALIDATION_FRACTION', 0.1))
+# What happens to a newly trained model: 'activate' serves it, 'shadow' scores it in the shadow of
+# the active model on SHADOW_FRACTION of the traffic, 'none' only publishes it to the store.
+MODEL_ACTIVATION = os.environ.get('MODEL_ACTIVATION', 'activate')
+SHADOW_FRACTION = float(os.environ.get('SHADOW_FRACTION', 0.05))
+# Reviews longer than this many characters are scored from a single streaming pass over their tokens.
+LONG_TEXT_CHARS = int(os.environ.get('LONG_TEXT_CHARS', 20000))
+# Tokens of a long review scored at once, 0 scores every token.
+INFERENCE_MAX_TOKENS = int(os.environ.get('INFERENCE_MAX_TOKENS', 5000))
+# 'truncate' scores the first INFERENCE_MAX_TOKENS tokens of a long review and stops reading it,
+# 'window' averages the probabilities of every consecutive window of that many tokens.
+LONG_TEXT_MODE = os.environ.get('LONG_TEXT_MODE', 'truncate')
+REVIEW_MAP = {0: "Negative", 1: "Positive"}
+WARMUP_TEXTS = [
+    "<br />One of the best movies I have seen this year, the acting was brilliant.",
+    "A boring, predictable plot and terrible dialogue. I wanted my money back!",
+]
+
+logger = logging.getLogger(__name__)
+
+
+def _predict(model, texts, path, proba=False):
+  # Pipelines are timed per step, other models (e.g. ArtifactModel) as a single predict stage.
+  if isinstance(model, Pipeline):
+    with INFERENCE_STAGE_SECONDS.labels(stage='vectorize', path=path).time():
+      features = model[:-1].transform(texts)
+    model = model[-1]
+  else:
+    features = texts
+  with INFERENCE_STAGE_SECONDS.labels(stage='predict', path=path).time():
+    return model.predict_proba(features) if proba else model.predict(features)
+
+
+def _long_text_probability(model, text, scorer=None):
+  """
+  Probability of the positive class of a long raw review. Tokens are streamed from the raw text
+  window by window, memory stays bounded by INFERENCE_MAX_TOKENS whatever the review length.
+  Args:
+    model: model scoring the windows when no scorer is given.
+    text: raw review text.
+    scorer: optional LinearScorer counting the tokens straight against the vocabulary.
+  """
+  windows = iter_windows(iter_tokens(text), INFERENCE_MAX_TOKENS)
+  if LONG_TEXT_MODE != 'window':
+    windows = islice(windows, 1)
+  total = 0.0
+  count = 0
+  for tokens in windows:
+    if scorer is not None:
+      total += scorer.predict_proba_tokens(tokens)
+    else:
+      total += float(_predict(model, [' '.join(tokens)], 'long', proba=True)[0, 1])
+    count += 1
+  return total / count
+
 
 class MovieReviewClassifier:
-  def __init__(self):
-    pass
+  def __init__(self, prediction_cache=None, shadow=None, model_store=None):
+    """
+    Args:
+      prediction_cache: optional PredictionCache consulted by infer before scoring.
+      shadow: optional ShadowScorer sampling infer traffic for a candidate model.
+      model_store: ModelStore trained models are published to, ModelStore() when None.
+    """
+    self.prediction_cache = prediction_cache
+    self.shadow = shadow
+    self.model_store = model_store if model_store is not None else ModelStore()
 
-  def read_data(self):
-    return pd.read_csv("./data/IMDB Dataset.csv", header=None, skiprows=1, names=['review', 'sentiment'])
+  def read_data(self, path=DATA_PATH):
+    return pd.read_csv(path, header=None, skiprows=1, names=['review', 'sentiment'])
+
+  def read_data_chunks(self, chunksize=STREAMING_CHUNK_SIZE):
+    """
+    Yields the dataset as DataFrames of at most chunksize rows.
+    """
+    yield from pd.read_csv(DATA_PATH, header=None, skiprows=1, names=['review', 'sentiment'],
+                           chunksize=chunksize)
   
   def preprocess(self, text):
-      text = text.strip()
-      text = re.sub("<[^>]*>", "",text)    
-      text = re.sub('[^a-zA-Z]', ' ',text)
-      text = text.lower()
-      text = text.split()
-      text = [ps.stem(word) for word in text]
-      text = ' '.join(text)
-      return text
+      return preprocess(text)
       
-  def preprocess_data(self, df):
-    print("Processing data")
-    df['Preprocessed_review'] = df['review'].apply(self.preprocess)
+  def preprocess_data(self, df, workers=None, executor=None):
+    logger.info(f"Preprocessing rows={len(df)}")
+    df['Preprocessed_review'] = preprocess_many(df['review'], workers=workers, executor=executor)
     map_dict = {'positive':1,'negative':0}
     df['sentiment_numeric'] = df.sentiment.map(map_dict)
     return df
 
-  def get_model(self):
-    print("Preparing model pipeline")
+  def load_preprocessed_data(self):
+    """
+    Returns the preprocessed dataset, reusing the on-disk corpus cache unless CORPUS_CACHE is off.
+    """
+    if not CORPUS_CACHE:
+      return self.preprocess_data(self.read_data())
+    df = CorpusCache().load(DATA_PATH, self.read_data, self.preprocess_data)
+    df['sentiment_numeric'] = df.sentiment.map({'positive':1,'negative':0})
+    return df
+
+  def get_model(self, vectorizer_params=None, C=1.0):
+    """
+    Args:
+      vectorizer_params: optional TfidfVectorizer parameters, e.g. the best ones of a search.
+      C: inverse regularization strength of the logistic regression.
+    """
+    logger.debug("Preparing model pipeline")
+    pipeline = Pipeline([
+        ('tfidf',TfidfVectorizer(**(vectorizer_params or {}))),        
+        ('log_reg', LogisticRegression(C=C))         
+    ])
+    return pipeline
+
+  def get_streaming_model(self):
+    """
+    Stateless hashing features and a logistic model trained by SGD, both usable chunk by chunk.
+    """
+    logger.debug("Preparing streaming model pipeline")
     pipeline = Pipeline([
-        ('tfidf',TfidfVectorizer()),        
-        ('log_reg', LogisticRegression())         
+        ('hashing', HashingVectorizer(n_features=HASHING_N_FEATURES, alternate_sign=False)),
+        ('sgd', SGDClassifier(loss='log_loss'))
     ])
     return pipeline
   
-  def train_data(self):
-    print('Started Training')
+  def train_data(self, progress=None, streaming=False, chunksize=STREAMING_CHUNK_SIZE, epochs=1, search=False,
+                 grid=None, folds=SEARCH_FOLDS, n_jobs=SEARCH_JOBS, incremental=False,
+                 data_path=INCREMENTAL_DATA_PATH):
+    """
+    Reads, preprocesses and fits the dataset, then persists the model.
+    Args:
+      progress: optional callable receiving the stage name (preprocessing, fitting, persisting).
+      streaming: fit incrementally chunk by chunk, memory stays bounded by chunksize.
+      chunksize: rows per chunk in streaming mode.
+      epochs: passes over the dataset in streaming mode, at least 1.
+      search: cross-validate a parameter grid and fit the best candidate, see model_search.
+      grid: parameter grid of the search, SEARCH_GRID or the default grid when None.
+      folds: cross-validation folds of the search.
+      n_jobs: joblib worker processes of the search.
+      incremental: update the active model with the reviews of data_path only, see incremental_training.
+      data_path: new labelled reviews of an incremental training.
+    """
+    progress = progress or (lambda stage: None)
+    if streaming:
+      return self.train_data_streaming(progress, chunksize=chunksize, epochs=epochs)
+    if search:
+      return self.train_data_search(progress, grid=grid, folds=folds, n_jobs=n_jobs)
+    if incremental:
+      return self.train_data_incremental(progress, data_path=data_path)
+    logger.info('Started Training')
     try:
-      df = self.read_data()
-      df = self.preprocess_data(df)
+      progress('preprocessing')
+      df = self.load_preprocessed_data()
       x_train, y_train = df.Preprocessed_review, df.sentiment_numeric
+      progress('fitting')
+      start = time.perf_counter()
+      x_fit, x_val, y_fit, y_val = self.split_validation(x_train, y_train)
       model = self.get_model()
+      model.fit(x_fit, y_fit)
+      accuracy = float(model.score(x_val, y_val)) if x_val is not None else None
+      progress('persisting')
+      self.save_model(model, self.training_metadata('batch', start, len(x_fit), validation_accuracy=accuracy))
+      logger.info(f'completed training validation_accuracy={accuracy}')
+    except Exception as e:
+      logger.exception(f'Training failed: {e}')
+      raise
+
+  def train_data_search(self, progress, grid=None, folds=SEARCH_FOLDS, n_jobs=SEARCH_JOBS):
+    logger.info('Started training with parameter search')
+    try:
+      progress('preprocessing')
+      df = self.load_preprocessed_data()
+      x_train, y_train = df.Preprocessed_review, df.sentiment_numeric
+      # The search and the final fit both count as fitting.
+      progress('fitting')
+      start = time.perf_counter()
+      scores = run_search(x_train, y_train, grid=grid, folds=folds, n_jobs=n_jobs)
+      best = scores['best']
+      model = self.get_model(vectorizer_params=best['vectorizer'], C=best['C'])
       model.fit(x_train, y_train)
-      with open('model/model.pkl', 'wb') as model_file:
-        pickle.dump(model, model_file)
-      print('completed training')
+      progress('persisting')
+      self.save_model(model, self.training_metadata(
+        'search', start, len(x_train), validation_accuracy=best['mean_score'], validation='cross_validation',
+        params=dict(best['vectorizer'], C=best['C'])))
+      save_scores(scores)
+      logger.info(f'completed training best_score={best["mean_score"]:.4f} C={best["C"]} '
+                  f'vectorizer={best["vectorizer"]}')
+    except Exception as e:
+      logger.exception(f'Training failed: {e}')
+      raise
+
+  def train_data_incremental(self, progress, data_path=INCREMENTAL_DATA_PATH):
+    logger.info(f'Started incremental training data_path={data_path}')
+    try:
+      store = self.model_store
+      base_version = store.active()
+      if base_version is None:
+        raise IncrementalTrainingError('No active model version to update, train in batch mode first')
+      n_docs = store.metadata(base_version).get('n_docs')
+      if not n_docs:
+        raise IncrementalTrainingError(
+          f'Model version {base_version} does not record n_docs, train in batch mode first')
+      base = store.load_version(base_version)
+      progress('preprocessing')
+      new = self.preprocess_data(self.read_data(data_path))
+      if new.empty:
+        raise IncrementalTrainingError(f'No new reviews in {data_path}')
+      # Only new reviews are held out, replayed ones may have trained the base model and would flatter it.
+      shortfall = holdout_shortfall(new.sentiment_numeric.tolist(), VALIDATION_FRACTION)
+      if shortfall:
+        logger.warning(f'Holding no new reviews out : {shortfall}')
+        fit_new, holdout = new, None
+      else:
+        fit_new, holdout, _, _ = self.split_validation(new, new.sentiment_numeric)
+      replay = self.sample_replay(len(fit_new))
+      columns = ['Preprocessed_review', 'sentiment_numeric']
+      fit_rows = fit_new[columns] if replay is None else pd.concat([fit_new[columns], replay[columns]], ignore_index=True)
+      progress('fitting')
+      start = time.perf_counter()
+      new_texts = fit_new.Preprocessed_review
+      model, update = update_model(
+        base, n_docs, new_texts, fit_rows.Preprocessed_review, fit_rows.sentiment_numeric)
+      if holdout is not None:
+        scores = check_accuracy(base, model, holdout.Preprocessed_review, holdout.sentiment_numeric)
+      else:
+        logger.warning('Publishing the updated model unchecked, no new reviews were held out')
+        scores = {}
+      progress('persisting')
+      self.save_model(model, self.training_metadata(
+        'incremental', start, update['n_docs'], data_path=data_path, base_version=base_version,
+        new_docs=len(new_texts), replay_docs=len(fit_rows) - len(new_texts), new_terms=update['new_terms'],
+        vocabulary_size=update['vocabulary_size'], **scores))
+      logger.info(f'completed training base_version={base_version} new_terms={update["new_terms"]} '
+                  f'validation_accuracy={scores.get("validation_accuracy")}')
+    except Exception as e:
+      logger.exception(f'Training failed: {e}')
+      raise
+
+  def sample_replay(self, n_new, ratio=INCREMENTAL_REPLAY_RATIO):
+    """
+    Returns a random sample of the preprocessed dataset, ratio previous reviews per new one, or None.
+    Read from the corpus cache, without it the sample is skipped rather than preprocessing the whole dataset.
+    """
+    size = int(n_new * ratio)
+    if size <= 0:
+      return None
+    df = CorpusCache().lookup(DATA_PATH) if CORPUS_CACHE else None
+    if df is None or df.empty:
+      logger.warning(f'Skipping the replay of previous reviews, no corpus cache of {DATA_PATH}')
+      return None
+    df['sentiment_numeric'] = df.sentiment.map({'positive':1,'negative':0})
+    return df.sample(n=min(size, len(df)), random_state=0)
+
+  def train_data_streaming(self, progress, chunksize=STREAMING_CHUNK_SIZE, epochs=1):
+    if epochs < 1:
+      raise ValueError(f'Streaming training needs at least one epoch, got epochs={epochs}')
+    logger.info('Started streaming training')
+    try:
+      model = self.get_streaming_model()
+      vectorizer, sgd = model.named_steps['hashing'], model.named_steps['sgd']
+      # Preprocessing and fitting interleave chunk by chunk, the whole loop reports as fitting.
+      progress('fitting')
+      start = time.perf_counter()
+      with ProcessPoolExecutor(max_workers=PREPROCESS_WORKERS) as executor:
+        for epoch in range(epochs):
+          rows = 0
+          for chunk in self.read_data_chunks(chunksize):
+            chunk = self.preprocess_data(chunk, executor=executor)
+            features = vectorizer.transform(chunk.Preprocessed_review)
+            sgd.partial_fit(features, chunk.sentiment_numeric, classes=[0, 1])
+            rows += len(chunk)
+          logger.info(f'Epoch {epoch + 1}/{epochs} fitted rows={rows}')
+      progress('persisting')
+      self.save_model(model, self.training_metadata('streaming', start, rows, epochs=epochs))
+      logger.info('completed training')
     except Exception as e:
-      print(e)
+      logger.exception(f'Training failed: {e}')
+      raise
   
+  def split_validation(self, x, y, fraction=VALIDATION_FRACTION):
+    """
+    Returns (x_fit, x_validation, y_fit, y_validation), the validation part being None when fraction is 0.
+    """
+    if fraction <= 0:
+      return x, None, y, None
+    return train_test_split(x, y, test_size=fraction, stratify=y, random_state=0)
+
+  def training_metadata(self, mode, start, n_docs, data_path=DATA_PATH, **extra):
+    """
+    Facts stored with a model version in the model store.
+    Args:
+      mode: training mode, e.g. batch.
+      start: time.perf_counter() when fitting started.
+      n_docs: number of documents the vectorizer was fitted on, incremental training builds on it.
+      data_path: dataset the model was trained on.
+      extra: additional facts, e.g. validation_accuracy.
+    """
+    return dict(
+      training_mode=mode,
+      trained_at=time.time(),
+      training_seconds=round(time.perf_counter() - start, 3),
+      data_path=data_path,
+      data_hash=hash_file(data_path)[0],
+      n_docs=int(n_docs),
+      **extra)
+
+  def save_model(self, model, metadata=None):
+    """
+    Publishes the model as a new immutable version of the model store, then activates it or
+    scores it in the shadow of the active model, see MODEL_ACTIVATION. Returns the version.
+    """
+    store = self.model_store
+    version = store.publish(model, metadata, activate=MODEL_ACTIVATION == 'activate')
+    if MODEL_ACTIVATION == 'shadow':
+      store.set_candidate(version, SHADOW_FRACTION)
+    return version
+
+  def warm_up(self, texts=WARMUP_TEXTS):
+    """
+    Loads the current model and runs the single and batch prediction paths once, so the first
+    request does not pay for deserialization, scorer compilation or lazy imports.
+    Bypasses the prediction cache and metrics. Returns True if a model was available.
+    """
+    start = time.perf_counter()
+    model, version = model_registry.current()
+    if not model:
+      logger.info('Skipping warm-up, no model exist')
+      return False
+    preprocessed = [self.preprocess(text) for text in texts]
+    scorer = get_scorer(model, version)
+    if scorer is not None:
+      for text in preprocessed:
+        scorer.predict(text)
+    model.predict_proba(preprocessed)
+    logger.info(f'Warm-up done version={version} seconds={time.perf_counter() - start:.3f}')
+    return True
+
   def infer(self, test_data):
-    print('Predicting data')
     try:
-      print('Loading model from DB')
-      with open('model/model.pkl', 'rb') as model_file:
-        model = pickle.load(model_file)
-        if model:
+      model, version = model_registry.current()
+      if model:
+        if len(test_data) > LONG_TEXT_CHARS:
+          # Never preprocessed as a whole, so neither cached nor shadow scored.
+          with INFERENCE_STAGE_SECONDS.labels(stage='stream', path='single').time():
+            probability = _long_text_probability(model, test_data, get_scorer(model, version))
+          return REVIEW_MAP[model.classes_[int(probability > 0.5)]]
+        with INFERENCE_STAGE_SECONDS.labels(stage='preprocess', path='single').time():
           test_data = self.preprocess(test_data)
-          pred = model.predict([test_data])[0]
-          review_map ={0:"Negative", 1:"Positive"}
-          return review_map[pred]
-        else:
-          return "No model exist! Train the data"
+        label = self.prediction_cache.get(version, test_data) if self.prediction_cache is not None else None
+        if label is None:
+          label = REVIEW_MAP[self._predict_single(model, version, test_data)]
+          if self.prediction_cache is not None:
+            self.prediction_cache.set(version, test_data, label)
+        if self.shadow is not None:
+          self.shadow.observe(test_data, label, version)
+        return label
+      else:
+        return "No model exist! Train the data"
     except Exception as exc:
-      return f'Exception : exc'
+      logger.exception('Inference failed')
+      return f'Exception : {exc}'
+
+  def _predict_single(self, model, version, text):
+    scorer = get_scorer(model, version)
+    if scorer is not None:
+      # Pure python scoring, skips sklearn validation and sparse matrix construction.
+      with INFERENCE_STAGE_SECONDS.labels(stage='predict', path='compiled').time():
+        return scorer.predict(text)
+    return _predict(model, [text], 'single')[0]
+
+  def infer_batch(self, texts, chunk_size=BATCH_CHUNK_SIZE, model=None):
+    """
+    Predicts sentiment for a list of reviews with one vectorized call per chunk.
+    Reviews longer than LONG_TEXT_CHARS are scored on their own from their streamed tokens.
+    Args:
+      texts: list of raw review strings.
+      chunk_size: maximum number of reviews transformed at once, caps memory for large batches.
+      model: optional model to score with instead of the registry's current one.
+    Returns a list of dicts holding the label and the probability of that label.
+    """
+    # Only registry models have a version to compile a scorer for.
+    model, version = (model, None) if model is not None else model_registry.current()
+    if not model:
+      raise RuntimeError("No model exist! Train the data")
+    scorer = get_scorer(model, version) if version is not None else None
+    classes = list(model.classes_)
+    results = []
+    for start in range(0, len(texts), chunk_size):
+      chunk = texts[start:start + chunk_size]
+      with INFERENCE_STAGE_SECONDS.labels(stage='preprocess', path='batch').time():
+        preprocessed = [self.preprocess(text) for text in chunk if len(text) <= LONG_TEXT_CHARS]
+      rows = iter(_predict(model, preprocessed, 'batch', proba=True) if preprocessed else [])
+      for text in chunk:
+        if len(text) > LONG_TEXT_CHARS:
+          probability = _long_text_probability(model, text, scorer)
+          row = (1 - probability, probability)
+        else:
+          row = next(rows)
+        best = max(range(len(row)), key=row.__getitem__)
+        results.append({'label': REVIEW_MAP[classes[best]], 'probability': float(row[best])})
+    return results
@@ -0,0 +1,142 @@
+import hashlib
+import json
+import logging
+import os
+import time
+import uuid
+from typing import Callable, Dict, Optional, Tuple
+
+import pandas as pd
+
+from file_utils import atomic_write, atomic_write_json
+from preprocessing import PREPROCESS_VERSION
+
+
+CORPUS_CACHE_DIR = os.environ.get('CORPUS_CACHE_DIR', 'data/cache')
+MANIFEST_FILE = 'manifest.json'
+CACHED_COLUMNS = ['Preprocessed_review', 'sentiment']
+HASH_BLOCK_SIZE = 1024 * 1024
+
+logger = logging.getLogger(__name__)
+
+
+def hash_file(path: str, prefix_size: Optional[int] = None) -> Tuple[str, Optional[str], int]:
+    """
+    Returns (hash of the whole file, hash of its first prefix_size bytes, file size) in one pass.
+    """
+    digest = hashlib.sha256()
+    prefix_digest = None
+    size = 0
+    with open(path, 'rb') as source:
+        while True:
+            block = source.read(HASH_BLOCK_SIZE)
+            if prefix_size is not None and prefix_digest is None and size + len(block) >= prefix_size:
+                digest.update(block[:prefix_size - size])
+                prefix_digest = digest.hexdigest()
+                digest.update(block[prefix_size - size:])
+            else:
+                digest.update(block)
+            size += len(block)
+            if not block:
+                return digest.hexdigest(), prefix_digest, size
+
+
+class CorpusCache:
+    def __init__(self, cache_dir: str = CORPUS_CACHE_DIR):
+        """
+        On-disk cache of the preprocessed dataset as Parquet parts, one directory per source file
+        and preprocessing version. Rows appended to the source are preprocessed and added as a new part.
+        Args:
+            cache_dir: directory holding the caches.
+        """
+        self.cache_dir = cache_dir
+
+    def _directory(self, source_path: str) -> str:
+        source_key = hashlib.sha256(os.path.abspath(source_path).encode('utf-8')).hexdigest()[:16]
+        return os.path.join(self.cache_dir, f'{source_key}-v{PREPROCESS_VERSION}')
+
+    @staticmethod
+    def _read_manifest(directory: str) -> Optional[Dict]:
+        try:
+            with open(os.path.join(directory, MANIFEST_FILE)) as manifest_file:
+                return json.load(manifest_file)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    @staticmethod
+    def _read_parts(directory: str, manifest: Dict) -> pd.DataFrame:
+        parts = [pd.read_parquet(os.path.join(directory, part)) for part in manifest['parts']]
+        return pd.concat(parts, ignore_index=True) if parts else pd.DataFrame(columns=CACHED_COLUMNS)
+
+    def lookup(self, source_path: str) -> Optional[pd.DataFrame]:
+        """
+        Returns the cached preprocessed rows of source_path, or None when there is no cache for it.
+        Never preprocesses nor writes: rows appended to the source since the cache was built are
+        left out, and a cache of a source rewritten since is ignored.
+        Args:
+            source_path: dataset file the cache was built from.
+        """
+        directory = self._directory(source_path)
+        manifest = self._read_manifest(directory)
+        if manifest is None:
+            return None
+        try:
+            source_hash, prefix_hash, _ = hash_file(source_path, manifest['source_size'])
+        except FileNotFoundError:
+            return None
+        if manifest['source_hash'] not in (source_hash, prefix_hash):
+            return None
+        return self._read_parts(directory, manifest)
+
+    def load(self, source_path: str, read_source: Callable[[], pd.DataFrame],
+             preprocess_frame: Callable[[pd.DataFrame], pd.DataFrame]) -> pd.DataFrame:
+        """
+        Returns the preprocessed dataset, preprocessing only rows missing from the cache.
+        Args:
+            source_path: dataset file, its content hash validates the cache.
+            read_source: callable reading the full dataset as a DataFrame.
+            preprocess_frame: callable adding the Preprocessed_review column to a DataFrame.
+        """
+        directory = self._directory(source_path)
+        manifest = self._read_manifest(directory)
+        prefix_size = manifest['source_size'] if manifest else None
+        source_hash, prefix_hash, source_size = hash_file(source_path, prefix_size)
+
+        if manifest and manifest['source_hash'] == source_hash:
+            logger.info(f'Corpus cache hit rows={manifest["rows"]} source={source_path}')
+            return self._read_parts(directory, manifest)
+
+        start = time.perf_counter()
+        df = read_source()
+        if manifest and prefix_hash == manifest['source_hash'] and len(df) >= manifest['rows']:
+            # The source only grew: keep the cached rows and preprocess the appended ones.
+            cached = self._read_parts(directory, manifest)
+            new_rows = preprocess_frame(df.iloc[manifest['rows']:].copy())
+        else:
+            manifest = {'parts': [], 'rows': 0}
+            cached = None
+            new_rows = preprocess_frame(df)
+        logger.info(f'Corpus cache preprocessed rows={len(new_rows)} cached_rows={manifest["rows"]} '
+                    f'seconds={time.perf_counter() - start:.2f}')
+
+        os.makedirs(directory, exist_ok=True)
+        # Unique names, so a rebuild never overwrites a part the current manifest still lists.
+        part = f'part-{len(manifest["parts"]):05d}-{uuid.uuid4().hex[:8]}.parquet'
+        atomic_write(os.path.join(directory, part),
+                      lambda path: new_rows[CACHED_COLUMNS].to_parquet(path, index=False))
+        manifest = {
+            'source_path': source_path,
+            'source_hash': source_hash,
+            'source_size': source_size,
+            'preprocess_version': PREPROCESS_VERSION,
+            'rows': manifest['rows'] + len(new_rows),
+            'parts': manifest['parts'] + [part],
+        }
+        # The manifest is replaced last, an interrupted run leaves the previous cache intact.
+        atomic_write_json(os.path.join(directory, MANIFEST_FILE), manifest)
+        for stale in set(os.listdir(directory)) - set(manifest['parts']) - {MANIFEST_FILE}:
+            if stale.endswith('.parquet'):
+                os.unlink(os.path.join(directory, stale))
+
+        new_rows = new_rows[CACHED_COLUMNS]
+        return new_rows.reset_index(drop=True) if cached is None else pd.concat([cached, new_rows], ignore_index=True)
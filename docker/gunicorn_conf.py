@@ -1,3 +1,4 @@
+import gc
 import os
 
 workers = int(os.environ.get('GUNICORN_PROCESSES', '2'))
@@ -9,4 +10,31 @@ timeout = int(os.environ.get('GUNICORN_TIMEOUT', '120'))
 bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:5001')
 
 
-forwarded_allow_ips = '*'
\ No newline at end of file
+# Only trusts the forwarded scheme, client addresses behind a proxy need TRUSTED_PROXIES, see app.py.
+forwarded_allow_ips = '*'
+
+# Import the app, and load the model, once in the master, workers share those pages copy-on-write.
+preload_app = os.environ.get('GUNICORN_PRELOAD', 'True') == 'True'
+
+
+def on_starting(server):
+    # Runs once in the master, before any worker is forked.
+    from postgres_utils import auth_from_env, create_schema
+    create_schema(auth_from_env())
+    if preload_app:
+        from app import classifier
+        classifier.warm_up()
+        # Objects loaded so far are never collected, so the collector does not write to shared pages.
+        gc.freeze()
+
+
+def post_worker_init(worker):
+    # Runs in each worker before it accepts requests.
+    from app import classifier
+    classifier.warm_up()
+
+
+def worker_exit(server, worker):
+    # Write out activity updates still buffered in this worker.
+    from app import activitylog_obj
+    activitylog_obj.flush()
@@ -0,0 +1,46 @@
+import json
+import os
+import uuid
+from typing import Callable, Dict
+
+
+def atomic_write(path: str, write: Callable[[str], None]):
+    """
+    Writes a file through a temporary file renamed over path once complete and synced, so readers
+    see either the previous content or the new one, never a partial file.
+    Args:
+        path: destination file.
+        write: callable writing the content to the temporary path it is given.
+    """
+    tmp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+    try:
+        write(tmp_path)
+        with open(tmp_path, 'rb') as tmp_file:
+            os.fsync(tmp_file.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+
+def atomic_write_json(path: str, payload: Dict, **dump_kwargs):
+    """
+    Writes payload as json with atomic_write.
+    Args:
+        path: destination file.
+        payload: json serializable object.
+        dump_kwargs: forwarded to json.dump, e.g. indent.
+    """
+    def write(tmp_path):
+        with open(tmp_path, 'w') as json_file:
+            json.dump(payload, json_file, **dump_kwargs)
+    atomic_write(path, write)
+
+
+def directory_size(path: str) -> int:
+    """
+    Total size in bytes of the files of a directory, or of the directory a symlink points at.
+    """
+    directory = os.path.realpath(path)
+    return sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory))
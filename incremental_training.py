@@ -0,0 +1,172 @@
+import logging
+import math
+import os
+from collections import Counter
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.linear_model import LogisticRegression
+from sklearn.pipeline import Pipeline
+
+from model_artifact import is_exportable
+
+
+# Newly labelled reviews, same columns as DATA_PATH, folded into the active model by incremental training.
+INCREMENTAL_DATA_PATH = os.environ.get('INCREMENTAL_DATA_PATH', './data/new_reviews.csv')
+# Unknown terms join the vocabulary once they occur in this many new documents...
+INCREMENTAL_MIN_DF = int(os.environ.get('INCREMENTAL_MIN_DF', 2))
+# ...and at most this many of them per run, the most frequent first.
+INCREMENTAL_MAX_NEW_TERMS = int(os.environ.get('INCREMENTAL_MAX_NEW_TERMS', 10000))
+# Previously seen reviews refitted with the new ones, per new review, so the model does not drift to the delta.
+INCREMENTAL_REPLAY_RATIO = float(os.environ.get('INCREMENTAL_REPLAY_RATIO', 1.0))
+# Largest accuracy loss against the active model on the held out reviews that still gets published.
+INCREMENTAL_MAX_ACCURACY_DROP = float(os.environ.get('INCREMENTAL_MAX_ACCURACY_DROP', 0.005))
+
+logger = logging.getLogger(__name__)
+
+
+class IncrementalTrainingError(RuntimeError):
+    """Error when the active model can not be updated, or the updated one is not good enough to publish."""
+
+
+def document_frequencies(vectorizer: TfidfVectorizer, n_docs: int) -> np.ndarray:
+    """
+    Recovers the document frequency of every term from the idf of a fitted vectorizer.
+    Args:
+        vectorizer: fitted TfidfVectorizer.
+        n_docs: number of documents the vectorizer was fitted on.
+    """
+    smooth = int(vectorizer.smooth_idf)
+    # Inverse of idf = ln((n + smooth) / (df + smooth)) + 1
+    return np.rint((n_docs + smooth) / np.exp(vectorizer.idf_ - 1) - smooth).astype(np.int64)
+
+
+def _idf(df: np.ndarray, n_docs: int, smooth_idf: bool) -> np.ndarray:
+    smooth = int(smooth_idf)
+    return np.log((n_docs + smooth) / (df + smooth)) + 1
+
+
+def grow_vectorizer(vectorizer: TfidfVectorizer, n_docs: int, texts: Sequence[str],
+                    min_df: int = INCREMENTAL_MIN_DF,
+                    max_new_terms: int = INCREMENTAL_MAX_NEW_TERMS) -> Tuple[TfidfVectorizer, int, List[str]]:
+    """
+    Adds new documents to the statistics of a fitted vectorizer without refitting it.
+    Known terms keep their column, admitted new terms are appended after them.
+    Returns (new vectorizer, documents it accounts for, terms added).
+    Args:
+        vectorizer: fitted TfidfVectorizer, left unchanged.
+        n_docs: number of documents the vectorizer accounts for.
+        texts: preprocessed new documents.
+        min_df: new documents a term must occur in to join the vocabulary.
+        max_new_terms: most terms added, the vocabulary also stays within the vectorizer's max_features.
+    """
+    analyze = vectorizer.build_analyzer()
+    vocabulary = vectorizer.vocabulary_
+    delta_df = np.zeros(len(vocabulary), dtype=np.int64)
+    unknown_df = Counter()
+    for text in texts:
+        for term in set(analyze(text)):
+            index = vocabulary.get(term)
+            if index is None:
+                unknown_df[term] += 1
+            else:
+                delta_df[index] += 1
+
+    limit = max_new_terms
+    if vectorizer.max_features is not None:
+        limit = min(limit, max(vectorizer.max_features - len(vocabulary), 0))
+    candidates = sorted((term for term, df in unknown_df.items() if df >= min_df),
+                        key=lambda term: (-unknown_df[term], term))
+    added = candidates[:limit]
+
+    n_docs += len(texts)
+    df = np.concatenate([
+        document_frequencies(vectorizer, n_docs - len(texts)) + delta_df,
+        np.array([unknown_df[term] for term in added], dtype=np.int64),
+    ])
+    grown_vocabulary = dict(vocabulary)
+    grown_vocabulary.update((term, len(vocabulary) + offset) for offset, term in enumerate(added))
+    # A fixed vocabulary and an assigned idf_ make a fitted vectorizer, fit would recompute the idf from texts only.
+    grown = TfidfVectorizer(**dict(vectorizer.get_params(), vocabulary=grown_vocabulary))
+    grown.idf_ = _idf(df, n_docs, vectorizer.smooth_idf)
+    return grown, n_docs, added
+
+
+def warm_start_classifier(classifier: LogisticRegression, n_features: int) -> LogisticRegression:
+    """
+    Returns an unfitted copy of a fitted LogisticRegression that starts from its coefficients,
+    zero for the features appended since it was fitted.
+    """
+    grown = LogisticRegression(**dict(classifier.get_params(), warm_start=True))
+    n_new = n_features - classifier.coef_.shape[1]
+    grown.coef_ = np.hstack([classifier.coef_, np.zeros((classifier.coef_.shape[0], n_new))])
+    grown.intercept_ = classifier.intercept_.copy()
+    return grown
+
+
+def holdout_shortfall(labels: Sequence[int], fraction: float) -> Optional[str]:
+    """
+    Returns why labels are too few for a stratified split holding out fraction of them, None when
+    they can be split. A delta of a few reviews is normal for incremental training.
+    Args:
+        labels: numeric sentiment of the new documents.
+        fraction: share of them held out, see split_validation.
+    """
+    if fraction <= 0:
+        return None
+    counts = Counter(labels)
+    # Sizes as train_test_split computes them for a fractional test_size.
+    n_holdout = math.ceil(len(labels) * fraction)
+    n_fit = len(labels) - n_holdout
+    if n_holdout < len(counts) or n_fit < len(counts):
+        return (f'{len(labels)} new reviews leave {n_holdout} held out and {n_fit} fitted, '
+                f'both need one per class ({len(counts)})')
+    if counts and min(counts.values()) < 2:
+        return f'every class needs at least 2 new reviews, got {dict(counts)}'
+    return None
+
+
+def update_model(pipeline: Pipeline, n_docs: int, new_texts: Sequence[str], fit_texts: Sequence[str],
+                 fit_labels: Sequence[int]) -> Tuple[Pipeline, Dict]:
+    """
+    Returns the pipeline updated with new documents, and facts about the update.
+    The vectorizer statistics grow with new_texts only, while the classifier is refitted on
+    fit_texts, i.e. the new documents plus a replayed sample of previous ones, starting from the
+    previous coefficients. The given pipeline is left unchanged.
+    Args:
+        pipeline: fitted TF-IDF + LogisticRegression pipeline accepted by is_exportable.
+        n_docs: number of documents its vectorizer was fitted on.
+        new_texts: preprocessed new documents.
+        fit_texts: preprocessed documents the classifier is fitted on.
+        fit_labels: numeric sentiment of fit_texts.
+    """
+    if not is_exportable(pipeline):
+        raise IncrementalTrainingError('Incremental training needs a TF-IDF + LogisticRegression model')
+    (vectorizer_name, vectorizer), (classifier_name, classifier) = pipeline.steps
+    grown_vectorizer, grown_docs, added = grow_vectorizer(vectorizer, n_docs, new_texts)
+    grown_classifier = warm_start_classifier(classifier, len(grown_vectorizer.vocabulary_))
+    grown_classifier.fit(grown_vectorizer.transform(fit_texts), fit_labels)
+    logger.info(f'Incremental update new_docs={len(new_texts)} fit_docs={len(fit_texts)} '
+                f'new_terms={len(added)} vocabulary={len(grown_vectorizer.vocabulary_)} '
+                f'n_iter={int(grown_classifier.n_iter_.max())}')
+    model = Pipeline([(vectorizer_name, grown_vectorizer), (classifier_name, grown_classifier)])
+    return model, {'n_docs': grown_docs, 'new_terms': len(added),
+                   'vocabulary_size': len(grown_vectorizer.vocabulary_)}
+
+
+def check_accuracy(previous: Pipeline, updated: Pipeline, texts: Sequence[str], labels: Sequence[int],
+                   max_drop: float = INCREMENTAL_MAX_ACCURACY_DROP) -> Dict:
+    """
+    Scores both models on held out documents and raises IncrementalTrainingError when the
+    updated one loses more than max_drop accuracy. Returns both accuracies.
+    """
+    accuracy = float(updated.score(texts, labels))
+    previous_accuracy = float(previous.score(texts, labels))
+    logger.info(f'Incremental holdout accuracy={accuracy:.4f} previous_accuracy={previous_accuracy:.4f} '
+                f'documents={len(texts)}')
+    if accuracy < previous_accuracy - max_drop:
+        raise IncrementalTrainingError(
+            f'Updated model accuracy {accuracy:.4f} is below the active model accuracy '
+            f'{previous_accuracy:.4f} on {len(texts)} held out reviews, not publishing it')
+    return {'validation_accuracy': accuracy, 'previous_accuracy': previous_accuracy}
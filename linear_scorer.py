@@ -0,0 +1,242 @@
+"""
+Scores a single preprocessed review straight from the weights of the trained linear model.
+
+Usage as a parity check of the current model against its sklearn pipeline:
+
+    python linear_scorer.py --data "./data/IMDB Dataset.csv" --limit 5000
+"""
+import argparse
+import math
+import os
+import re
+import threading
+from collections import Counter, deque
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from model_artifact import ArtifactModel, analyzer_settings, build_analyzer, is_exportable
+
+
+COMPILED_SCORER = os.environ.get('COMPILED_SCORER', 'True') == 'True'
+
+
+class LinearScorer:
+    def __init__(self, weights: Dict[str, Tuple[float, float]], intercept: float, classes: List,
+                 analyzer_settings: Dict):
+        """
+        TF-IDF + logistic regression scoring with plain dict lookups and float arithmetic.
+        Args:
+            weights: term -> (idf, idf * coefficient).
+            intercept: intercept of the logistic model.
+            classes: class labels, the second one being the positive class.
+            analyzer_settings: lowercase, token_pattern, ngram_range, binary, sublinear_tf, norm.
+        """
+        self.weights = weights
+        self.intercept = intercept
+        self.classes = list(classes)
+        self.binary = analyzer_settings['binary']
+        self.sublinear_tf = analyzer_settings['sublinear_tf']
+        self.norm = analyzer_settings['norm']
+        self.lowercase = analyzer_settings['lowercase']
+        self.token_re = re.compile(analyzer_settings['token_pattern'])
+        self.ngram_range = tuple(analyzer_settings['ngram_range'])
+        self.analyze = build_analyzer(self.lowercase, analyzer_settings['token_pattern'], self.ngram_range)
+
+    @classmethod
+    def from_pipeline(cls, pipeline) -> 'LinearScorer':
+        vectorizer, classifier = pipeline.steps[0][1], pipeline.steps[1][1]
+        coef, idf = classifier.coef_[0], vectorizer.idf_
+        weights = {
+            term: (float(idf[index]), float(idf[index] * coef[index]))
+            for term, index in vectorizer.vocabulary_.items()
+        }
+        return cls(weights, float(classifier.intercept_[0]), classifier.classes_.tolist(),
+                   analyzer_settings(vectorizer))
+
+    @classmethod
+    def from_artifact(cls, artifact: ArtifactModel) -> 'ArtifactScorer':
+        return ArtifactScorer(artifact)
+
+    def _iter_terms(self, tokens: Iterable[str]) -> Iterator[str]:
+        # The terms analyze finds in ' '.join(tokens) for token patterns that never match spaces.
+        min_n, max_n = self.ngram_range
+        previous = deque(maxlen=max_n)
+        for token in tokens:
+            for term in self.token_re.findall(token.lower() if self.lowercase else token):
+                previous.append(term)
+                for n in range(min_n, min(max_n, len(previous)) + 1):
+                    yield term if n == 1 else ' '.join(list(previous)[-n:])
+
+    def count_terms(self, tokens: Iterable[str]) -> Dict[str, int]:
+        """
+        Counts the vocabulary terms of a stream of preprocessed tokens, the terms analyze finds in
+        ' '.join(tokens) for token patterns that never match spaces, like the default one.
+        Unknown terms are dropped as they come, so memory stays bounded by the vocabulary.
+        """
+        weights = self.weights
+        counts = {}
+        for term in self._iter_terms(tokens):
+            if term in weights:
+                counts[term] = counts.get(term, 0) + 1
+        return counts
+
+    def decision_function(self, text: str) -> float:
+        """
+        Logit of the positive class for one preprocessed text.
+        """
+        return self._score(Counter(self.analyze(text)))
+
+    def _score(self, counts: Dict[str, int]) -> float:
+        dot = 0.0
+        squares = 0.0
+        absolutes = 0.0
+        for term, count in counts.items():
+            weight = self.weights.get(term)
+            if weight is None:
+                continue
+            if self.binary:
+                count = 1
+            elif self.sublinear_tf:
+                count = 1 + math.log(count)
+            idf, weighted_coef = weight
+            dot += count * weighted_coef
+            squares += (count * idf) ** 2
+            absolutes += count * idf
+        if self.norm == 'l2' and squares:
+            dot /= math.sqrt(squares)
+        elif self.norm == 'l1' and absolutes:
+            dot /= absolutes
+        return dot + self.intercept
+
+    def predict_proba(self, text: str) -> float:
+        """
+        Probability of the positive class for one preprocessed text.
+        """
+        return self._probability(self.decision_function(text))
+
+    def predict_proba_tokens(self, tokens: Iterable[str]) -> float:
+        """
+        Probability of the positive class for a stream of preprocessed tokens, e.g. from
+        preprocessing.iter_tokens, without building the preprocessed text.
+        """
+        return self._probability(self._score(self.count_terms(tokens)))
+
+    @staticmethod
+    def _probability(score: float) -> float:
+        # Split on the sign so exp never overflows for large logits.
+        if score >= 0:
+            return 1 / (1 + math.exp(-score))
+        exp_score = math.exp(score)
+        return exp_score / (1 + exp_score)
+
+    def predict(self, text: str):
+        return self.classes[1] if self.decision_function(text) > 0 else self.classes[0]
+
+
+class ArtifactScorer(LinearScorer):
+    def __init__(self, artifact: ArtifactModel):
+        """
+        LinearScorer reading the weights of the counted terms straight from the memory mapped arrays
+        of an artifact, found by binary search of its sorted terms. Nothing is copied per vocabulary
+        term, so it is ready at once and workers keep sharing the artifact's pages.
+        Args:
+            artifact: loaded model artifact.
+        """
+        super().__init__(None, artifact.intercept, artifact.classes_.tolist(), artifact.meta)
+        self.artifact = artifact
+
+    def count_terms(self, tokens: Iterable[str]) -> Dict[str, int]:
+        """
+        Counts the vocabulary terms of a stream of preprocessed tokens, see LinearScorer.count_terms.
+        Unknown terms are dropped once the stream ends, memory is bounded by the distinct terms of the stream.
+        """
+        counts = Counter(self._iter_terms(tokens))
+        if not counts:
+            return {}
+        known = self.artifact.lookup(list(counts)) >= 0
+        return {term: count for (term, count), is_known in zip(counts.items(), known) if is_known}
+
+    def _score(self, counts: Dict[str, int]) -> float:
+        indices = self.artifact.lookup(list(counts))
+        known = indices >= 0
+        if not known.any():
+            return self.intercept
+        indices = indices[known]
+        values = np.fromiter(counts.values(), dtype=np.float64, count=len(counts))[known]
+        if self.binary:
+            values.fill(1)
+        elif self.sublinear_tf:
+            values = 1 + np.log(values)
+        weighted = values * np.asarray(self.artifact.idf[indices], dtype=np.float64)
+        dot = float(weighted @ np.asarray(self.artifact.coef[indices], dtype=np.float64)) * self.artifact.coef_scale
+        if self.norm == 'l2':
+            dot /= math.sqrt(float(weighted @ weighted))
+        elif self.norm == 'l1':
+            dot /= float(weighted.sum())
+        return dot + self.intercept
+
+
+_scorer_cache = {'version': None, 'scorer': None}
+_scorer_lock = threading.Lock()
+
+
+def get_scorer(model, version: str) -> Optional[LinearScorer]:
+    """
+    Returns the scorer compiled from the given model version, None if the model is not linear.
+    The last compiled scorer is cached, so compilation happens once per model version.
+    """
+    if not COMPILED_SCORER:
+        return None
+    if _scorer_cache['version'] == version:
+        return _scorer_cache['scorer']
+    with _scorer_lock:
+        if _scorer_cache['version'] != version:
+            if isinstance(model, ArtifactModel):
+                scorer = LinearScorer.from_artifact(model)
+            elif is_exportable(model):
+                scorer = LinearScorer.from_pipeline(model)
+            else:
+                scorer = None
+            _scorer_cache.update(version=version, scorer=scorer)
+        return _scorer_cache['scorer']
+
+
+def check_parity(model, scorer: LinearScorer, texts: List[str]) -> Dict:
+    """
+    Compares the scorer with the model's predict_proba on preprocessed texts.
+    """
+    expected = model.predict(texts)
+    probabilities = model.predict_proba(texts)[:, 1]
+    disagreements = 0
+    max_difference = 0.0
+    for text, label, probability in zip(texts, expected, probabilities):
+        if scorer.predict(text) != label:
+            disagreements += 1
+        max_difference = max(max_difference, abs(scorer.predict_proba(text) - probability))
+    return {
+        'documents': len(texts),
+        'disagreements': disagreements,
+        'agreement': 1 - disagreements / len(texts) if texts else 1.0,
+        'max_probability_difference': max_difference,
+    }
+
+
+if __name__ == '__main__':
+    import pandas as pd
+    from model_registry import model_registry
+    from preprocessing import preprocess_many
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--data', default=os.environ.get('DATA_PATH', './data/IMDB Dataset.csv'))
+    parser.add_argument('--limit', type=int, default=None, help='only check the first N reviews')
+    args = parser.parse_args()
+
+    model, version = model_registry.current()
+    scorer = get_scorer(model, version)
+    if scorer is None:
+        raise SystemExit('The current model is not a TF-IDF + LogisticRegression model')
+    reviews = pd.read_csv(args.data, header=None, skiprows=1, names=['review', 'sentiment'], nrows=args.limit)
+    result = check_parity(model, scorer, preprocess_many(reviews['review']))
+    print(result)
+    raise SystemExit(0 if result['disagreements'] == 0 else 1)
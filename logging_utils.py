@@ -0,0 +1,13 @@
+import logging
+import os
+
+
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = 'ts=%(asctime)s level=%(levelname)s pid=%(process)d logger=%(name)s msg="%(message)s"'
+
+
+def configure_logging(level: str = LOG_LEVEL):
+    """
+    Configures root logging once per process as logfmt style lines, gated by LOG_LEVEL.
+    """
+    logging.basicConfig(level=level, format=LOG_FORMAT)
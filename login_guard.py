@@ -0,0 +1,84 @@
+import logging
+import os
+from typing import Optional
+
+
+LOGIN_MAX_FAILURES_PER_USER = int(os.environ.get('LOGIN_MAX_FAILURES_PER_USER', 5))
+LOGIN_MAX_FAILURES_PER_IP = int(os.environ.get('LOGIN_MAX_FAILURES_PER_IP', 20))
+# Each failure restarts the window, a blocked user or address is let through again after a quiet window.
+LOGIN_FAILURE_WINDOW = int(os.environ.get('LOGIN_FAILURE_WINDOW', 15 * 60))
+USER_KEY = 'login_failures:user:{username}'
+IP_KEY = 'login_failures:ip:{ip}'
+
+logger = logging.getLogger(__name__)
+
+
+class LoginGuard:
+    def __init__(self, redis_client, max_user_failures: int = LOGIN_MAX_FAILURES_PER_USER,
+                 max_ip_failures: int = LOGIN_MAX_FAILURES_PER_IP, window: int = LOGIN_FAILURE_WINDOW):
+        """
+        Counts failed logins per username and per client address in redis, and rejects further
+        attempts before any password hashing once either count reaches its limit.
+        Redis errors never block a login.
+        Args:
+            redis_client: client shared by all workers, so the limits hold across processes.
+            max_user_failures: failed attempts allowed per username and window.
+            max_ip_failures: failed attempts allowed per client address and window.
+            window: length of the counting window in seconds.
+        """
+        self.redis_client = redis_client
+        self.max_user_failures = max_user_failures
+        self.max_ip_failures = max_ip_failures
+        self.window = window
+
+    def _keys(self, username: str, ip: Optional[str]):
+        keys = [(USER_KEY.format(username=username), self.max_user_failures)]
+        if ip:
+            keys.append((IP_KEY.format(ip=ip), self.max_ip_failures))
+        return keys
+
+    def retry_after(self, username: str, ip: Optional[str]) -> int:
+        """
+        Returns the seconds until a blocked attempt may be retried, 0 if the attempt is allowed.
+        Args:
+            username: username the login is for.
+            ip: address of the client.
+        """
+        keys = self._keys(username, ip)
+        try:
+            pipe = self.redis_client.pipeline()
+            for key, _ in keys:
+                pipe.get(key)
+                pipe.ttl(key)
+            replies = pipe.execute()
+        except Exception as exc:
+            logger.warning(f'Login guard lookup failed : {exc}')
+            return 0
+        retry_after = 0
+        for index, (_, limit) in enumerate(keys):
+            failures, ttl = replies[2 * index], replies[2 * index + 1]
+            if failures is not None and int(failures) >= limit:
+                retry_after = max(retry_after, ttl if ttl and ttl > 0 else self.window)
+        return retry_after
+
+    def record_failure(self, username: str, ip: Optional[str]):
+        """
+        Counts a failed attempt against the username and the client address.
+        """
+        try:
+            pipe = self.redis_client.pipeline()
+            for key, _ in self._keys(username, ip):
+                pipe.incr(key)
+                pipe.expire(key, self.window)
+            pipe.execute()
+        except Exception as exc:
+            logger.warning(f'Login guard update failed : {exc}')
+
+    def record_success(self, username: str):
+        """
+        Clears the failures of the username, the client address keeps its count.
+        """
+        try:
+            self.redis_client.delete(USER_KEY.format(username=username))
+        except Exception as exc:
+            logger.warning(f'Login guard reset failed : {exc}')
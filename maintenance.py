@@ -0,0 +1,132 @@
+"""
+Retention jobs: deletes expired tokens and activity rows of long inactive users in bounded batches.
+
+Run once from the command line, e.g. from cron:
+
+    python maintenance.py
+
+or keep running it every MAINTENANCE_INTERVAL seconds:
+
+    python maintenance.py --loop
+"""
+import argparse
+import json
+import logging
+import os
+import time
+import uuid
+from typing import Dict, Optional
+
+from logging_utils import configure_logging
+from metrics import MAINTENANCE_ROWS_PURGED, MAINTENANCE_SECONDS
+from postgres_utils import ACTIVITY_RETENTION_DAYS, PURGE_BATCH_SIZE
+from worker_threads import WorkerThread
+
+
+# Seconds between two runs across all workers, 0 disables the in-app scheduler.
+MAINTENANCE_INTERVAL = int(os.environ.get('MAINTENANCE_INTERVAL', 3600))
+LOCK_KEY = 'maintenance_lock'
+REPORT_KEY = 'maintenance:last_run'
+
+logger = logging.getLogger(__name__)
+
+
+def run_maintenance(token_db, activity_db, batch_size: int = PURGE_BATCH_SIZE,
+                    retention_days: int = ACTIVITY_RETENTION_DAYS) -> Dict:
+    """
+    Runs every retention job and returns the rows purged and seconds taken per table.
+    Args:
+        token_db: TokensDB whose expired tokens are deleted.
+        activity_db: ActivityLogDB whose inactive users are deleted.
+        batch_size: maximum number of rows deleted per statement.
+        retention_days: days of inactivity after which an activity row is deleted.
+    """
+    jobs = {
+        token_db.table_name: lambda: token_db.purge_expired(batch_size=batch_size),
+        activity_db.table_name: lambda: activity_db.purge_inactive(
+            retention_days=retention_days, batch_size=batch_size),
+    }
+    report = {}
+    for table, job in jobs.items():
+        start = time.perf_counter()
+        purged = job()
+        seconds = time.perf_counter() - start
+        MAINTENANCE_ROWS_PURGED.labels(table=table).inc(purged)
+        MAINTENANCE_SECONDS.labels(table=table).observe(seconds)
+        report[table] = {'rows_purged': purged, 'seconds': round(seconds, 3)}
+        logger.info(f'Retention job done table={table} rows_purged={purged} seconds={seconds:.3f}')
+    return report
+
+
+class MaintenanceScheduler:
+    def __init__(self, redis_client, token_db, activity_db, interval: int = MAINTENANCE_INTERVAL,
+                 **job_kwargs):
+        """
+        Runs the retention jobs every interval seconds from a background thread of each worker.
+        A redis lock held for the whole interval makes sure only one worker runs them per interval.
+        Args:
+            redis_client: client shared by all workers.
+            token_db: TokensDB whose expired tokens are deleted.
+            activity_db: ActivityLogDB whose inactive users are deleted.
+            interval: seconds between two runs, 0 disables the scheduler.
+            job_kwargs: forwarded to run_maintenance, e.g. batch_size.
+        """
+        self.redis_client = redis_client
+        self.token_db = token_db
+        self.activity_db = activity_db
+        self.interval = interval
+        self.job_kwargs = job_kwargs
+        self._thread = WorkerThread(self._run, name='maintenance')
+
+    def start(self):
+        if self.interval:
+            self._thread.start()
+
+    def run_once(self) -> Optional[Dict]:
+        """
+        Runs the retention jobs unless another worker ran them within the interval.
+        Returns the report of the run, or None when it was skipped.
+        """
+        try:
+            if not self.redis_client.set(LOCK_KEY, uuid.uuid4().hex, nx=True, ex=self.interval):
+                return None
+        except Exception as exc:
+            logger.warning(f'Skipping retention jobs, failed to take the lock : {exc}')
+            return None
+        report = run_maintenance(self.token_db, self.activity_db, **self.job_kwargs)
+        try:
+            self.redis_client.set(REPORT_KEY, json.dumps(dict(report, finished_at=time.time())))
+        except Exception as exc:
+            logger.warning(f'Failed to store the retention report : {exc}')
+        return report
+
+    def _run(self):
+        while True:
+            try:
+                self.run_once()
+            except Exception:
+                logger.exception('Retention jobs failed')
+            time.sleep(self.interval)
+
+
+if __name__ == '__main__':
+    from postgres_utils import ActivityLogDB, TokensDB, auth_from_env
+    from redis_utils import get_redis_client
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--batch-size', type=int, default=PURGE_BATCH_SIZE)
+    parser.add_argument('--retention-days', type=int, default=ACTIVITY_RETENTION_DAYS)
+    parser.add_argument('--loop', action='store_true',
+                        help='run every MAINTENANCE_INTERVAL seconds, sharing the lock with the app workers')
+    args = parser.parse_args()
+
+    configure_logging()
+    auth = auth_from_env()
+    token_db, activity_db = TokensDB(auth), ActivityLogDB(auth)
+    job_kwargs = {'batch_size': args.batch_size, 'retention_days': args.retention_days}
+    if args.loop:
+        if MAINTENANCE_INTERVAL <= 0:
+            raise SystemExit('MAINTENANCE_INTERVAL must be positive with --loop')
+        MaintenanceScheduler(get_redis_client(), token_db, activity_db, **job_kwargs)._run()
+    else:
+        print(json.dumps(run_maintenance(token_db, activity_db, **job_kwargs)))
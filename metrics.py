@@ -0,0 +1,232 @@
+"""
+Minimal in-process metrics rendered in the Prometheus text exposition format.
+
+Values live in the process that records them, so every gunicorn worker exposes its own series.
+"""
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from functools import wraps
+from typing import Callable, Dict, List, Sequence, Tuple
+
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+               for value in labels.values())
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + '}'
+
+
+class _Metric:
+    kind = ''
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+        REGISTRY.register(self)
+
+    def labels(self, **labels):
+        """
+        Returns the child series for the given label values, creating it on first use.
+        """
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        child = self._children.get(key)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(key, self._new_child())
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        for key, child in sorted(self._children.items()):
+            lines.extend(child.render(self.name, dict(zip(self.labelnames, key))))
+        return lines
+
+
+class _CounterChild:
+    def __init__(self):
+        self.value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1):
+        with self._lock:
+            self.value += amount
+
+    def render(self, name, labels):
+        return [f'{name}_total{_format_labels(labels)} {self.value}']
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount: float = 1):
+        self.labels().inc(amount)
+
+
+class _GaugeChild:
+    def __init__(self):
+        self.value = 0.0
+        self.function = None
+
+    def set(self, value: float):
+        self.value = value
+
+    def set_function(self, function: Callable[[], float]):
+        """
+        Reads the value from function every time the metrics are rendered.
+        """
+        self.function = function
+
+    def render(self, name, labels):
+        value = self.function() if self.function else self.value
+        return [f'{name}{_format_labels(labels)} {value}']
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def _new_child(self):
+        return _GaugeChild()
+
+    def set(self, value: float):
+        self.labels().set(value)
+
+    def set_function(self, function: Callable[[], float]):
+        self.labels().set_function(function)
+
+
+class _HistogramChild:
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    @contextmanager
+    def time(self):
+        """
+        Observes the wall time spent in the block, in seconds.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def render(self, name, labels):
+        with self._lock:
+            counts, total = list(self.counts), self.sum
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            le = '+Inf' if bound == float('inf') else repr(bound)
+            lines.append(f'{name}_bucket{_format_labels(dict(labels, le=le))} {cumulative}')
+        lines.append(f'{name}_sum{_format_labels(labels)} {total}')
+        lines.append(f'{name}_count{_format_labels(labels)} {cumulative}')
+        return lines
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value: float):
+        self.labels().observe(value)
+
+    def time(self):
+        return self.labels().time()
+
+
+def timed(histogram: Histogram, **labels):
+    """
+    Decorator observing the duration of every call of the wrapped function.
+    """
+    def decorator(function):
+        child = histogram.labels(**labels)
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            with child.time():
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric: _Metric):
+        with self._lock:
+            self._metrics.append(metric)
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics)
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+HTTP_REQUEST_SECONDS = Histogram(
+    'sentiment_http_request_seconds', 'Time spent in route handlers.', ('endpoint', 'method', 'status'))
+INFERENCE_STAGE_SECONDS = Histogram(
+    'sentiment_inference_stage_seconds', 'Time spent per inference stage.', ('stage', 'path'))
+MODEL_LOAD_SECONDS = Histogram(
+    'sentiment_model_load_seconds', 'Time spent loading a model into the registry.',
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30))
+DB_QUERY_SECONDS = Histogram(
+    'sentiment_db_query_seconds', 'Time spent executing postgres queries.', ('table', 'operation'))
+DB_QUERY_ERRORS = Counter(
+    'sentiment_db_query_errors', 'Failed postgres queries.', ('table', 'operation'))
+REDIS_COMMAND_SECONDS = Histogram(
+    'sentiment_redis_command_seconds', 'Time spent in redis commands.', ('command',))
+REDIS_COMMAND_ERRORS = Counter(
+    'sentiment_redis_command_errors', 'Failed redis commands.', ('command',))
+PREDICTION_CACHE_LOOKUPS = Counter(
+    'sentiment_prediction_cache_lookups', 'Prediction cache lookups by result.', ('result',))
+PASSWORD_HASH_SECONDS = Histogram(
+    'sentiment_password_hash_seconds', 'Time spent in bcrypt operations.', ('operation',))
+LOGIN_ATTEMPTS = Counter(
+    'sentiment_login_attempts', 'Login attempts by result.', ('result',))
+MAINTENANCE_ROWS_PURGED = Counter(
+    'sentiment_maintenance_rows_purged', 'Rows deleted by the retention jobs.', ('table',))
+MAINTENANCE_SECONDS = Histogram(
+    'sentiment_maintenance_seconds', 'Time spent in retention jobs.', ('table',),
+    buckets=(0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300))
+SHADOW_PREDICTIONS = Counter(
+    'sentiment_shadow_predictions', 'Candidate model predictions by agreement with the active model.', ('result',))
+REQUESTS_REJECTED = Counter(
+    'sentiment_requests_rejected', 'Requests turned away by admission control.', ('endpoint', 'reason'))
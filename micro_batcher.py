@@ -0,0 +1,84 @@
+import logging
+import os
+import queue
+import time
+from concurrent.futures import Future
+from typing import Callable, List
+
+from metrics import Histogram
+from worker_threads import WorkerThread
+
+
+MICROBATCH_MAX_SIZE = int(os.environ.get('MICROBATCH_MAX_SIZE', 64))
+MICROBATCH_MAX_WAIT_MS = float(os.environ.get('MICROBATCH_MAX_WAIT_MS', 5))
+
+BATCH_SIZE = Histogram(
+    'sentiment_microbatch_size', 'Requests scored together by the micro-batcher.',
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256))
+
+logger = logging.getLogger(__name__)
+
+
+class MicroBatcher:
+    def __init__(self, predict_batch: Callable[[List[str]], List], max_batch_size: int = MICROBATCH_MAX_SIZE,
+                 max_wait_ms: float = MICROBATCH_MAX_WAIT_MS):
+        """
+        Collects concurrently submitted texts and scores them with one vectorized call.
+        A batch is scored once it holds max_batch_size texts or its first text waited max_wait_ms,
+        which bounds the latency added to any request.
+        Args:
+            predict_batch: callable returning one result per text, e.g. MovieReviewClassifier.infer_batch.
+            max_batch_size: maximum number of texts scored together.
+            max_wait_ms: maximum time the first text of a batch waits for more to arrive.
+        """
+        self.predict_batch = predict_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self._queue = queue.Queue()
+        self._worker = WorkerThread(self._run, make_args=self._new_queue, name='microbatch')
+
+    def _new_queue(self):
+        # Texts queued in the parent process would never be scored by this process's thread.
+        self._queue = queue.Queue()
+        return (self._queue,)
+
+    def submit(self, text: str) -> Future:
+        """
+        Queues a text and returns a future resolved with its prediction.
+        """
+        self._worker.start()
+        future = Future()
+        self._queue.put((text, future))
+        return future
+
+    def _collect(self, pending: queue.Queue) -> list:
+        batch = [pending.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(pending.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self, pending: queue.Queue):
+        while True:
+            batch = self._collect(pending)
+            live = [(text, future) for text, future in batch if future.set_running_or_notify_cancel()]
+            if not live:
+                continue
+            texts = [text for text, _ in live]
+            futures = [future for _, future in live]
+            BATCH_SIZE.observe(len(texts))
+            try:
+                results = self.predict_batch(texts)
+            except Exception as exc:
+                logger.exception('Micro-batch prediction failed')
+                for future in futures:
+                    future.set_exception(exc)
+                continue
+            for future, result in zip(futures, results):
+                future.set_result(result)
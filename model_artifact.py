@@ -0,0 +1,313 @@
+import glob
+import hashlib
+import json
+import os
+import re
+import shutil
+import uuid
+from typing import Callable, Dict, List, Sequence, Tuple
+
+import numpy as np
+import scipy.sparse as sp
+from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.linear_model import LogisticRegression
+
+
+ARTIFACT_PATH = os.environ.get('MODEL_ARTIFACT_PATH', 'model/model_artifact')
+# Compaction applied when a trained model is exported, see save_artifact.
+ARTIFACT_MAX_FEATURES = int(os.environ['ARTIFACT_MAX_FEATURES']) if os.environ.get('ARTIFACT_MAX_FEATURES') else None
+ARTIFACT_PRUNE_BY = os.environ.get('ARTIFACT_PRUNE_BY', 'coef')
+ARTIFACT_QUANTIZE = os.environ.get('ARTIFACT_QUANTIZE') or None
+FORMAT_VERSION = 2
+# Version 1 artifacts only lack the coefficient scale, which then is 1.
+SUPPORTED_FORMAT_VERSIONS = (1, 2)
+META_FILE = 'meta.json'
+# Sorted vocabulary as fixed width bytes (searchable with np.searchsorted while memory mapped)
+# and the feature index of each sorted term.
+TERMS_FILE = 'terms.npy'
+TERM_INDEX_FILE = 'term_index.npy'
+IDF_FILE = 'idf.npy'
+COEF_FILE = 'coef.npy'
+
+
+class ArtifactFormatError(ValueError):
+    """Error when a pipeline can not be exported to, or a directory is not, a model artifact."""
+
+
+def is_exportable(pipeline) -> bool:
+    """
+    True for fitted TF-IDF + binary LogisticRegression pipelines using the default word analyzer.
+    """
+    steps = getattr(pipeline, 'steps', None)
+    if not steps or len(steps) != 2:
+        return False
+    vectorizer, classifier = steps[0][1], steps[1][1]
+    return (
+        isinstance(vectorizer, TfidfVectorizer)
+        and isinstance(classifier, LogisticRegression)
+        and hasattr(classifier, 'coef_') and classifier.coef_.shape[0] == 1
+        and vectorizer.analyzer == 'word' and vectorizer.use_idf
+        and vectorizer.tokenizer is None and vectorizer.preprocessor is None
+        and vectorizer.strip_accents is None and vectorizer.stop_words is None
+    )
+
+
+def build_analyzer(lowercase: bool, token_pattern: str, ngram_range: Sequence[int]) -> Callable[[str], List[str]]:
+    """
+    Returns a function producing the same terms as TfidfVectorizer's word analyzer for the
+    settings accepted by is_exportable.
+    """
+    token_re = re.compile(token_pattern)
+    min_n, max_n = ngram_range
+
+    def analyze(text: str) -> List[str]:
+        if lowercase:
+            text = text.lower()
+        tokens = token_re.findall(text)
+        if max_n == 1:
+            return tokens
+        ngrams = list(tokens) if min_n == 1 else []
+        for n in range(max(min_n, 2), max_n + 1):
+            ngrams.extend(' '.join(tokens[i:i + n]) for i in range(len(tokens) - n + 1))
+        return ngrams
+    return analyze
+
+
+def analyzer_settings(vectorizer: TfidfVectorizer) -> Dict:
+    """
+    Settings of a fitted vectorizer needed to reproduce its transform, as stored in meta.json.
+    """
+    return {
+        'lowercase': vectorizer.lowercase,
+        'token_pattern': vectorizer.token_pattern,
+        'ngram_range': list(vectorizer.ngram_range),
+        'binary': vectorizer.binary,
+        'sublinear_tf': vectorizer.sublinear_tf,
+        'norm': vectorizer.norm,
+    }
+
+
+def prune_features(vocabulary: Dict[str, int], idf: np.ndarray, coef: np.ndarray, max_features: int,
+                   by: str = 'coef') -> Tuple[Dict[str, int], np.ndarray, np.ndarray]:
+    """
+    Keeps the max_features terms with the largest absolute coefficient ('coef') or document
+    frequency ('df') and renumbers them. Returns the pruned (vocabulary, idf, coef).
+    """
+    if by not in ('coef', 'df'):
+        raise ValueError(f'Unknown pruning criterion {by}')
+    if max_features is None or max_features >= len(idf):
+        return vocabulary, idf, coef
+    # idf decreases as document frequency grows, whatever the number of training documents.
+    ranking = np.abs(coef) if by == 'coef' else -np.asarray(idf)
+    kept = np.sort(np.argsort(-ranking, kind='stable')[:max_features])
+    new_index = np.full(len(idf), -1, dtype=np.int64)
+    new_index[kept] = np.arange(len(kept))
+    vocabulary = {term: int(new_index[index]) for term, index in vocabulary.items() if new_index[index] >= 0}
+    return vocabulary, np.asarray(idf)[kept], np.asarray(coef)[kept]
+
+
+def quantize_coef(coef: np.ndarray, dtype: str = None) -> Tuple[np.ndarray, float]:
+    """
+    Returns (stored coefficients, scale), the coefficients being stored * scale.
+    Args:
+        coef: coefficients of the linear model.
+        dtype: None keeps float64, 'float16' takes a quarter of the bytes, 'int8' an eighth by
+            storing round(coef / scale) with scale = max |coef| / 127.
+    """
+    coef = np.asarray(coef, dtype=np.float64)
+    if dtype is None:
+        return coef, 1.0
+    if dtype == 'float16':
+        return coef.astype(np.float16), 1.0
+    if dtype == 'int8':
+        scale = float(np.abs(coef).max()) / 127 if len(coef) else 0.0
+        scale = scale or 1.0
+        return np.round(coef / scale).astype(np.int8), scale
+    raise ValueError(f'Unknown quantization {dtype}')
+
+
+def _write_arrays(directory: str, vocabulary: Dict[str, int], idf: np.ndarray, coef: np.ndarray,
+                  intercept: float, classes: List, settings: Dict, extra_meta: Dict = None,
+                  coef_scale: float = 1.0) -> str:
+    terms = sorted(vocabulary)
+    arrays = {
+        TERMS_FILE: np.array([term.encode('utf-8') for term in terms], dtype=bytes),
+        TERM_INDEX_FILE: np.array([vocabulary[term] for term in terms], dtype=np.int32),
+        IDF_FILE: np.asarray(idf),
+        COEF_FILE: np.ascontiguousarray(coef),
+    }
+    digest = hashlib.sha256()
+    for name, array in arrays.items():
+        np.save(os.path.join(directory, name), array)
+        digest.update(array.tobytes())
+    meta = {
+        'format_version': FORMAT_VERSION,
+        'n_features': len(vocabulary),
+        'intercept': float(intercept),
+        'classes': [int(label) for label in classes],
+        'coef_scale': coef_scale,
+    }
+    meta.update(settings)
+    meta.update(extra_meta or {})
+    digest.update(json.dumps(meta, sort_keys=True).encode('utf-8'))
+    meta['digest'] = digest.hexdigest()[:16]
+    with open(os.path.join(directory, META_FILE), 'w') as meta_file:
+        json.dump(meta, meta_file)
+    return meta['digest']
+
+
+def save_artifact(pipeline, path: str = ARTIFACT_PATH, max_features: int = ARTIFACT_MAX_FEATURES,
+                  prune_by: str = ARTIFACT_PRUNE_BY, quantize: str = ARTIFACT_QUANTIZE, **extra_meta) -> str:
+    """
+    Writes the pipeline as raw numpy arrays and returns the artifact digest.
+    path becomes a symlink to a versioned directory, swapped atomically once all files are written.
+    Args:
+        pipeline: fitted pipeline accepted by is_exportable.
+        path: location of the artifact symlink.
+        max_features: optional number of features kept, see prune_features.
+        prune_by: 'coef' or 'df', the criterion of prune_features.
+        quantize: optional storage type of the coefficients, 'float16' or 'int8'.
+        extra_meta: additional json serializable fields stored in meta.json.
+    """
+    if not is_exportable(pipeline):
+        raise ArtifactFormatError('Only TF-IDF + binary LogisticRegression pipelines can be exported')
+    vectorizer, classifier = pipeline.steps[0][1], pipeline.steps[1][1]
+    vocabulary, idf, coef = prune_features(
+        vectorizer.vocabulary_, vectorizer.idf_, classifier.coef_[0], max_features, by=prune_by)
+    if max_features is not None:
+        extra_meta.update(pruned_from=len(vectorizer.idf_), prune_by=prune_by)
+    coef, coef_scale = quantize_coef(coef, quantize)
+    if quantize is not None:
+        # Once the coefficients are quantized, double precision idf only adds size.
+        idf = np.asarray(idf, dtype=np.float32)
+        extra_meta.update(quantize=quantize)
+    return write_artifact(path, vocabulary, idf, coef, classifier.intercept_[0], classifier.classes_,
+                          analyzer_settings(vectorizer), extra_meta, coef_scale=coef_scale)
+
+
+def write_artifact(path: str, vocabulary: Dict[str, int], idf: np.ndarray, coef: np.ndarray, intercept: float,
+                   classes: List, settings: Dict, extra_meta: Dict = None, coef_scale: float = 1.0) -> str:
+    """
+    Writes the vocabulary, idf and weights of a binary linear model as an artifact, see save_artifact.
+    """
+    parent = os.path.dirname(path) or '.'
+    base = os.path.basename(path)
+    tmp_dir = os.path.join(parent, f'.{base}-{uuid.uuid4().hex}.tmp')
+    os.makedirs(tmp_dir)
+    try:
+        digest = _write_arrays(tmp_dir, vocabulary, idf, coef, intercept, classes, settings, extra_meta,
+                               coef_scale=coef_scale)
+        target = os.path.join(parent, f'{base}-{digest}')
+        if os.path.isdir(target):
+            shutil.rmtree(tmp_dir)
+        else:
+            os.rename(tmp_dir, target)
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+    tmp_link = os.path.join(parent, f'.{base}-{uuid.uuid4().hex}.link')
+    os.symlink(os.path.basename(target), tmp_link)
+    os.replace(tmp_link, path)
+    # Workers still mapping an older version keep their pages, unlinking only drops the names.
+    for old in glob.glob(os.path.join(parent, f'{base}-*')):
+        if old != target:
+            shutil.rmtree(old, ignore_errors=True)
+    return digest
+
+
+def remove_artifact(path: str = ARTIFACT_PATH):
+    """
+    Removes the artifact symlink so a model that can not be exported is not shadowed by a stale one.
+    """
+    if os.path.islink(path):
+        os.unlink(path)
+
+
+class ArtifactModel:
+    def __init__(self, directory: str):
+        """
+        Memory mapped TF-IDF + logistic regression model with the predict API of the sklearn pipeline.
+        Args:
+            directory: artifact directory written by save_artifact.
+        """
+        with open(os.path.join(directory, META_FILE)) as meta_file:
+            self.meta = json.load(meta_file)
+        if self.meta.get('format_version') not in SUPPORTED_FORMAT_VERSIONS:
+            raise ArtifactFormatError(f'Unsupported artifact format {self.meta.get("format_version")}')
+        self.terms = np.load(os.path.join(directory, TERMS_FILE), mmap_mode='r')
+        self.term_index = np.load(os.path.join(directory, TERM_INDEX_FILE), mmap_mode='r')
+        self.idf = np.load(os.path.join(directory, IDF_FILE), mmap_mode='r')
+        self.coef = np.load(os.path.join(directory, COEF_FILE), mmap_mode='r')
+        self.intercept = self.meta['intercept']
+        self.coef_scale = self.meta.get('coef_scale', 1.0)
+        self.classes_ = np.array(self.meta['classes'])
+        self.version = self.meta['digest']
+        self._analyze = build_analyzer(
+            self.meta['lowercase'], self.meta['token_pattern'], self.meta['ngram_range'])
+
+    def lookup(self, terms: List[str]) -> np.ndarray:
+        """
+        Returns the feature index of every term, -1 for terms outside the vocabulary.
+        """
+        if not terms or not len(self.terms):
+            return np.full(len(terms), -1, dtype=np.int64)
+        keys = np.array([term.encode('utf-8') for term in terms], dtype=bytes)
+        positions = np.minimum(np.searchsorted(self.terms, keys), len(self.terms) - 1)
+        found = self.terms[positions] == keys
+        return np.where(found, self.term_index[positions], -1)
+
+    def transform(self, texts: List[str]) -> sp.csr_matrix:
+        """
+        TF-IDF features of the texts, equal to the fitted vectorizer's transform.
+        """
+        doc_tokens = [self._analyze(text) for text in texts]
+        lengths = np.array([len(tokens) for tokens in doc_tokens], dtype=np.int64)
+        indices = self.lookup([token for tokens in doc_tokens for token in tokens])
+        rows = np.repeat(np.arange(len(texts)), lengths)
+        known = indices >= 0
+        # Duplicate (row, column) pairs are summed into term counts by the conversion to csr.
+        matrix = sp.csr_matrix(
+            (np.ones(known.sum()), (rows[known], indices[known])),
+            shape=(len(texts), self.meta['n_features']))
+        matrix.sum_duplicates()
+        if self.meta['binary']:
+            matrix.data.fill(1)
+        elif self.meta['sublinear_tf']:
+            np.log(matrix.data, matrix.data)
+            matrix.data += 1
+        matrix = matrix @ sp.diags(np.asarray(self.idf))
+        return self._normalize(sp.csr_matrix(matrix))
+
+    def _normalize(self, matrix: sp.csr_matrix) -> sp.csr_matrix:
+        norm = self.meta['norm']
+        if norm is None:
+            return matrix
+        if norm == 'l2':
+            row_norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+        else:
+            row_norms = np.asarray(abs(matrix).sum(axis=1)).ravel()
+        row_norms[row_norms == 0] = 1
+        return sp.csr_matrix(sp.diags(1 / row_norms) @ matrix)
+
+    def decision_function(self, texts: List[str]) -> np.ndarray:
+        features = self.transform(texts)
+        # Only the coefficients of present features are read and widened, quantized ones included.
+        rows = np.repeat(np.arange(features.shape[0]), np.diff(features.indptr))
+        weights = features.data * np.asarray(self.coef[features.indices], dtype=np.float64)
+        scores = np.bincount(rows, weights=weights, minlength=features.shape[0])
+        return scores * self.coef_scale + self.intercept
+
+    def predict_proba(self, texts: List[str]) -> np.ndarray:
+        positive = 1 / (1 + np.exp(-self.decision_function(texts)))
+        return np.column_stack([1 - positive, positive])
+
+    def predict(self, texts: List[str]) -> np.ndarray:
+        return self.classes_[(self.decision_function(texts) > 0).astype(int)]
+
+
+def load_artifact(path: str = ARTIFACT_PATH) -> Tuple[ArtifactModel, str]:
+    """
+    Loads the artifact a symlink or directory points at and returns (model, version).
+    """
+    model = ArtifactModel(os.path.realpath(path))
+    return model, model.version
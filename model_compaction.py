@@ -0,0 +1,126 @@
+"""
+Reports the accuracy/size trade-off of compacted artifacts against the active model, and optionally
+publishes one of them as a new active version of the model store.
+
+    python model_compaction.py --max-features 5000 20000 50000 --quantize int8 --limit 5000
+    MODEL_FORMAT=artifact python model_compaction.py --max-features 20000 --quantize int8 --write
+
+Compaction can also be applied to every trained model with ARTIFACT_MAX_FEATURES,
+ARTIFACT_PRUNE_BY and ARTIFACT_QUANTIZE.
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+
+from file_utils import directory_size
+from linear_scorer import LinearScorer
+from model_artifact import is_exportable, load_artifact, save_artifact
+
+# Documents scored one by one to measure single request latency.
+LATENCY_SAMPLE = 1000
+
+
+def measure_artifact(path: str, texts: Sequence[str], labels: np.ndarray, reference: np.ndarray) -> Dict:
+    """
+    Size, load time, accuracy, agreement with the reference predictions and latency of an artifact.
+    Args:
+        path: artifact symlink or directory.
+        texts: preprocessed evaluation reviews.
+        labels: true labels of the texts.
+        reference: predictions of the full model on the texts.
+    """
+    start = time.perf_counter()
+    model, _ = load_artifact(path)
+    scorer = LinearScorer.from_artifact(model)
+    load_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    predictions = model.predict(list(texts))
+    batch_seconds = time.perf_counter() - start
+    sample = texts[:LATENCY_SAMPLE]
+    start = time.perf_counter()
+    for text in sample:
+        scorer.predict(text)
+    single_seconds = time.perf_counter() - start
+    return {
+        'n_features': model.meta['n_features'],
+        'bytes': directory_size(path),
+        'load_seconds': round(load_seconds, 4),
+        'accuracy': float(np.mean(predictions == labels)),
+        'agreement': float(np.mean(predictions == reference)),
+        'batch_docs_per_second': round(len(texts) / batch_seconds, 1) if batch_seconds else None,
+        'single_ms': round(1000 * single_seconds / len(sample), 4) if sample else None,
+    }
+
+
+def compare(pipeline, texts: Sequence[str], labels: Sequence, max_features: List[Optional[int]],
+            prune_by: str = 'coef', quantize: Optional[str] = None) -> Dict:
+    """
+    Measures the full model and one compacted artifact per max_features value.
+    Args:
+        pipeline: fitted pipeline accepted by is_exportable.
+        texts: preprocessed evaluation reviews.
+        labels: true labels of the texts.
+        max_features: numbers of features kept, None keeps every feature and only quantizes.
+        prune_by: 'coef' or 'df'.
+        quantize: optional storage type of the coefficients, 'float16' or 'int8'.
+    """
+    labels = np.asarray(labels)
+    reference = pipeline.predict(list(texts))
+    report = {'documents': len(texts), 'prune_by': prune_by, 'quantize': quantize, 'compacted': []}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        full_path = os.path.join(tmp_dir, 'full')
+        save_artifact(pipeline, full_path, max_features=None, quantize=None)
+        report['full'] = measure_artifact(full_path, texts, labels, reference)
+        for index, features in enumerate(max_features):
+            path = os.path.join(tmp_dir, f'compact{index}')
+            save_artifact(pipeline, path, max_features=features, prune_by=prune_by, quantize=quantize)
+            result = measure_artifact(path, texts, labels, reference)
+            result['size_ratio'] = round(result['bytes'] / report['full']['bytes'], 4)
+            result['accuracy_loss'] = round(report['full']['accuracy'] - result['accuracy'], 4)
+            report['compacted'].append(result)
+    return report
+
+
+if __name__ == '__main__':
+    import pandas as pd
+    from model_registry import MODEL_FORMAT, MODEL_PATH, load_pickle
+    from model_store import ModelStore
+    from preprocessing import preprocess_many
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--data', default=os.environ.get('DATA_PATH', './data/IMDB Dataset.csv'),
+                        help='labelled reviews to evaluate on, ideally not used for training')
+    parser.add_argument('--limit', type=int, default=None, help='only evaluate the first N reviews')
+    parser.add_argument('--max-features', type=int, nargs='+', default=[None])
+    parser.add_argument('--prune-by', choices=('coef', 'df'), default='coef')
+    parser.add_argument('--quantize', choices=('float16', 'int8'), default=None)
+    parser.add_argument('--write', action='store_true',
+                        help='publish the (single) compacted model to the model store and activate it, '
+                             'needs MODEL_FORMAT=artifact')
+    args = parser.parse_args()
+
+    store = ModelStore()
+    active = store.active()
+    pipeline = store.load_version(active) if active else load_pickle(MODEL_PATH)[0]
+    if not is_exportable(pipeline):
+        raise SystemExit('The current model is not a TF-IDF + LogisticRegression model')
+    if args.write and len(args.max_features) != 1:
+        raise SystemExit('--write takes a single --max-features value')
+    if args.write and MODEL_FORMAT != 'artifact':
+        # The version's pickle keeps every feature, only the artifact is compacted.
+        raise SystemExit(f"--write needs MODEL_FORMAT=artifact, workers with MODEL_FORMAT={MODEL_FORMAT} "
+                         f"would serve the uncompacted pickle of the version")
+    reviews = pd.read_csv(args.data, header=None, skiprows=1, names=['review', 'sentiment'], nrows=args.limit)
+    texts = preprocess_many(reviews['review'])
+    labels = reviews['sentiment'].map({'positive': 1, 'negative': 0}).to_numpy()
+    print(json.dumps(compare(pipeline, texts, labels, args.max_features, args.prune_by, args.quantize), indent=2))
+    if args.write:
+        metadata = dict(store.metadata(active), compacted_from=active) if active else {}
+        version = store.publish(pipeline, metadata, activate=True, max_features=args.max_features[0],
+                                prune_by=args.prune_by, quantize=args.quantize)
+        print(f'Activated compacted model version={version}')
@@ -0,0 +1,163 @@
+import hashlib
+import logging
+import os
+import pickle
+import threading
+from typing import Any, Callable, Optional, Tuple
+
+from metrics import MODEL_LOAD_SECONDS
+from model_store import ModelStore
+
+
+# Served until a version is activated in the model store.
+MODEL_PATH = os.environ.get('MODEL_PATH', 'model/model.pkl')
+# 'pickle' serves pickled models, 'artifact' their memory mapped export (MODEL_ARTIFACT_PATH outside the store).
+MODEL_FORMAT = os.environ.get('MODEL_FORMAT', 'pickle')
+
+logger = logging.getLogger(__name__)
+
+
+def load_pickle(path: str) -> Tuple[Any, str]:
+    """
+    Unpickles a model and returns (model, version), the version being a hash of the file.
+    """
+    with open(path, 'rb') as model_file:
+        data = model_file.read()
+    return pickle.loads(data), hashlib.sha256(data).hexdigest()[:16]
+
+
+class ModelRegistry:
+    def __init__(self, path: str, loader: Callable[[str], Tuple[Any, str]] = load_pickle,
+                 wait_for_first_load: bool = True):
+        """
+        Keeps a deserialized model in memory and reloads it when the file on disk changes.
+        Args:
+            path (str): location of the model.
+            loader: callable returning (model, version) for a path.
+            wait_for_first_load: False loads the first model in the background too, current()
+                returns (None, None) until it is ready.
+        """
+        self.path = path
+        self.loader = loader
+        self.wait_for_first_load = wait_for_first_load
+        # (model, version) are swapped together so readers never pair a model with the wrong version.
+        self._current = (None, None)
+        self._signature = None
+        # Signature of the last file that failed to load in the background, not retried until it changes.
+        self._failed_signature = None
+        self._load_lock = threading.Lock()
+
+    def _file_signature(self):
+        """
+        Returns a cheap fingerprint of the model file (inode, mtime, size) or None if it is missing.
+        """
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+    def _read(self, signature) -> Tuple[Any, str]:
+        return self.loader(self.path)
+
+    def _load(self, signature):
+        with MODEL_LOAD_SECONDS.time():
+            model, version = self._read(signature)
+        # Single attribute assignments are atomic, readers see either the old or the new model.
+        self._current = (model, version)
+        self._signature = signature
+        logger.info(f'Loaded model version={version} path={self.path}')
+
+    def current(self) -> Tuple[Optional[Any], Optional[str]]:
+        """
+        Returns (model, version). When the file was rewritten, the new model is loaded by a
+        background thread and requests keep using the previous model until it is ready.
+        """
+        signature = self._file_signature()
+        if signature is None or signature in (self._signature, self._failed_signature):
+            return self._current
+        if self._current[0] is None and self.wait_for_first_load:
+            # Nothing to serve yet, wait for whoever is loading.
+            with self._load_lock:
+                if signature != self._signature:
+                    self._load(signature)
+        elif self._load_lock.acquire(blocking=False):
+            threading.Thread(target=self._reload, args=(signature,), daemon=True).start()
+        return self._current
+
+    def _reload(self, signature):
+        # Runs with _load_lock held by the thread that started it.
+        try:
+            if signature != self._signature:
+                self._load(signature)
+        except Exception as exc:
+            self._failed_signature = signature
+            logger.error(f'Failed to reload model, keeping version={self.version} path={self.path} : {exc}')
+        finally:
+            self._load_lock.release()
+
+    def has_model(self) -> bool:
+        """
+        True if there is a model to load, without loading it.
+        """
+        return self._file_signature() is not None
+
+    def get(self) -> Optional[Any]:
+        """
+        Returns the current model, see current().
+        """
+        return self.current()[0]
+
+    @property
+    def version(self) -> Optional[str]:
+        return self._current[1]
+
+
+class StoreRegistry(ModelRegistry):
+    def __init__(self, store: ModelStore, fallback_path: str, fallback_loader: Callable[[str], Tuple[Any, str]],
+                 candidate: bool = False):
+        """
+        Serves the active (or candidate) version of a model store, watching its pointer file.
+        Until a version was activated, the model at fallback_path is served instead.
+        Args:
+            store: model store to serve from.
+            fallback_path: legacy model location, e.g. MODEL_PATH.
+            fallback_loader: callable returning (model, version) for fallback_path.
+            candidate: serve the shadow candidate instead of the active version, without fallback.
+                The candidate is only ever loaded in the background, requests never wait for it.
+        """
+        super().__init__(store.candidate_path if candidate else store.active_path,
+                         wait_for_first_load=not candidate)
+        self.store = store
+        self.fallback_path = None if candidate else fallback_path
+        self.fallback_loader = fallback_loader
+        self.candidate = candidate
+
+    def _file_signature(self):
+        for path in (self.path, self.fallback_path):
+            if path is None:
+                continue
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            return (path, stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        return None
+
+    def _read(self, signature) -> Tuple[Any, str]:
+        if signature[0] == self.fallback_path:
+            return self.fallback_loader(self.fallback_path)
+        if self.candidate:
+            return self.store.load_candidate(MODEL_FORMAT)
+        return self.store.load_active(MODEL_FORMAT)
+
+
+def _create_registry(candidate: bool = False) -> ModelRegistry:
+    if MODEL_FORMAT == 'artifact':
+        from model_artifact import ARTIFACT_PATH, load_artifact
+        return StoreRegistry(ModelStore(), ARTIFACT_PATH, load_artifact, candidate=candidate)
+    return StoreRegistry(ModelStore(), MODEL_PATH, load_pickle, candidate=candidate)
+
+
+model_registry = _create_registry()
+candidate_registry = _create_registry(candidate=True)
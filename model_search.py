@@ -0,0 +1,140 @@
+import functools
+import itertools
+import json
+import logging
+import os
+import tempfile
+import time
+from typing import Dict, List, Optional, Sequence
+
+import joblib
+import numpy as np
+from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.linear_model import LogisticRegression
+from sklearn.model_selection import StratifiedKFold
+
+from file_utils import atomic_write_json
+from model_registry import MODEL_PATH
+
+
+# JSON object mapping TfidfVectorizer parameters and C to the values tried, e.g.
+# {"ngram_range": [[1, 1], [1, 2]], "min_df": [1, 5], "max_features": [null], "C": [0.5, 1, 2]}
+SEARCH_GRID = os.environ.get('SEARCH_GRID')
+SEARCH_FOLDS = int(os.environ.get('SEARCH_FOLDS', 5))
+# joblib n_jobs, -1 uses every core.
+SEARCH_JOBS = int(os.environ.get('SEARCH_JOBS', -1))
+MODEL_SCORES_PATH = os.environ.get(
+    'MODEL_SCORES_PATH', os.path.join(os.path.dirname(MODEL_PATH) or '.', 'model_scores.json'))
+DEFAULT_GRID = {
+    'ngram_range': [(1, 1), (1, 2)],
+    'min_df': [1, 5],
+    'max_features': [None],
+    'C': [0.25, 1.0, 4.0],
+}
+
+logger = logging.getLogger(__name__)
+
+
+def get_grid() -> Dict[str, List]:
+    """
+    Returns the search grid from SEARCH_GRID, or the default one.
+    """
+    grid = json.loads(SEARCH_GRID) if SEARCH_GRID else DEFAULT_GRID
+    if 'ngram_range' in grid:
+        grid = dict(grid, ngram_range=[tuple(value) for value in grid['ngram_range']])
+    return grid
+
+
+def split_grid(grid: Dict[str, List]):
+    """
+    Splits the grid into the list of vectorizer parameter sets and the sorted C values.
+    """
+    c_values = sorted(grid.get('C', [1.0]))
+    names = sorted(name for name in grid if name != 'C')
+    vectorizer_params = [dict(zip(names, values)) for values in itertools.product(*(grid[name] for name in names))]
+    return vectorizer_params, c_values
+
+
+@functools.lru_cache(maxsize=1)
+def _load_corpus(path: str):
+    # Each worker process loads the dumped corpus once and reuses it for all of its tasks.
+    return joblib.load(path)
+
+
+def _score_fold(corpus_path: str, train_index: np.ndarray, test_index: np.ndarray,
+                vectorizer_params: Dict, c_values: Sequence[float]) -> List[float]:
+    """
+    Fits the vectorizer on one training fold and scores every C value on the held out fold.
+    The fold is vectorized once, and each fit starts from the solution of the previous, smaller C.
+    """
+    texts, labels = _load_corpus(corpus_path)
+    vectorizer = TfidfVectorizer(**vectorizer_params)
+    x_train = vectorizer.fit_transform(texts[train_index])
+    x_test = vectorizer.transform(texts[test_index])
+    classifier = LogisticRegression(warm_start=True)
+    scores = []
+    for c_value in c_values:
+        classifier.set_params(C=c_value)
+        classifier.fit(x_train, labels[train_index])
+        scores.append(float(classifier.score(x_test, labels[test_index])))
+    return scores
+
+
+def run_search(texts: Sequence[str], labels: Sequence[int], grid: Optional[Dict[str, List]] = None,
+               folds: int = SEARCH_FOLDS, n_jobs: int = SEARCH_JOBS) -> Dict:
+    """
+    Cross-validates every combination of the grid and returns the scores, best first.
+    One task per (vectorizer parameters, fold) runs on a joblib process pool.
+    Args:
+        texts: preprocessed reviews.
+        labels: numeric sentiment of each review.
+        grid: parameter name -> values tried, C goes to LogisticRegression, the rest to TfidfVectorizer.
+        folds: number of stratified cross-validation folds.
+        n_jobs: joblib worker processes, -1 uses every core.
+    """
+    vectorizer_params, c_values = split_grid(grid or get_grid())
+    texts, labels = np.asarray(texts, dtype=object), np.asarray(labels)
+    splits = list(StratifiedKFold(n_splits=folds, shuffle=True, random_state=0).split(texts, labels))
+    start = time.perf_counter()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # Dumped once instead of being pickled into every task.
+        corpus_path = os.path.join(tmp_dir, 'corpus.joblib')
+        joblib.dump((texts, labels), corpus_path)
+        tasks = list(itertools.product(range(len(vectorizer_params)), range(folds)))
+        fold_scores = joblib.Parallel(n_jobs=n_jobs)(
+            joblib.delayed(_score_fold)(corpus_path, *splits[fold], vectorizer_params[params], c_values)
+            for params, fold in tasks)
+
+    per_candidate = {}
+    for (params, _), scores in zip(tasks, fold_scores):
+        for c_value, score in zip(c_values, scores):
+            per_candidate.setdefault((params, c_value), []).append(score)
+    results = [
+        {
+            'vectorizer': vectorizer_params[params],
+            'C': c_value,
+            'mean_score': float(np.mean(scores)),
+            'std_score': float(np.std(scores)),
+            'fold_scores': scores,
+        }
+        for (params, c_value), scores in per_candidate.items()
+    ]
+    results.sort(key=lambda result: result['mean_score'], reverse=True)
+    search_seconds = time.perf_counter() - start
+    logger.info(f'Search done candidates={len(results)} folds={folds} n_jobs={n_jobs} '
+                f'best_score={results[0]["mean_score"]:.4f} seconds={search_seconds:.1f}')
+    return {
+        'best': results[0],
+        'results': results,
+        'folds': folds,
+        'n_jobs': n_jobs,
+        'documents': len(texts),
+        'search_seconds': round(search_seconds, 3),
+    }
+
+
+def save_scores(scores: Dict, path: str = MODEL_SCORES_PATH):
+    """
+    Writes the search scores next to the model, replacing the previous ones atomically.
+    """
+    atomic_write_json(path, scores, indent=2)
@@ -0,0 +1,321 @@
+"""
+Versioned model store: immutable, content addressed model versions and an atomically switched
+active pointer, announced to every worker over redis pub/sub.
+
+    python model_store.py list
+    python model_store.py activate <version>
+    python model_store.py rollback
+    python model_store.py shadow <version> --fraction 0.05
+    python model_store.py shadow --clear
+    python model_store.py shadow-stats <version>
+"""
+import argparse
+import contextlib
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import pickle
+import shutil
+import time
+import uuid
+from collections import namedtuple
+from typing import Any, Dict, List, Optional, Tuple
+
+from file_utils import atomic_write_json, directory_size
+from model_artifact import ArtifactFormatError, is_exportable, load_artifact, save_artifact
+from worker_threads import WorkerThread
+
+
+MODEL_STORE_DIR = os.environ.get('MODEL_STORE_DIR', 'model/store')
+MODEL_EVENTS_CHANNEL = os.environ.get('MODEL_EVENTS_CHANNEL', 'model_events')
+# Previously active versions remembered for rollback.
+ROLLBACK_HISTORY = int(os.environ.get('MODEL_ROLLBACK_HISTORY', 10))
+VERSIONS_DIR = 'versions'
+ACTIVE_FILE = 'ACTIVE'
+CANDIDATE_FILE = 'CANDIDATE'
+LOCK_FILE = '.lock'
+PICKLE_FILE = 'model.pkl'
+ARTIFACT_DIR = 'artifact'
+META_FILE = 'meta.json'
+SHADOW_KEY = 'shadow:{version}'
+
+logger = logging.getLogger(__name__)
+
+# Model scored in the shadow of the active one on a fraction of the traffic.
+Candidate = namedtuple('Candidate', ['model', 'fraction'])
+
+
+class ModelStoreError(RuntimeError):
+    """Error when a version is unknown or a pointer can not be moved."""
+
+
+def _read_json(path: str) -> Optional[Dict]:
+    try:
+        with open(path) as json_file:
+            return json.load(json_file)
+    except FileNotFoundError:
+        return None
+
+
+class ModelStore:
+    def __init__(self, directory: str = MODEL_STORE_DIR, redis_client=None):
+        """
+        Versions live in versions/<version>/ (pickle, optional memory mapped artifact, meta.json)
+        and are never modified once published. ACTIVE and CANDIDATE are small json pointers
+        replaced atomically, so readers always see a complete version.
+        Args:
+            directory: root of the store.
+            redis_client: client used to announce pointer changes, created on first use when None.
+        """
+        self.directory = directory
+        self.redis_client = redis_client
+        self.active_path = os.path.join(directory, ACTIVE_FILE)
+        self.candidate_path = os.path.join(directory, CANDIDATE_FILE)
+
+    def _version_dir(self, version: str) -> str:
+        return os.path.join(self.directory, VERSIONS_DIR, version)
+
+    @contextlib.contextmanager
+    def _pointer_lock(self):
+        # Serializes read-modify-write of the pointers across processes.
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, LOCK_FILE), 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def publish(self, model, metadata: Dict = None, activate: bool = False, **artifact_options) -> str:
+        """
+        Stores a model as a new immutable version and returns its id, a hash of its content.
+        Args:
+            model: fitted model, exported as a memory mapped artifact too when is_exportable.
+            metadata: json serializable facts about the version, e.g. training time or accuracy.
+            activate: make it the active version right away.
+            artifact_options: forwarded to save_artifact, e.g. max_features or quantize.
+        """
+        data = pickle.dumps(model)
+        digest = hashlib.sha256(data)
+        digest.update(json.dumps(artifact_options, sort_keys=True).encode('utf-8'))
+        version = digest.hexdigest()[:16]
+        target = self._version_dir(version)
+        if not os.path.isdir(target):
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            tmp_dir = f'{target}.{uuid.uuid4().hex}.tmp'
+            os.makedirs(tmp_dir)
+            try:
+                with open(os.path.join(tmp_dir, PICKLE_FILE), 'wb') as model_file:
+                    model_file.write(data)
+                size = len(data)
+                if is_exportable(model):
+                    # The artifact link is relative, it stays valid once the directory is renamed.
+                    save_artifact(model, os.path.join(tmp_dir, ARTIFACT_DIR), **artifact_options)
+                    size += directory_size(os.path.join(tmp_dir, ARTIFACT_DIR))
+                meta = dict(metadata or {}, version=version, published_at=time.time(), size_bytes=size,
+                            artifact=is_exportable(model), artifact_options=artifact_options)
+                atomic_write_json(os.path.join(tmp_dir, META_FILE), meta)
+                os.rename(tmp_dir, target)
+            except BaseException:
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+                raise
+            logger.info(f'Published model version={version} size_bytes={size}')
+        if activate:
+            self.activate(version)
+        return version
+
+    def metadata(self, version: str) -> Dict:
+        meta = _read_json(os.path.join(self._version_dir(version), META_FILE))
+        if meta is None:
+            raise ModelStoreError(f'Unknown model version {version}')
+        return meta
+
+    def versions(self) -> List[Dict]:
+        """
+        Returns the metadata of every version, oldest first.
+        """
+        versions_dir = os.path.join(self.directory, VERSIONS_DIR)
+        if not os.path.isdir(versions_dir):
+            return []
+        metas = [_read_json(os.path.join(versions_dir, name, META_FILE)) for name in os.listdir(versions_dir)]
+        return sorted((meta for meta in metas if meta), key=lambda meta: meta['published_at'])
+
+    def active(self) -> Optional[str]:
+        pointer = _read_json(self.active_path)
+        return pointer['version'] if pointer else None
+
+    def candidate(self) -> Optional[Dict]:
+        pointer = _read_json(self.candidate_path)
+        return pointer if pointer and pointer.get('version') else None
+
+    def activate(self, version: str):
+        """
+        Points ACTIVE at a published version, remembering the previous one for rollback.
+        """
+        self.metadata(version)
+        with self._pointer_lock():
+            pointer = _read_json(self.active_path) or {'version': None, 'history': []}
+            if pointer['version'] == version:
+                return
+            history = pointer['history']
+            if pointer['version'] is not None:
+                history = [pointer['version']] + history
+            atomic_write_json(self.active_path, {'version': version, 'history': history[:ROLLBACK_HISTORY],
+                                           'activated_at': time.time()})
+        logger.info(f'Activated model version={version} previous={pointer["version"]}')
+        self._notify('activate', version)
+
+    def rollback(self) -> str:
+        """
+        Re-activates the previously active version and returns it.
+        """
+        with self._pointer_lock():
+            pointer = _read_json(self.active_path)
+            if not pointer or not pointer['history']:
+                raise ModelStoreError('No previous model version to roll back to')
+            version, history = pointer['history'][0], pointer['history'][1:]
+            atomic_write_json(self.active_path, {'version': version, 'history': history, 'activated_at': time.time()})
+        logger.info(f'Rolled back model version={pointer["version"]} to version={version}')
+        self._notify('activate', version)
+        return version
+
+    def set_candidate(self, version: str, fraction: float):
+        """
+        Scores a published version in the shadow of the active one on fraction of the traffic.
+        """
+        if not 0 < fraction <= 1:
+            raise ValueError('The shadow fraction must be in (0, 1]')
+        self.metadata(version)
+        with self._pointer_lock():
+            atomic_write_json(self.candidate_path, {'version': version, 'fraction': fraction})
+        self._notify('candidate', version)
+
+    def clear_candidate(self):
+        with self._pointer_lock():
+            # Written rather than deleted, so registries notice the change.
+            atomic_write_json(self.candidate_path, {'version': None})
+        self._notify('candidate', None)
+
+    def load_version(self, version: str, model_format: str = 'pickle') -> Any:
+        """
+        Loads a version as a pickled model or, for model_format='artifact', as its memory mapped
+        artifact when it has one.
+        """
+        directory = self._version_dir(version)
+        if model_format == 'artifact' and os.path.exists(os.path.join(directory, ARTIFACT_DIR)):
+            return load_artifact(os.path.join(directory, ARTIFACT_DIR))[0]
+        try:
+            with open(os.path.join(directory, PICKLE_FILE), 'rb') as model_file:
+                return pickle.load(model_file)
+        except FileNotFoundError:
+            raise ModelStoreError(f'Unknown model version {version}')
+
+    def load_active(self, model_format: str = 'pickle') -> Tuple[Any, Optional[str]]:
+        version = self.active()
+        return (self.load_version(version, model_format), version) if version else (None, None)
+
+    def load_candidate(self, model_format: str = 'pickle') -> Tuple[Optional[Candidate], Optional[str]]:
+        pointer = self.candidate()
+        if pointer is None:
+            return None, None
+        model = self.load_version(pointer['version'], model_format)
+        return Candidate(model, pointer['fraction']), pointer['version']
+
+    def _notify(self, event: str, version: Optional[str]):
+        try:
+            if self.redis_client is None:
+                from redis_utils import get_redis_client
+                self.redis_client = get_redis_client()
+            self.redis_client.publish(MODEL_EVENTS_CHANNEL, json.dumps({'event': event, 'version': version}))
+        except Exception as exc:
+            # Workers still notice the new pointer on their next request.
+            logger.warning(f'Failed to announce model event={event} version={version} : {exc}')
+
+
+class ModelEventListener:
+    def __init__(self, redis_client, registries: List):
+        """
+        Reloads the given registries in the background as soon as a model event is announced,
+        so requests never wait for a load.
+        Args:
+            redis_client: client subscribed to MODEL_EVENTS_CHANNEL.
+            registries: ModelRegistry objects refreshed on every event.
+        """
+        self.redis_client = redis_client
+        self.registries = registries
+        self._thread = WorkerThread(self._run, name='model-events')
+
+    def start(self):
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                pubsub = self.redis_client.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(MODEL_EVENTS_CHANNEL)
+                for message in pubsub.listen():
+                    logger.info(f'Received model event {message["data"]}')
+                    for registry in self.registries:
+                        registry.current()
+            except Exception as exc:
+                logger.warning(f'Model event subscription failed, retrying : {exc}')
+                time.sleep(5)
+
+
+def shadow_stats(redis_client, version: str) -> Dict:
+    """
+    Returns how often a candidate agreed with the active model, across all workers.
+    """
+    stats = {key.decode('utf-8'): int(value)
+             for key, value in redis_client.hgetall(SHADOW_KEY.format(version=version)).items()}
+    total = stats.get('total', 0)
+    return {
+        'version': version,
+        'total': total,
+        'agree': stats.get('agree', 0),
+        'agreement': round(stats.get('agree', 0) / total, 4) if total else None,
+    }
+
+
+if __name__ == '__main__':
+    from logging_utils import configure_logging
+    from redis_utils import get_redis_client
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('list')
+    commands.add_parser('activate').add_argument('version')
+    commands.add_parser('rollback')
+    shadow = commands.add_parser('shadow')
+    shadow.add_argument('version', nargs='?')
+    shadow.add_argument('--fraction', type=float, default=0.05)
+    shadow.add_argument('--clear', action='store_true')
+    commands.add_parser('shadow-stats').add_argument('version')
+    args = parser.parse_args()
+
+    configure_logging()
+    store = ModelStore()
+    try:
+        if args.command == 'list':
+            active, candidate = store.active(), store.candidate()
+            for meta in store.versions():
+                flags = ['active'] * (meta['version'] == active)
+                flags += ['candidate'] * (candidate is not None and meta['version'] == candidate['version'])
+                print(json.dumps(dict(meta, status=flags)))
+        elif args.command == 'activate':
+            store.activate(args.version)
+        elif args.command == 'rollback':
+            print(store.rollback())
+        elif args.command == 'shadow':
+            if args.clear:
+                store.clear_candidate()
+            elif args.version:
+                store.set_candidate(args.version, args.fraction)
+            else:
+                parser.error('shadow takes a version or --clear')
+        elif args.command == 'shadow-stats':
+            print(json.dumps(shadow_stats(get_redis_client(), args.version)))
+    except (ModelStoreError, ArtifactFormatError, ValueError) as exc:
+        raise SystemExit(str(exc))
@@ -0,0 +1,132 @@
+import base64
+import binascii
+import logging
+import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from typing import Callable
+
+import bcrypt
+
+from metrics import PASSWORD_HASH_SECONDS
+
+
+BCRYPT_ROUNDS = int(os.environ.get('BCRYPT_ROUNDS', 12))
+# bcrypt releases the GIL, so this bounds the cores logins can take away from inference.
+BCRYPT_MAX_CONCURRENCY = int(os.environ.get('BCRYPT_MAX_CONCURRENCY', 2))
+# Request threads of a worker, see docker/gunicorn_conf.py.
+GUNICORN_THREADS = int(os.environ.get('GUNICORN_THREADS', 4))
+# Hash operations allowed to wait for a bcrypt thread, further ones are rejected right away. Every
+# login waiting on bcrypt holds a request thread, by default one is always left for other requests.
+BCRYPT_MAX_PENDING = int(os.environ.get('BCRYPT_MAX_PENDING', max(GUNICORN_THREADS - BCRYPT_MAX_CONCURRENCY - 1, 0)))
+BCRYPT_TIMEOUT = float(os.environ.get('BCRYPT_TIMEOUT', 10))
+
+logger = logging.getLogger(__name__)
+
+
+class PasswordHashingBusy(RuntimeError):
+    """Error when the bcrypt executor has no room left for another operation."""
+
+
+_executor = ThreadPoolExecutor(max_workers=BCRYPT_MAX_CONCURRENCY, thread_name_prefix='bcrypt')
+_slots = threading.BoundedSemaphore(BCRYPT_MAX_CONCURRENCY + BCRYPT_MAX_PENDING)
+
+
+def _run_bounded(operation: str, function, *args):
+    if not _slots.acquire(blocking=False):
+        raise PasswordHashingBusy(f'Too many pending password {operation} operations')
+
+    def timed():
+        start = time.perf_counter()
+        try:
+            return function(*args)
+        finally:
+            PASSWORD_HASH_SECONDS.labels(operation=operation).observe(time.perf_counter() - start)
+
+    try:
+        future = _executor.submit(timed)
+    except BaseException:
+        _slots.release()
+        raise
+    future.add_done_callback(lambda _: _slots.release())
+    return future
+
+
+def _result(operation: str, future: Future):
+    # A queue that does not drain in time is as saturated as a full one.
+    try:
+        return future.result(timeout=BCRYPT_TIMEOUT)
+    except FutureTimeoutError:
+        future.cancel()
+        raise PasswordHashingBusy(f'Password {operation} did not complete within {BCRYPT_TIMEOUT}s')
+
+
+def _hash(password: str, rounds: int) -> str:
+    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds)).decode('utf-8')
+
+
+def hash_password(password: str, rounds: int = BCRYPT_ROUNDS) -> str:
+    """
+    Returns the bcrypt hash of a password as stored in the USER table.
+    Args:
+        password: plain text password.
+        rounds: bcrypt cost factor.
+    """
+    return _result('hash', _run_bounded('hash', _hash, password, rounds))
+
+
+def _decode_stored(stored_hash: str) -> bytes:
+    # Hashes written before the cost became configurable were stored base64 encoded.
+    if stored_hash.startswith('$2'):
+        return stored_hash.encode('utf-8')
+    try:
+        return base64.b64decode(stored_hash, validate=True)
+    except (binascii.Error, ValueError):
+        return b''
+
+
+def check_password(password: str, stored_hash: str) -> bool:
+    """
+    Checks a password against its stored hash on the bounded bcrypt executor.
+    Raises PasswordHashingBusy when too many checks are already queued or it times out.
+    Args:
+        password: plain text password.
+        stored_hash: value of the password column, raw or legacy base64 encoded.
+    """
+    hashed = _decode_stored(stored_hash)
+    if not hashed.startswith(b'$2'):
+        return False
+    return _result('check', _run_bounded('check', bcrypt.checkpw, password.encode('utf-8'), hashed))
+
+
+def needs_rehash(stored_hash: str, rounds: int = BCRYPT_ROUNDS) -> bool:
+    """
+    True when the stored hash is in the legacy encoding or uses another cost factor.
+    """
+    if not stored_hash.startswith('$2'):
+        return True
+    try:
+        return int(stored_hash.split('$')[2]) != rounds
+    except (IndexError, ValueError):
+        return True
+
+
+def rehash_in_background(password: str, store: Callable[[str], None]):
+    """
+    Hashes a password with the current cost factor and hands the hash to store, without waiting.
+    Skipped when the executor is saturated, the next login retries it.
+    Args:
+        password: plain text password that was just verified.
+        store: callable persisting the new hash.
+    """
+    def rehash():
+        try:
+            store(_hash(password, BCRYPT_ROUNDS))
+        except Exception as exc:
+            logger.warning(f'Password rehash failed : {exc}')
+
+    try:
+        _run_bounded('rehash', rehash)
+    except PasswordHashingBusy:
+        logger.debug('Password rehash skipped, bcrypt executor is busy')
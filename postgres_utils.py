@@ -1,75 +1,261 @@
+import atexit
+import logging
 import os
-import bcrypt
-import base64
 import datetime
 from enum import Enum
 from functools import wraps
 import psycopg2
-from psycopg2 import sql
-from typing import Dict
+from psycopg2 import extensions, sql
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from typing import Dict, Optional, Tuple
 import uuid
 
+from metrics import DB_QUERY_ERRORS, DB_QUERY_SECONDS
+from password_hashing import check_password, hash_password, needs_rehash, rehash_in_background
 from user import User
+from worker_threads import WorkerThread
 
 
 VARCHAR_DEFAULT_SIZE = 100
+# Upper bound on how long a token stays cached, also bounds how long a token invalidated by
+# another worker can still be accepted by this one when the invalidation event was missed.
+TOKEN_CACHE_TTL = int(os.environ.get('TOKEN_CACHE_TTL', 60))
+# Redis channel announcing invalidated tokens to every worker, see TokenEventListener.
+TOKEN_EVENTS_CHANNEL = os.environ.get('TOKEN_EVENTS_CHANNEL', 'token_events')
+TOKEN_CACHE_SIZE = int(os.environ.get('TOKEN_CACHE_SIZE', 10000))
+POOL_MIN_SIZE = int(os.environ.get('POSTGRES_POOL_MIN', 1))
+POOL_MAX_SIZE = int(os.environ.get('POSTGRES_POOL_MAX', os.environ.get('GUNICORN_THREADS', 4)))
+POOL_TIMEOUT = float(os.environ.get('POSTGRES_POOL_TIMEOUT', 5))
+# Connections idle for longer than this are pinged before being handed out.
+POOL_HEALTHCHECK_INTERVAL = float(os.environ.get('POSTGRES_POOL_HEALTHCHECK_INTERVAL', 30))
+ACTIVITY_FLUSH_INTERVAL = float(os.environ.get('ACTIVITY_FLUSH_INTERVAL', 5))
+ACTIVITY_FLUSH_SIZE = int(os.environ.get('ACTIVITY_FLUSH_SIZE', 500))
+# Rows deleted per statement by the retention jobs, small batches keep row locks short.
+PURGE_BATCH_SIZE = int(os.environ.get('MAINTENANCE_BATCH_SIZE', 1000))
+ACTIVITY_RETENTION_DAYS = int(os.environ.get('ACTIVITY_RETENTION_DAYS', 365))
+
+logger = logging.getLogger(__name__)
 
 class DatabaseCommunicationError(RuntimeError):
     """Error when trying to connect, query or communicate to the postgres database."""
 
 
+class ConnectionPool:
+    def __init__(self, auth: Dict, min_size: int = POOL_MIN_SIZE, max_size: int = POOL_MAX_SIZE,
+                 timeout: float = POOL_TIMEOUT):
+        """
+        Thread-safe pool of postgres connections.
+        Args:
+            auth (dict): Contains dbname, username, password, host, port
+            min_size: connections opened when the pool is first used in a process.
+            max_size: maximum number of connections checked out at once.
+            timeout: seconds to wait for a free connection before failing.
+        """
+        self.auth = auth
+        self.min_size = min(min_size, max_size)
+        self.max_size = max_size
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._pid = None
+        self._abandoned = []
+
+    def _ensure_process(self):
+        # Connections are opened lazily by the process using them. A forked worker abandons the
+        # ones inherited from its parent without closing them, closing would end the parent's sessions.
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            if self._pid is not None:
+                # Kept referenced, deallocating a psycopg2 connection closes it.
+                self._abandoned.extend(connection for connection, _ in self._idle)
+            self._slots = threading.BoundedSemaphore(self.max_size)
+            self._idle = deque()
+            self._pid = os.getpid()
+        try:
+            for _ in range(self.min_size):
+                self._idle.append((self._connect(), time.monotonic()))
+        except psycopg2.Error as e:
+            # Missing connections are opened on demand once the database is reachable.
+            logger.error(f'Exception in establishing the connection : {e}')
+
+    def _connect(self):
+        return psycopg2.connect(
+            dbname = self.auth['dbname'],
+            user = self.auth['username'],
+            password = self.auth['password'],
+            host = self.auth['host'],
+            port = self.auth['port']
+        )
+
+    @staticmethod
+    def _is_healthy(connection) -> bool:
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT 1')
+            connection.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _checkout(self):
+        with self._lock:
+            connection, last_used = self._idle.pop() if self._idle else (None, None)
+        if connection is not None:
+            stale = time.monotonic() - last_used > POOL_HEALTHCHECK_INTERVAL
+            if connection.closed or (stale and not self._is_healthy(connection)):
+                logger.warning('Dropping broken postgres connection')
+                self._discard(connection)
+                connection = None
+        return connection or self._connect()
+
+    def _checkin(self, connection):
+        if connection.closed:
+            return
+        if connection.get_transaction_status() != extensions.TRANSACTION_STATUS_IDLE:
+            connection.rollback()
+        with self._lock:
+            self._idle.append((connection, time.monotonic()))
+
+    @staticmethod
+    def _discard(connection):
+        try:
+            connection.close()
+        except psycopg2.Error:
+            pass
+
+    @contextmanager
+    def connection(self):
+        """
+        Checks out a connection for the duration of the block.
+        Connections that fail with a connection level error are closed instead of returned.
+        """
+        self._ensure_process()
+        if not self._slots.acquire(timeout=self.timeout):
+            raise DatabaseCommunicationError(
+                f'Timed out after {self.timeout}s waiting for one of {self.max_size} connections')
+        connection = None
+        try:
+            connection = self._checkout()
+            yield connection
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            if connection is not None:
+                self._discard(connection)
+                connection = None
+            raise
+        finally:
+            try:
+                if connection is not None:
+                    self._checkin(connection)
+            finally:
+                self._slots.release()
+
+    def close(self):
+        if self._pid != os.getpid():
+            return
+        with self._lock:
+            idle, self._idle = self._idle, deque()
+        for connection, _ in idle:
+            self._discard(connection)
+
+
+def auth_from_env() -> Dict:
+    """
+    Returns the credentials of the application database from the POSTGRES_* environment variables.
+    """
+    return {
+        'dbname' : 'sentiment_analyzer_db',
+        'username' : os.environ.get('POSTGRES_USERNAME', 'root'),
+        'password' : os.environ.get('POSTGRES_PASSWORD', 'root'),
+        'host' : os.environ.get('POSTGRES_HOST', '0.0.0.0'),
+        'port' : os.environ.get('POSTGRES_PORT', 5432)
+    }
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+def get_pool(auth: Dict) -> ConnectionPool:
+    """
+    Returns the pool shared by every wrapper built with the same credentials.
+    Args:
+        auth (dict): Contains dbname, username, password, host, port
+    """
+    key = (auth['host'], str(auth['port']), auth['dbname'], auth['username'])
+    with _pools_lock:
+        if key not in _pools:
+            _pools[key] = ConnectionPool(auth)
+        return _pools[key]
+
+
+def _query_operation(query) -> str:
+    # First keyword of the statement, e.g. SELECT or INSERT, read from the leading sql.SQL part.
+    while isinstance(query, sql.Composed):
+        query = query.seq[0] if query.seq else ''
+    if isinstance(query, sql.SQL):
+        query = query.string
+    words = str(query).split(None, 1)
+    return words[0].upper() if words else 'UNKNOWN'
+
+
 class PostgresDBWrapper:
     def __init__(self, auth: Dict):
         """
-        Creates connection based on database credentials.
+        Attaches to the connection pool for the given database credentials.
         Args:
             auth (dict): Contains dbname, username, password, host, port            
         """
         try:
-            self.connection = psycopg2.connect(
-                dbname = auth['dbname'],
-                user = auth['username'],
-                password = auth['password'],
-                host = auth['host'],
-                port = auth['port']
-            )
-            self.cursor = self.connection.cursor()
+            self.pool = get_pool(auth)
         except Exception as e:
-            print('Exception in establishing the connection : ', e)
+            logger.error(f'Exception in establishing the connection : {e}')
 
     def execute_query(self, query, data=None, is_read=False) -> Dict:
         """
-        Executes the given query and returns result if it's a read query.
+        Executes the given query on a pooled connection and returns result if it's a read query.
         Args:
             query: query string to execute.
             data: dict containing parameters to run the query.
             is_read: boolen flag indicating if it's a read/write query.
         """
+        labels = {'table': getattr(self, 'table_name', 'unknown'), 'operation': _query_operation(query)}
+        start = time.perf_counter()
         try:
-            self.cursor.execute(query, data)
-            if is_read:
-                return self.cursor.fetchall()
-            self.connection.commit()
+            with self.pool.connection() as connection:
+                try:
+                    with connection.cursor() as cursor:
+                        cursor.execute(query, data)
+                        result = cursor.fetchall() if is_read else None
+                    connection.commit()
+                except Exception:
+                    if not connection.closed:
+                        connection.rollback()
+                    raise
+            return result
         except Exception as exc:
-            print(exc)
+            DB_QUERY_ERRORS.labels(**labels).inc()
+            if isinstance(exc, DatabaseCommunicationError):
+                raise
+            logger.error(f'Query failed table={labels["table"]} operation={labels["operation"]} : {exc}')
             raise DatabaseCommunicationError('Failed to execute the query') from exc
-        if is_read: return None 
+        finally:
+            DB_QUERY_SECONDS.labels(**labels).observe(time.perf_counter() - start)
 
     def close_connection(self):
-        self.cursor.close()
-        self.connection.close()
+        self.pool.close()
 
 
 class Hashing:
     def __init__(self, password):
-        self.password = password.encode('utf-8')
+        self.password = password
         self.encrypted_pwd = self.encrypt()
 
     def encrypt(self):
-        salt = bcrypt.gensalt()
-        encrypted_pwd = bcrypt.hashpw(self.password, salt)
-        encrypted_pwd = base64.b64encode(encrypted_pwd).decode('utf-8')
-        return encrypted_pwd
+        return hash_password(self.password)
 
 
 class UserDBColumns(Enum):
@@ -80,7 +266,6 @@ class UserDB(PostgresDBWrapper):
     def __init__(self, auth: Dict):
         super().__init__(auth=auth)
         self.table_name = 'USER'
-        self.create_table()
 
     def create_table(self):
         # Creating table
@@ -94,7 +279,7 @@ class UserDB(PostgresDBWrapper):
                 password_col=UserDBColumns.PASSWORD.value
             )
         self.execute_query(create_table_query)
-        print("Executed successfully")
+        logger.debug(f"Created table={self.table_name}")
 
     def insert_user(self, user: User):
         """
@@ -114,11 +299,11 @@ class UserDB(PostgresDBWrapper):
                     password=sql.Literal(Hashing(user.password).encrypted_pwd)
                 )
             self.execute_query(insert_user_query)
-            print("Insertion successful")
+            logger.debug("Insertion successful")
         except psycopg2.errors.UniqueViolation:
-            print("Insertion failed: User already exists")
+            logger.info("Insertion failed: User already exists")
         except: 
-            print("Insertion failed")
+            logger.exception("Insertion failed")
 
     
     def delete_user(self, user: User):
@@ -136,36 +321,52 @@ class UserDB(PostgresDBWrapper):
                 username=sql.Literal(user.username)
             )
         self.execute_query(delete_user_query)
-        print("Deletion successful")
+        logger.debug("Deletion successful")
 
     def validate_user(self, user):
         """
-        Validates user details and returns True or False upon validating them
+        Validates user details and returns True or False upon validating them.
+        Hashes using an outdated cost factor or encoding are replaced in the background.
+        Raises PasswordHashingBusy when too many password checks are already queued.
         Args:
             user: User class object holding username & password info.
         """
+        get_password_query = sql.SQL(
+                'SELECT {password_col} FROM {table_name} WHERE {username_col} = %s'
+            ).format(
+                table_name=sql.Identifier(self.table_name),
+                username_col=UserDBColumns.USERNAME.value,
+                password_col=UserDBColumns.PASSWORD.value
+            )
         try:
-            get_user_query = sql.SQL(
-                    'SELECT * FROM {table_name} where '
-                    '{username_col} = {username} '
-                ).format(
-                    table_name=sql.Identifier(self.table_name),
-                    username_col=UserDBColumns.USERNAME.value,
-                    username=sql.Literal(user.username)
-                )
-            result = self.execute_query(get_user_query, is_read=True)
-            print("res : ", result)
-            stored_hash_bytes=None
-            if result:
-                result = result[0]
-                stored_username = result[0]
-                stored_hash_bytes = base64.b64decode(result[1])
-            is_pwd_valid = bcrypt.checkpw(user.password.encode('utf-8'), stored_hash_bytes)
-            if user.username == stored_username and is_pwd_valid:
-                return True
-        except:
+            result = self.execute_query(get_password_query, data=(user.username,), is_read=True)
+        except DatabaseCommunicationError:
             return False
-        return False
+        if not result or not user.password:
+            return False
+        stored_hash = result[0][0]
+        if not check_password(user.password, stored_hash):
+            return False
+        if needs_rehash(stored_hash):
+            rehash_in_background(user.password, lambda new_hash: self.update_password_hash(user.username, new_hash))
+        return True
+
+    def update_password_hash(self, username: str, password_hash: str):
+        """
+        Replaces the stored password hash of a user.
+        Args:
+            username: user whose hash is replaced.
+            password_hash: new bcrypt hash.
+        """
+        update_password_query = sql.SQL(
+                'UPDATE {table_name} SET {password_col} = %s WHERE {username_col} = %s'
+            ).format(
+                table_name=sql.Identifier(self.table_name),
+                username_col=UserDBColumns.USERNAME.value,
+                password_col=UserDBColumns.PASSWORD.value
+            )
+        self.execute_query(update_password_query, data=(password_hash, username))
+        logger.debug(f'Rehashed password username={username}')
 
     def delete_user(self, user):
         """
@@ -192,10 +393,18 @@ class TokensDBColumns(Enum):
     EXPIRES_AT = sql.Identifier('expires_at')
 
 class TokensDB(PostgresDBWrapper):
-    def __init__(self, auth: Dict):
+    def __init__(self, auth: Dict, redis_client=None):
+        """
+        Args:
+            auth: postgres connection settings, see auth_from_env.
+            redis_client: optional client announcing invalidated tokens to the other workers.
+        """
         super().__init__(auth=auth)
         self.table_name = 'TOKENS'
-        self.create_table()
+        self.redis_client = redis_client
+        # token -> (username, expires_at, cached_until)
+        self._token_cache = OrderedDict()
+        self._token_cache_lock = threading.Lock()
 
     def create_table(self):
         # Creating table
@@ -215,7 +424,23 @@ class TokensDB(PostgresDBWrapper):
                 expires_at_col=TokensDBColumns.EXPIRES_AT.value
             )
         self.execute_query(create_table_query)
-        print("Executed successfully")
+        create_index_query = sql.SQL(
+                'CREATE INDEX IF NOT EXISTS {index_name} ON {table_name} ({token_col})'
+            ).format(
+                index_name=sql.Identifier(f'{self.table_name}_token_idx'),
+                table_name=sql.Identifier(self.table_name),
+                token_col=TokensDBColumns.TOKEN.value
+            )
+        self.execute_query(create_index_query)
+        create_expiry_index_query = sql.SQL(
+                'CREATE INDEX IF NOT EXISTS {index_name} ON {table_name} ({expires_at_col})'
+            ).format(
+                index_name=sql.Identifier(f'{self.table_name}_expires_at_idx'),
+                table_name=sql.Identifier(self.table_name),
+                expires_at_col=TokensDBColumns.EXPIRES_AT.value
+            )
+        self.execute_query(create_expiry_index_query)
+        logger.debug(f"Created table={self.table_name}")
 
     def generate_token(self, username):
         """
@@ -241,30 +466,89 @@ class TokensDB(PostgresDBWrapper):
         self.execute_query(insert_token_query)
         return token
 
+    def lookup_token(self, token: str) -> Optional[Tuple[str, datetime.datetime]]:
+        """
+        Returns (username, expires_at) of a valid token or None, with a single indexed query.
+        Results are cached in process until the token expires or TOKEN_CACHE_TTL passes.
+        Args:
+            token: a string type token.
+        """
+        now = datetime.datetime.now()
+        cached = self.lookup_cached_token(token, now)
+        if cached is not None:
+            return cached
+        lookup_token_query = sql.SQL(
+                'SELECT {username_col}, {expires_at_col} FROM {table_name} where '
+                '{token_col} = {token} AND '
+                '{expires_at_col} > {now} LIMIT 1'
+            ).format(
+                username_col=TokensDBColumns.USERNAME.value,
+                expires_at_col=TokensDBColumns.EXPIRES_AT.value,
+                table_name=sql.Identifier(self.table_name),
+                token_col=TokensDBColumns.TOKEN.value,
+                token=sql.Literal(token),
+                now=sql.Literal(now)
+            )
+        result = self.execute_query(lookup_token_query, is_read=True)
+        if not result:
+            return None
+        username, expires_at = result[0]
+        cached_until = min(expires_at, now + datetime.timedelta(seconds=TOKEN_CACHE_TTL))
+        with self._token_cache_lock:
+            self._token_cache[token] = (username, expires_at, cached_until)
+            if len(self._token_cache) > TOKEN_CACHE_SIZE:
+                self._token_cache.popitem(last=False)
+        return username, expires_at
+
+    def lookup_cached_token(self, token: str, now: Optional[datetime.datetime] = None
+                            ) -> Optional[Tuple[str, datetime.datetime]]:
+        """
+        Returns (username, expires_at) of a token found in the process cache, None without querying
+        postgres otherwise.
+        Args:
+            token: a string type token.
+            now: current time, datetime.now() when None.
+        """
+        now = now or datetime.datetime.now()
+        with self._token_cache_lock:
+            cached = self._token_cache.get(token)
+            if cached is None:
+                return None
+            username, expires_at, cached_until = cached
+            if now < cached_until:
+                self._token_cache.move_to_end(token)
+                return username, expires_at
+            del self._token_cache[token]
+        return None
+
+    def evict_cached_token(self, token: str):
+        """
+        Drops a token from the process cache, its next lookup queries postgres.
+        Args:
+            token: a string type token.
+        """
+        with self._token_cache_lock:
+            self._token_cache.pop(token, None)
+
+    def authenticate(self, token: str) -> Optional[str]:
+        """
+        Returns the username owning a valid token, None if the token is unknown or expired.
+        Args:
+            token: a string type token.
+        """
+        try:
+            result = self.lookup_token(token)
+        except DatabaseCommunicationError:
+            return None
+        return result[0] if result else None
+
     def get_username(self, token: str):
         """
         Returns username for a given token
         Args:
             token: a string type token.
         """
-        try:
-            get_username_query = sql.SQL(
-                    'SELECT {username_col} FROM {table_name} where '
-                    '{token_col} = {token}'
-                ).format(
-                    username_col=TokensDBColumns.USERNAME.value,
-                    table_name=sql.Identifier(self.table_name),
-                    token_col=TokensDBColumns.TOKEN.value,
-                    token=sql.Literal(token)
-                )
-            result = self.execute_query(get_username_query, is_read=True)
-            print('res : ', result)
-            if result:
-                return result[0]
-        except: 
-            print("unable to get the username!")
-            return ''
-        return ''
+        return self.authenticate(token) or ''
 
     def verify_token(self, token: str):
         """
@@ -272,30 +556,12 @@ class TokensDB(PostgresDBWrapper):
         Args:
             token: a string type token 
         """
-        try:
-            exp_time = datetime.datetime.now()
-            get_token_query = sql.SQL(
-                    'SELECT * FROM {table_name} where '
-                    '{token_col} = {token} AND '
-                    '{expires_at_col} > {expires_at}'
-                ).format(
-                    table_name=sql.Identifier(self.table_name),
-                    token_col=TokensDBColumns.TOKEN.value,
-                    expires_at_col=TokensDBColumns.EXPIRES_AT.value,
-                    token=sql.Literal(token),
-                    expires_at=sql.Literal(exp_time)
-                )
-            result = self.execute_query(get_token_query, is_read=True)
-            print("res : ", result)
-            if result:
-                return True
-        except: 
-            return False
-        return False
+        return self.authenticate(token) is not None
 
     def invalidate_token(self, token):
         """
-        Delete the token from the table
+        Delete the token from the table, and from the token cache of every worker listening
+        to TOKEN_EVENTS_CHANNEL.
         Args:
             token: a string based token
         """
@@ -307,21 +573,87 @@ class TokensDB(PostgresDBWrapper):
                 token_col=TokensDBColumns.TOKEN.value,
                 token=sql.Literal(token)
             )
+        self.evict_cached_token(token)
         self.execute_query(delete_token_query)
+        if self.redis_client is not None:
+            try:
+                self.redis_client.publish(TOKEN_EVENTS_CHANNEL, token)
+            except Exception as exc:
+                # Other workers drop the token from their cache within TOKEN_CACHE_TTL.
+                logger.warning(f'Failed to announce token invalidation : {exc}')
+
+    def purge_expired(self, batch_size: int = PURGE_BATCH_SIZE) -> int:
+        """
+        Deletes expired tokens in batches of batch_size rows, each in its own transaction,
+        and returns the number of rows deleted.
+        Args:
+            batch_size: maximum number of rows deleted per statement.
+        """
+        purge_query = sql.SQL(
+                'DELETE FROM {table_name} WHERE {tokenid_col} IN ('
+                'SELECT {tokenid_col} FROM {table_name} WHERE {expires_at_col} <= {now} LIMIT {batch_size}) '
+                'RETURNING {tokenid_col}'
+            ).format(
+                table_name=sql.Identifier(self.table_name),
+                tokenid_col=TokensDBColumns.TOKEN_ID.value,
+                expires_at_col=TokensDBColumns.EXPIRES_AT.value,
+                now=sql.Literal(datetime.datetime.now()),
+                batch_size=sql.Literal(batch_size)
+            )
+        return _delete_in_batches(self, purge_query, batch_size)
 
 
 
+class TokenEventListener:
+    def __init__(self, redis_client, token_db: TokensDB):
+        """
+        Evicts tokens invalidated by any worker from this worker's token cache, from a background thread.
+        Args:
+            redis_client: client subscribed to TOKEN_EVENTS_CHANNEL.
+            token_db: TokensDB whose cache is kept in sync.
+        """
+        self.redis_client = redis_client
+        self.token_db = token_db
+        self._thread = WorkerThread(self._run, name='token-events')
+
+    def start(self):
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                pubsub = self.redis_client.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(TOKEN_EVENTS_CHANNEL)
+                for message in pubsub.listen():
+                    self.token_db.evict_cached_token(message['data'].decode('utf-8'))
+            except Exception as exc:
+                logger.warning(f'Token event subscription failed, retrying : {exc}')
+                time.sleep(5)
+
+
 class ActivityLogDBColumns(Enum):
     USERNAME = sql.Identifier('username')
     LAST_LOGIN = sql.Identifier('last_login')
     LAST_TRAINING = sql.Identifier('last_training')
     LAST_INFERENCE = sql.Identifier('last_inference')
 
+ACTIVITY_COLUMNS = {
+    'login': ActivityLogDBColumns.LAST_LOGIN,
+    'training': ActivityLogDBColumns.LAST_TRAINING,
+    'inference': ActivityLogDBColumns.LAST_INFERENCE,
+}
+
 class ActivityLogDB(PostgresDBWrapper):
     def __init__(self, auth: Dict):
         super().__init__(auth=auth)
         self.table_name = 'ACTIVITY_LOG'
-        self.create_table()
+        # (username, activity) -> latest activity time, waiting to be flushed.
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake_flusher = threading.Event()
+        self._flusher = WorkerThread(self._flush_loop, name='activity-flusher')
+        atexit.register(self.flush)
 
     def create_table(self):
         # Creating table
@@ -339,69 +671,134 @@ class ActivityLogDB(PostgresDBWrapper):
                 last_inference_col=ActivityLogDBColumns.LAST_INFERENCE.value
             )
         self.execute_query(create_table_query)
-        print("Executed successfully")
+        logger.debug(f"Created table={self.table_name}")
 
     def update_activity(self, username: str, activity: str):
         """
-        update the activity table column.
+        Records the activity in memory, a background thread writes it to the table.
+        Repeated activities of a user between two flushes collapse into one row.
         Args:
             username: a string, username
-            action: a string , training/inference.
+            activity: a string, login/training/inference.
         """
-        if activity is 'login':
-            activity_col = ActivityLogDBColumns.LAST_LOGIN.value
-        if activity is 'training':
-            activity_col = ActivityLogDBColumns.LAST_TRAINING.value
-        elif activity is 'inference':
-            activity_col = ActivityLogDBColumns.LAST_INFERENCE.value
-
+        if activity not in ACTIVITY_COLUMNS:
+            raise ValueError(f'Unknown activity {activity}')
+        with self._pending_lock:
+            self._pending[(username, activity)] = datetime.datetime.now()
+            pending = len(self._pending)
+        self._flusher.start()
+        if pending >= ACTIVITY_FLUSH_SIZE:
+            self._wake_flusher.set()
+
+    def _flush_loop(self):
+        while True:
+            self._wake_flusher.wait(ACTIVITY_FLUSH_INTERVAL)
+            self._wake_flusher.clear()
+            try:
+                self.flush()
+            except DatabaseCommunicationError as exc:
+                logger.warning(f'Failed to flush activity log, retrying later : {exc}')
+
+    def flush(self) -> int:
+        """
+        Writes pending activities as one multi-row upsert per activity column.
+        Returns the number of rows written; on failure the rows stay pending.
+        """
+        with self._flush_lock:
+            with self._pending_lock:
+                pending, self._pending = self._pending, {}
+            if not pending:
+                return 0
+            by_activity = {}
+            for (username, activity), activity_time in pending.items():
+                by_activity.setdefault(activity, []).append((username, activity_time))
+            try:
+                for activity, rows in list(by_activity.items()):
+                    self._upsert(ACTIVITY_COLUMNS[activity].value, rows)
+                    del by_activity[activity]
+            except DatabaseCommunicationError:
+                with self._pending_lock:
+                    for activity, rows in by_activity.items():
+                        for username, activity_time in rows:
+                            key = (username, activity)
+                            if key not in self._pending or self._pending[key] < activity_time:
+                                self._pending[key] = activity_time
+                raise
+            return len(pending)
+
+    def _upsert(self, activity_col, rows):
+        # GREATEST keeps the newest time when workers flush out of order.
         update_action_query = sql.SQL(
             'INSERT INTO {table_name} ({username_col}, {activity_col}) '
-            'VALUES ({username}, {activity_time}) '
+            'VALUES {values} '
             'ON CONFLICT ({username_col}) DO UPDATE '
-            'SET {activity_col} = {activity_time}'
+            'SET {activity_col} = GREATEST({table_name}.{activity_col}, EXCLUDED.{activity_col})'
         ).format(
             table_name=sql.Identifier(self.table_name),
             username_col=ActivityLogDBColumns.USERNAME.value,
             activity_col=activity_col,
-            username=sql.Literal(username),
-            activity_time=sql.Literal(datetime.datetime.now())
+            values=sql.SQL(', ').join(
+                sql.SQL('({}, {})').format(sql.Literal(username), sql.Literal(activity_time))
+                for username, activity_time in rows
+            )
         )
         self.execute_query(update_action_query)
-        print("Activity updated successfully")
-
-
-
-
-
-# if __name__== '__main__':
-#     auth = {
-#         'dbname' : 'flask_db',
-#         'username' : 'root',
-#         'password' : 'root',
-#         'host' : 'localhost',
-#         'port' : 5432
-#     }
-    # try:
-        # u = UserDB(auth)
-        # print("No errors while establishing conneciton")
-        # print(u.create_table())
-        # new_user = User('SAI', '12345')
-        # #print(u.insert_user(new_user))
-        # print("="*20, "started validating user ", "="*20)
-        # print(u.validate_user(new_user))
-        # #print(u.delete_user(new_user))
-
-    #     t= TokensDB(auth)
-    #     x = t.generate_token('SAI')
-    #     print(x)
-    #     t.verify_token(x)
-    #     t.invalidate_token(x)
-    # except Exception as e:
-    #     print("errors while connecting : ", e)
-    
-    
 
-# TBD:
-# clean up unused tokens
-# clean up Activity log data periodically
\ No newline at end of file
+    def purge_inactive(self, retention_days: int = ACTIVITY_RETENTION_DAYS,
+                       batch_size: int = PURGE_BATCH_SIZE) -> int:
+        """
+        Deletes the rows of users without any activity in the last retention_days, in batches,
+        and returns the number of rows deleted.
+        Args:
+            retention_days: days of inactivity after which a row is deleted.
+            batch_size: maximum number of rows deleted per statement.
+        """
+        cutoff = datetime.datetime.now() - datetime.timedelta(days=retention_days)
+        purge_query = sql.SQL(
+                'DELETE FROM {table_name} WHERE {username_col} IN ('
+                'SELECT {username_col} FROM {table_name} '
+                'WHERE COALESCE(GREATEST({last_login_col}, {last_training_col}, {last_inference_col}), {epoch}) '
+                '< {cutoff} LIMIT {batch_size}) '
+                'RETURNING {username_col}'
+            ).format(
+                table_name=sql.Identifier(self.table_name),
+                username_col=ActivityLogDBColumns.USERNAME.value,
+                last_login_col=ActivityLogDBColumns.LAST_LOGIN.value,
+                last_training_col=ActivityLogDBColumns.LAST_TRAINING.value,
+                last_inference_col=ActivityLogDBColumns.LAST_INFERENCE.value,
+                epoch=sql.Literal(datetime.datetime(1970, 1, 1)),
+                cutoff=sql.Literal(cutoff),
+                batch_size=sql.Literal(batch_size)
+            )
+        return _delete_in_batches(self, purge_query, batch_size)
+
+
+def _delete_in_batches(db: PostgresDBWrapper, delete_query, batch_size: int) -> int:
+    # The query deletes at most batch_size rows and returns one row per deletion.
+    deleted = 0
+    while True:
+        batch = len(db.execute_query(delete_query, is_read=True))
+        deleted += batch
+        if batch < batch_size:
+            return deleted
+
+
+def create_schema(auth: Dict):
+    """
+    Creates the tables and indexes used by the app. Run once per deployment, e.g. from the
+    gunicorn master or with `python postgres_utils.py`, rather than by every worker.
+    Args:
+        auth (dict): Contains dbname, username, password, host, port
+    """
+    for db_class in (UserDB, TokensDB, ActivityLogDB):
+        db_class(auth).create_table()
+    # The DDL connections are not needed anymore, serving processes open their own.
+    get_pool(auth).close()
+    logger.info('Database schema is up to date')
+
+
+if __name__ == '__main__':
+    from logging_utils import configure_logging
+
+    configure_logging()
+    create_schema(auth_from_env())
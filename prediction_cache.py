@@ -0,0 +1,118 @@
+import hashlib
+import logging
+import os
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional
+
+from metrics import PREDICTION_CACHE_LOOKUPS
+
+
+LOCAL_CACHE_SIZE = int(os.environ.get('PREDICTION_CACHE_SIZE', 10000))
+REDIS_CACHE_TTL = int(os.environ.get('PREDICTION_CACHE_TTL', 24 * 3600))
+KEY_PREFIX = 'prediction'
+
+logger = logging.getLogger(__name__)
+
+
+class PredictionCache:
+    def __init__(self, redis_client=None, local_size: int = LOCAL_CACHE_SIZE, ttl: int = REDIS_CACHE_TTL):
+        """
+        Two level cache of predictions: an in-process LRU in front of redis.
+        Entries are keyed on the model version, so publishing a new model invalidates them.
+        Args:
+            redis_client: optional shared redis client, only the local LRU is used without it.
+            local_size: maximum number of entries kept in process.
+            ttl: expiry in seconds of the redis entries.
+        """
+        self.redis_client = redis_client
+        self.local_size = local_size
+        self.ttl = ttl
+        self._local = OrderedDict()
+        self._local_version = None
+        self._lock = threading.Lock()
+        self.local_hits = 0
+        self.redis_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _key(version: str, text: str) -> str:
+        digest = hashlib.sha256(text.encode('utf-8')).hexdigest()
+        return f'{KEY_PREFIX}:{version}:{digest}'
+
+    def _check_version(self, version: str):
+        # Entries of an older model are never read again, drop them instead of letting them age out.
+        if version != self._local_version:
+            self._local.clear()
+            self._local_version = version
+
+    def get(self, version: str, text: str) -> Optional[str]:
+        """
+        Returns the cached label for a preprocessed text or None.
+        Args:
+            version: version of the model that would score the text.
+            text: preprocessed review text.
+        """
+        key = self._key(version, text)
+        with self._lock:
+            self._check_version(version)
+            label = self._local.get(key)
+            if label is not None:
+                self._local.move_to_end(key)
+                self.local_hits += 1
+        if label is not None:
+            PREDICTION_CACHE_LOOKUPS.labels(result='local_hit').inc()
+            return label
+        if self.redis_client is not None:
+            try:
+                label = self.redis_client.get(key)
+            except Exception as exc:
+                logger.warning(f'Prediction cache lookup failed : {exc}')
+                label = None
+            if label is not None:
+                label = label.decode('utf-8')
+                self._set_local(version, key, label)
+                with self._lock:
+                    self.redis_hits += 1
+                PREDICTION_CACHE_LOOKUPS.labels(result='redis_hit').inc()
+                return label
+        with self._lock:
+            self.misses += 1
+        PREDICTION_CACHE_LOOKUPS.labels(result='miss').inc()
+        return None
+
+    def set(self, version: str, text: str, label: str):
+        """
+        Stores the label predicted for a preprocessed text.
+        Args:
+            version: version of the model that scored the text.
+            text: preprocessed review text.
+            label: predicted label.
+        """
+        key = self._key(version, text)
+        self._set_local(version, key, label)
+        if self.redis_client is not None:
+            try:
+                self.redis_client.set(key, label, ex=self.ttl)
+            except Exception as exc:
+                logger.warning(f'Prediction cache store failed : {exc}')
+
+    def _set_local(self, version: str, key: str, label: str):
+        with self._lock:
+            self._check_version(version)
+            self._local[key] = label
+            self._local.move_to_end(key)
+            if len(self._local) > self.local_size:
+                self._local.popitem(last=False)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            lookups = self.local_hits + self.redis_hits + self.misses
+            return {
+                'local_hits': self.local_hits,
+                'redis_hits': self.redis_hits,
+                'misses': self.misses,
+                'hit_ratio': round((lookups - self.misses) / lookups, 4) if lookups else 0.0,
+                'local_entries': len(self._local),
+                'model_version': self._local_version,
+            }
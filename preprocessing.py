@@ -0,0 +1,111 @@
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from itertools import islice
+from typing import Iterable, Iterator, List, Optional
+
+from nltk.stem.porter import PorterStemmer
+
+
+PREPROCESS_WORKERS = int(os.environ.get('PREPROCESS_WORKERS', os.cpu_count() or 1))
+STEM_CACHE_SIZE = int(os.environ.get('STEM_CACHE_SIZE', 200000))
+# Bump whenever preprocess output changes, cached preprocessed corpora are keyed on it.
+PREPROCESS_VERSION = 1
+# Below this many documents the process pool start-up costs more than it saves.
+MIN_PARALLEL_DOCS = 2000
+
+HTML_TAG_RE = re.compile("<[^>]*>")
+NON_LETTER_RE = re.compile('[^a-zA-Z]')
+# Tags and letter runs in one scan, letter runs joined only by tags make one word as in preprocess.
+TAG_OR_LETTERS_RE = re.compile("<[^>]*>|[a-zA-Z]+")
+
+ps = PorterStemmer()
+
+
+@lru_cache(maxsize=STEM_CACHE_SIZE)
+def stem(word: str) -> str:
+    """
+    Porter stem of a word, memoized since review vocabulary repeats heavily.
+    """
+    return ps.stem(word)
+
+
+def preprocess(text: str) -> str:
+    """
+    Strips html tags and non letters, lowercases and stems every token.
+    Args:
+        text: raw review text.
+    """
+    text = text.strip()
+    text = HTML_TAG_RE.sub("", text)
+    text = NON_LETTER_RE.sub(' ', text)
+    return ' '.join([stem(word) for word in text.lower().split()])
+
+
+def iter_tokens(text: str) -> Iterator[str]:
+    """
+    Yields the tokens of preprocess(text) one by one from a single scan of the raw text,
+    without building the intermediate strings. Stopping early stops the scan.
+    Args:
+        text: raw review text.
+    """
+    parts = []
+    end = None
+    for match in TAG_OR_LETTERS_RE.finditer(text):
+        if match.start() != end and parts:
+            yield stem(''.join(parts).lower())
+            parts = []
+        end = match.end()
+        if text[match.start()] != '<':
+            parts.append(match.group())
+    if parts:
+        yield stem(''.join(parts).lower())
+
+
+def iter_windows(tokens: Iterable[str], size: int) -> Iterator[List[str]]:
+    """
+    Splits a token stream into consecutive lists of at most size tokens, at least one even if empty.
+    A size of 0 yields a single list of every token.
+    """
+    tokens = iter(tokens)
+    window = list(islice(tokens, size) if size else tokens)
+    yield window
+    while size and len(window) == size:
+        window = list(islice(tokens, size))
+        if not window:
+            return
+        yield window
+
+
+def _preprocess_chunk(texts: List[str]) -> List[str]:
+    return [preprocess(text) for text in texts]
+
+
+def preprocess_many(texts: Iterable[str], workers: Optional[int] = None,
+                    executor: Optional[ProcessPoolExecutor] = None) -> List[str]:
+    """
+    Preprocesses a corpus, sharding it across a process pool. Output order matches the input.
+    Args:
+        texts: iterable of raw review strings.
+        workers: number of processes, defaults to PREPROCESS_WORKERS. 1 runs inline.
+        executor: optional pool reused across calls, e.g. for every chunk of a streamed dataset.
+    """
+    texts = list(texts)
+    workers = workers or PREPROCESS_WORKERS
+    if workers <= 1 or len(texts) < MIN_PARALLEL_DOCS:
+        return _preprocess_chunk(texts)
+    # A few chunks per worker keeps the pool busy when chunks take uneven time.
+    chunk_size = -(-len(texts) // (workers * 4))
+    chunks = [texts[start:start + chunk_size] for start in range(0, len(texts), chunk_size)]
+    if executor is not None:
+        return _run_chunks(executor, chunks)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return _run_chunks(executor, chunks)
+
+
+def _run_chunks(executor: ProcessPoolExecutor, chunks: List[List[str]]) -> List[str]:
+    processed = []
+    for chunk in executor.map(_preprocess_chunk, chunks):
+        processed.extend(chunk)
+    return processed
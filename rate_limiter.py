@@ -0,0 +1,167 @@
+import contextlib
+import hashlib
+import json
+import logging
+import math
+import os
+import uuid
+from typing import Dict, Optional, Tuple
+
+
+RATE_LIMITS_ENABLED = os.environ.get('RATE_LIMITS_ENABLED', 'True') == 'True'
+# JSON object mapping endpoints to [burst, requests per second] allowed per user, e.g. {"infer": [20, 10]},
+# merged over DEFAULT_RATE_LIMITS. Endpoints without a limit are not limited.
+RATE_LIMITS = os.environ.get('RATE_LIMITS')
+DEFAULT_RATE_LIMITS = {
+    # Requests whose token is missing, invalid or not cached yet, per client address and across
+    # endpoints, checked before the token costs a postgres lookup.
+    'anonymous': (10, 1),
+    'infer': (20, 10),
+    'infer_batch': (5, 1),
+    'train': (3, 1 / 60),
+    'train_status': (20, 5),
+}
+# Inference requests served at once across all workers, 0 for no cap.
+MAX_INFLIGHT_INFERENCE = int(os.environ.get('MAX_INFLIGHT_INFERENCE', 32))
+# Seconds after which the slot of a request that never released it, e.g. of a killed worker, is reclaimed.
+INFLIGHT_SLOT_TIMEOUT = int(os.environ.get('INFLIGHT_SLOT_TIMEOUT', 60))
+BUCKET_KEY = 'rate:{endpoint}:{identity}'
+INFLIGHT_KEY = 'inflight:inference'
+
+logger = logging.getLogger(__name__)
+
+# Refills the bucket for the time elapsed since the last request, then takes ARGV[3] tokens if it holds
+# them. Returns {1, 0} when taken, else {0, seconds until enough tokens}. Redis time keeps every worker
+# on the same clock.
+TAKE_TOKENS_SCRIPT = """
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local cost = tonumber(ARGV[3])
+local time = redis.call('time')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local bucket = redis.call('hmget', KEYS[1], 'tokens', 'updated_at')
+local tokens = tonumber(bucket[1]) or capacity
+local updated_at = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - updated_at) * rate)
+local wait = 0
+if tokens >= cost then
+    tokens = tokens - cost
+else
+    wait = (cost - tokens) / rate
+end
+redis.call('hset', KEYS[1], 'tokens', tostring(tokens), 'updated_at', tostring(now))
+redis.call('expire', KEYS[1], math.ceil(capacity / rate) + 1)
+if wait > 0 then
+    return {0, tostring(wait)}
+end
+return {1, '0'}
+"""
+# Adds ARGV[2] to the set of in-flight requests unless it already holds ARGV[1] live ones.
+ACQUIRE_SLOT_SCRIPT = """
+local time = redis.call('time')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+redis.call('zremrangebyscore', KEYS[1], '-inf', now - tonumber(ARGV[3]))
+if redis.call('zcard', KEYS[1]) >= tonumber(ARGV[1]) then
+    return 0
+end
+redis.call('zadd', KEYS[1], now, ARGV[2])
+redis.call('expire', KEYS[1], ARGV[3])
+return 1
+"""
+
+
+def get_limits() -> Dict[str, Tuple[float, float]]:
+    """
+    Returns endpoint -> (burst, requests per second) from RATE_LIMITS over the defaults.
+    """
+    limits = dict(DEFAULT_RATE_LIMITS)
+    if RATE_LIMITS:
+        limits.update({endpoint: tuple(limit) for endpoint, limit in json.loads(RATE_LIMITS).items()})
+    return limits
+
+
+class RateLimiter:
+    def __init__(self, redis_client, limits: Optional[Dict[str, Tuple[float, float]]] = None,
+                 max_inflight: int = MAX_INFLIGHT_INFERENCE, enabled: bool = RATE_LIMITS_ENABLED):
+        """
+        Admission control shared by all workers: a token bucket per user and endpoint, and a cap
+        on the inference requests in flight. Both are updated atomically by Lua scripts in redis.
+        Redis errors never reject a request.
+        Args:
+            redis_client: client shared by all workers.
+            limits: endpoint -> (burst, requests per second) allowed per user, get_limits() when None.
+            max_inflight: inference requests served at once, 0 for no cap.
+            enabled: False admits every request without touching redis.
+        """
+        self.redis_client = redis_client
+        self.limits = limits if limits is not None else get_limits()
+        self.max_inflight = max_inflight
+        self.enabled = enabled
+        self._scripts = None
+
+    def _script(self, name: str):
+        # Registered on first use, the client only loads them into redis on their first call.
+        if self._scripts is None:
+            self._scripts = {
+                'take': self.redis_client.register_script(TAKE_TOKENS_SCRIPT),
+                'acquire': self.redis_client.register_script(ACQUIRE_SLOT_SCRIPT),
+            }
+        return self._scripts[name]
+
+    def retry_after(self, endpoint: str, identity: str, cost: int = 1) -> int:
+        """
+        Takes cost tokens from the bucket of identity for endpoint. Returns 0 when the request is
+        admitted, else the seconds until the bucket holds enough tokens again.
+        Args:
+            endpoint: name of the endpoint, see DEFAULT_RATE_LIMITS.
+            identity: whom the bucket belongs to, e.g. a username or a client address.
+            cost: tokens taken by the request.
+        """
+        if not self.enabled or endpoint not in self.limits:
+            return 0
+        capacity, rate = self.limits[endpoint]
+        # Hashed so keys stay short whatever the username or address.
+        identity = hashlib.sha256(identity.encode('utf-8')).hexdigest()[:32]
+        key = BUCKET_KEY.format(endpoint=endpoint, identity=identity)
+        try:
+            taken, wait = self._script('take')(keys=[key], args=[capacity, rate, cost])
+        except Exception as exc:
+            logger.warning(f'Rate limit lookup failed endpoint={endpoint} : {exc}')
+            return 0
+        return 0 if int(taken) else max(1, math.ceil(float(wait)))
+
+    @contextlib.contextmanager
+    def inflight_slot(self):
+        """
+        Holds one of the max_inflight inference slots for the duration of the block.
+        Yields False when every slot is taken, the caller should then reject the request.
+        """
+        admitted, slot = self.acquire_slot()
+        try:
+            yield admitted
+        finally:
+            if slot is not None:
+                self.release_slot(slot)
+
+    def acquire_slot(self) -> Tuple[bool, Optional[str]]:
+        """
+        Takes one of the max_inflight inference slots, for callers that can not use inflight_slot.
+        Returns (admitted, slot to pass to release_slot or None when no slot is held).
+        """
+        if not self.enabled or not self.max_inflight:
+            return True, None
+        slot = uuid.uuid4().hex
+        try:
+            acquired = self._script('acquire')(
+                keys=[INFLIGHT_KEY], args=[self.max_inflight, slot, INFLIGHT_SLOT_TIMEOUT])
+        except Exception as exc:
+            logger.warning(f'In-flight slot lookup failed : {exc}')
+            return True, None
+        return (True, slot) if acquired else (False, None)
+
+    def release_slot(self, slot: str):
+        try:
+            self.redis_client.zrem(INFLIGHT_KEY, slot)
+        except Exception as exc:
+            # The slot is reclaimed after INFLIGHT_SLOT_TIMEOUT.
+            logger.warning(f'Failed to release in-flight slot : {exc}')
@@ -0,0 +1,51 @@
+import os
+import time
+
+import redis
+from redis.commands.core import Script
+
+from metrics import REDIS_COMMAND_ERRORS, REDIS_COMMAND_SECONDS
+
+
+REDIS_HOST = os.environ.get('REDIS_HOST', 'localhost')
+REDIS_PORT = int(os.environ.get('REDIS_PORT', 6379))
+REDIS_PASSWORD = os.environ.get('REDIS_PASSWORD', 'redis123')
+REDIS_DB = int(os.environ.get('REDIS_DB', 1))
+
+
+class InstrumentedRedis:
+    def __init__(self, client: redis.StrictRedis):
+        """
+        Proxy of a redis client recording the duration and failures of every command.
+        Args:
+            client: client the commands are forwarded to.
+        """
+        self._client = client
+
+    def __getattr__(self, name):
+        attribute = getattr(self._client, name)
+        if not callable(attribute) or name in ('pipeline', 'pubsub', 'get_encoder'):
+            return attribute
+        timer = REDIS_COMMAND_SECONDS.labels(command=name)
+        def command(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return attribute(*args, **kwargs)
+            except Exception:
+                REDIS_COMMAND_ERRORS.labels(command=name).inc()
+                raise
+            finally:
+                timer.observe(time.perf_counter() - start)
+        return command
+
+    def register_script(self, script: str) -> Script:
+        # Bound to the proxy so script calls (evalsha) are timed as well.
+        return Script(self, script)
+
+
+def get_redis_client() -> InstrumentedRedis:
+    """
+    Returns a client for the shared redis instance. Connections are opened lazily on first command.
+    """
+    return InstrumentedRedis(
+        redis.StrictRedis(host=REDIS_HOST, port=REDIS_PORT, password=REDIS_PASSWORD, db=REDIS_DB))
@@ -0,0 +1,72 @@
+import logging
+import os
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional
+
+from metrics import INFERENCE_STAGE_SECONDS, SHADOW_PREDICTIONS
+from model_store import SHADOW_KEY
+
+
+# Shadow predictions waiting for the scoring thread, further samples are dropped.
+SHADOW_MAX_PENDING = int(os.environ.get('SHADOW_MAX_PENDING', 100))
+
+logger = logging.getLogger(__name__)
+
+
+class ShadowScorer:
+    def __init__(self, registry, labels: Dict, redis_client=None, max_pending: int = SHADOW_MAX_PENDING):
+        """
+        Scores a sampled fraction of live queries with the candidate model on a background thread
+        and counts how often it agrees with the active model. The live response never waits for it.
+        Args:
+            registry: registry serving the Candidate of the model store.
+            labels: maps model predictions to the labels returned to users.
+            redis_client: optional client aggregating agreement counts across workers.
+            max_pending: queued shadow predictions above which samples are dropped.
+        """
+        self.registry = registry
+        self.labels = labels
+        self.redis_client = redis_client
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='shadow')
+        self._slots = threading.BoundedSemaphore(max_pending)
+
+    def observe(self, text: str, label: str, live_version: Optional[str]):
+        """
+        Samples a scored query for shadow scoring. Never raises, shadow failures are only logged.
+        Args:
+            text: preprocessed review text.
+            label: label returned by the active model.
+            live_version: version of the active model.
+        """
+        try:
+            candidate, version = self.registry.current()
+            if candidate is None or version == live_version or random.random() >= candidate.fraction:
+                return
+            if not self._slots.acquire(blocking=False):
+                SHADOW_PREDICTIONS.labels(result='dropped').inc()
+                return
+            try:
+                future = self._executor.submit(self._score, candidate.model, version, text, label)
+            except Exception:
+                self._slots.release()
+                raise
+            future.add_done_callback(lambda _: self._slots.release())
+        except Exception as exc:
+            logger.warning(f'Shadow sampling failed live_version={live_version} : {exc}')
+
+    def _score(self, model, version: str, text: str, label: str):
+        try:
+            with INFERENCE_STAGE_SECONDS.labels(stage='predict', path='shadow').time():
+                shadow_label = self.labels[model.predict([text])[0]]
+            result = 'agree' if shadow_label == label else 'disagree'
+            SHADOW_PREDICTIONS.labels(result=result).inc()
+            if self.redis_client is not None:
+                pipe = self.redis_client.pipeline()
+                pipe.hincrby(SHADOW_KEY.format(version=version), 'total', 1)
+                if result == 'agree':
+                    pipe.hincrby(SHADOW_KEY.format(version=version), 'agree', 1)
+                pipe.execute()
+        except Exception as exc:
+            logger.warning(f'Shadow scoring failed version={version} : {exc}')
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The modules live at the repository root, tests run with python -m pytest from there or from tests/.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
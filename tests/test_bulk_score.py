@@ -0,0 +1,36 @@
+"""
+Malformed bulk scoring input fails with the line or record at fault, before reaching a worker.
+
+    python -m pytest -q tests
+"""
+import pytest
+
+from bulk_score import _record_fields, read_records
+
+
+def write(tmp_path, content):
+    path = tmp_path / 'input.jsonl'
+    path.write_text(content, encoding='utf-8')
+    return str(path)
+
+
+def test_read_records_skips_blank_lines(tmp_path):
+    path = write(tmp_path, '{"review": "good"}\n\n{"review": "bad", "id": 2}\n')
+    assert list(read_records(path, 'jsonl')) == [{'review': 'good'}, {'review': 'bad', 'id': 2}]
+
+
+@pytest.mark.parametrize('line', ['[]', '"x"', '3', 'null', '{bad'])
+def test_read_records_rejects_non_objects(tmp_path, line):
+    path = write(tmp_path, '{"review": "good"}\n\n' + line + '\n')
+    with pytest.raises(ValueError, match='line 3'):
+        list(read_records(path, 'jsonl'))
+
+
+@pytest.mark.parametrize('text', [5, ['a'], {'a': 1}, True])
+def test_record_fields_rejects_non_string_text(text):
+    with pytest.raises(ValueError, match='Record 8 field review'):
+        _record_fields(7, {'review': text}, 'review', None)
+
+
+def test_record_fields_defaults_missing_text():
+    assert _record_fields(0, {'id': 'a'}, 'review', 'id') == (0, 'a', '')
@@ -0,0 +1,66 @@
+"""
+Incremental training on deltas too small to hold reviews out of.
+
+    python -m pytest -q tests
+"""
+import csv
+
+import pytest
+from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.linear_model import LogisticRegression
+from sklearn.pipeline import Pipeline
+
+import classifier
+from benchmarks.corpus import make_corpus
+from benchmarks.fakes import FakeRedis
+from incremental_training import holdout_shortfall
+from model_store import ModelStore
+from preprocessing import preprocess
+
+
+@pytest.mark.parametrize('labels, fraction', [
+    ([0, 1] * 5, 0.1),
+    ([0, 1, 1, 1, 1, 1], 0.5),
+    ([0] + [1] * 30, 0.1),
+])
+def test_holdout_shortfall_small_deltas(labels, fraction):
+    assert holdout_shortfall(labels, fraction)
+
+
+@pytest.mark.parametrize('labels, fraction', [
+    ([0, 1] * 10, 0.1),
+    ([0, 1] * 5, 0.0),
+])
+def test_holdout_shortfall_splittable(labels, fraction):
+    assert holdout_shortfall(labels, fraction) is None
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    corpus = make_corpus(200, seed=0, mean_length=40)
+    pipeline = Pipeline([('tfidf', TfidfVectorizer()), ('log_reg', LogisticRegression())])
+    pipeline.fit([preprocess(review) for review, _ in corpus],
+                 [int(sentiment == 'positive') for _, sentiment in corpus])
+    store = ModelStore(str(tmp_path / 'store'), redis_client=FakeRedis())
+    store.publish(pipeline, {'n_docs': len(corpus)}, activate=True)
+    monkeypatch.setattr(classifier, 'CORPUS_CACHE', False)
+    return store
+
+
+def test_incremental_training_publishes_small_delta_unchecked(store, tmp_path):
+    data_path = tmp_path / 'new_reviews.csv'
+    with open(data_path, 'w', newline='') as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(['review', 'sentiment'])
+        writer.writerows(make_corpus(10, seed=3, mean_length=40))
+    base_version = store.active()
+
+    classifier.MovieReviewClassifier(model_store=store).train_data_incremental(
+        lambda stage: None, data_path=str(data_path))
+
+    version = store.active()
+    assert version != base_version
+    metadata = store.metadata(version)
+    assert metadata['base_version'] == base_version
+    assert metadata['new_docs'] == 10
+    assert 'validation_accuracy' not in metadata
@@ -0,0 +1,148 @@
+"""
+The fast paths must score exactly what the sklearn pipeline scores:
+preprocess against the original implementation, iter_tokens and LinearScorer.count_terms against
+preprocess and the vectorizer's analyzer, ArtifactModel.transform against TfidfVectorizer.transform
+and the scorer of an artifact against the artifact.
+
+    python -m pytest -q tests
+"""
+import random
+import re
+from collections import Counter
+
+import numpy as np
+import pytest
+from nltk.stem.porter import PorterStemmer
+from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.linear_model import LogisticRegression
+from sklearn.pipeline import Pipeline
+
+from benchmarks.corpus import make_corpus
+from linear_scorer import LinearScorer
+from model_artifact import load_artifact, save_artifact
+from preprocessing import iter_tokens, preprocess
+
+reference_stemmer = PorterStemmer()
+
+EDGE_CASES = [
+    '',
+    '   ',
+    'Plain review.',
+    'I <b>loved</b> it<br /><br />Really!',
+    'no<br />space between tags',
+    'half<i>way</i>through',
+    'unclosed < bracket and text',
+    'unclosed <tag at the end',
+    'a < b > c',
+    '<<nested>> tags>',
+    '> stray closing bracket',
+    "It's 10/10, don't miss it!!!",
+    'UPPER case AND MiXeD',
+    'café naïve über',
+    'tabs\tand\nnew\r\nlines',
+    'trailing letters<',
+    '<only tags></only>',
+    'running runs runner ran',
+]
+
+
+def reference_preprocess(text):
+    # Preprocessing as the classifier did it before the preprocessing module existed.
+    text = text.strip()
+    text = re.sub("<[^>]*>", "", text)
+    text = re.sub('[^a-zA-Z]', ' ', text)
+    text = text.lower()
+    text = text.split()
+    text = [reference_stemmer.stem(word) for word in text]
+    text = ' '.join(text)
+    return text
+
+
+def random_texts(count, seed=0):
+    rng = random.Random(seed)
+    alphabet = 'abcXYZ <>/!.\n\té0'
+    fragments = ['<br />', '<b>', '</i>', '<', '>', 'movie', 'running', "isn't"]
+    texts = []
+    for _ in range(count):
+        parts = [rng.choice(fragments) if rng.random() < 0.3 else rng.choice(alphabet)
+                 for _ in range(rng.randint(0, 40))]
+        texts.append(''.join(parts))
+    return texts
+
+
+RAW_TEXTS = EDGE_CASES + [review for review, _ in make_corpus(40, seed=1, mean_length=60)] + random_texts(500)
+
+VECTORIZER_PARAMS = [
+    {},
+    {'ngram_range': (1, 2)},
+    {'ngram_range': (2, 3)},
+    {'sublinear_tf': True},
+    {'ngram_range': (1, 2), 'sublinear_tf': True, 'norm': 'l1'},
+    {'binary': True},
+    {'norm': None, 'min_df': 2},
+]
+
+
+@pytest.fixture(scope='module', params=VECTORIZER_PARAMS, ids=lambda params: repr(params))
+def pipeline(request):
+    corpus = make_corpus(200, seed=0, mean_length=40)
+    texts = [preprocess(review) for review, _ in corpus]
+    labels = [int(sentiment == 'positive') for _, sentiment in corpus]
+    model = Pipeline([('tfidf', TfidfVectorizer(**request.param)), ('log_reg', LogisticRegression())])
+    return model.fit(texts, labels)
+
+
+@pytest.mark.parametrize('text', RAW_TEXTS)
+def test_preprocess_matches_reference(text):
+    assert preprocess(text) == reference_preprocess(text)
+
+
+@pytest.mark.parametrize('text', RAW_TEXTS)
+def test_iter_tokens_matches_preprocess(text):
+    assert ' '.join(iter_tokens(text)) == preprocess(text)
+
+
+def test_count_terms_matches_analyzer(pipeline):
+    vectorizer = pipeline.named_steps['tfidf']
+    analyze = vectorizer.build_analyzer()
+    scorer = LinearScorer.from_pipeline(pipeline)
+    for text in RAW_TEXTS:
+        expected = Counter(term for term in analyze(preprocess(text)) if term in vectorizer.vocabulary_)
+        assert scorer.count_terms(iter_tokens(text)) == dict(expected), text
+
+
+def test_predict_proba_tokens_matches_pipeline(pipeline):
+    scorer = LinearScorer.from_pipeline(pipeline)
+    texts = [preprocess(text) for text in RAW_TEXTS]
+    expected = pipeline.predict_proba(texts)[:, 1]
+    actual = [scorer.predict_proba_tokens(iter_tokens(text)) for text in RAW_TEXTS]
+    np.testing.assert_allclose(actual, expected, rtol=1e-9, atol=1e-12)
+
+
+@pytest.mark.parametrize('quantize', [None, 'int8'])
+def test_artifact_scorer_matches_artifact(pipeline, tmp_path, quantize):
+    save_artifact(pipeline, str(tmp_path / 'model_artifact'), max_features=None, quantize=quantize)
+    artifact, _ = load_artifact(str(tmp_path / 'model_artifact'))
+    scorer = LinearScorer.from_artifact(artifact)
+    vectorizer = pipeline.named_steps['tfidf']
+    analyze = vectorizer.build_analyzer()
+    texts = [preprocess(text) for text in RAW_TEXTS]
+    for raw, text in zip(RAW_TEXTS, texts):
+        expected = Counter(term for term in analyze(text) if term in vectorizer.vocabulary_)
+        assert scorer.count_terms(iter_tokens(raw)) == dict(expected), raw
+    expected = artifact.predict_proba(texts)[:, 1]
+    np.testing.assert_allclose([scorer.predict_proba(text) for text in texts], expected, rtol=1e-9, atol=1e-12)
+    np.testing.assert_allclose([scorer.predict_proba_tokens(iter_tokens(raw)) for raw in RAW_TEXTS], expected,
+                               rtol=1e-9, atol=1e-12)
+    assert [scorer.predict(text) for text in texts] == artifact.predict(texts).tolist()
+
+
+def test_artifact_transform_matches_vectorizer(pipeline, tmp_path):
+    save_artifact(pipeline, str(tmp_path / 'model_artifact'), max_features=None, quantize=None)
+    artifact, _ = load_artifact(str(tmp_path / 'model_artifact'))
+    texts = [preprocess(text) for text in RAW_TEXTS]
+    expected = pipeline.named_steps['tfidf'].transform(texts)
+    actual = artifact.transform(texts)
+    assert actual.shape == expected.shape
+    np.testing.assert_allclose(actual.toarray(), expected.toarray(), rtol=1e-9, atol=1e-12)
+    np.testing.assert_allclose(artifact.predict_proba(texts), pipeline.predict_proba(texts), rtol=1e-9, atol=1e-12)
@@ -0,0 +1,186 @@
+import logging
+import multiprocessing
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from enum import Enum
+from typing import Dict, Optional
+
+from logging_utils import configure_logging
+from redis_utils import get_redis_client
+
+
+LOCK_KEY = 'training_lock'
+JOB_KEY = 'training_job:{job_id}'
+# The lock only has to outlive a missed heartbeat, the heartbeat keeps renewing it while a fit runs.
+LOCK_TTL = int(os.environ.get('TRAINING_LOCK_TTL', 60))
+HEARTBEAT_INTERVAL = LOCK_TTL / 3
+JOB_RECORD_TTL = int(os.environ.get('TRAINING_JOB_RECORD_TTL', 7 * 24 * 3600))
+
+logger = logging.getLogger(__name__)
+
+# Renew/release the lock only while it still belongs to the given job.
+RENEW_LOCK_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('expire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+RELEASE_LOCK_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+class TrainingStatus(Enum):
+    QUEUED = 'queued'
+    PREPROCESSING = 'preprocessing'
+    FITTING = 'fitting'
+    PERSISTING = 'persisting'
+    DONE = 'done'
+    FAILED = 'failed'
+
+
+STAGE_ORDER = [status.value for status in TrainingStatus]
+FINAL_STATES = (TrainingStatus.DONE.value, TrainingStatus.FAILED.value)
+
+
+class TrainingJobs:
+    def __init__(self, redis_client):
+        """
+        Queues training runs on a separate process and tracks their progress in redis.
+        Args:
+            redis_client: client used for the training lock and the job records.
+        """
+        self.redis_client = redis_client
+        self._executor = None
+        self._executor_lock = threading.Lock()
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        # Created lazily so it belongs to the serving worker, spawn avoids forking a threaded process.
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(
+                    max_workers=1, mp_context=multiprocessing.get_context('spawn'))
+            return self._executor
+
+    def submit(self, username: str, **train_kwargs) -> Optional[str]:
+        """
+        Queues a training job and returns its id, or None if another training holds the lock.
+        Args:
+            username: user who requested the training.
+            train_kwargs: forwarded to MovieReviewClassifier.train_data.
+        """
+        job_id = uuid.uuid4().hex
+        if not self.redis_client.set(LOCK_KEY, job_id, nx=True, ex=LOCK_TTL):
+            return None
+        _set_stage(self.redis_client, job_id, TrainingStatus.QUEUED, username=username)
+        executor = self._get_executor()
+        try:
+            future = executor.submit(run_training_job, job_id, train_kwargs)
+        except Exception as exc:
+            self._fail(job_id, executor, exc)
+            raise
+        future.add_done_callback(lambda done: self._job_done(job_id, executor, done))
+        return job_id
+
+    def _job_done(self, job_id: str, executor: ProcessPoolExecutor, future: Future):
+        # run_training_job records its own failures, an exception here means the job never ran to the
+        # end, e.g. the training process was killed, and nothing else will mark it failed.
+        exc = future.exception() if not future.cancelled() else RuntimeError('Training job was cancelled')
+        if exc is not None:
+            logger.error(f'Training job died job_id={job_id} : {exc!r}')
+            try:
+                self._fail(job_id, executor, exc)
+            except Exception as redis_exc:
+                logger.warning(f'Failed to record the training failure job_id={job_id} : {redis_exc}')
+
+    def _fail(self, job_id: str, executor: ProcessPoolExecutor, exc: BaseException):
+        if isinstance(exc, BrokenProcessPool):
+            # A broken pool rejects every later submit, the next job gets a new one.
+            with self._executor_lock:
+                if self._executor is executor:
+                    self._executor = None
+            executor.shutdown(wait=False)
+        _set_stage(self.redis_client, job_id, TrainingStatus.FAILED, error=str(exc) or repr(exc))
+        self.redis_client.eval(RELEASE_LOCK_SCRIPT, 1, LOCK_KEY, job_id)
+
+    def status(self, job_id: str) -> Optional[Dict]:
+        """
+        Returns the job state with per stage durations in seconds, or None for unknown ids.
+        Args:
+            job_id: id returned by submit.
+        """
+        record = self.redis_client.hgetall(JOB_KEY.format(job_id=job_id))
+        if not record:
+            return None
+        record = {key.decode('utf-8'): value.decode('utf-8') for key, value in record.items()}
+        started = {stage: float(record[f'{stage}_at']) for stage in STAGE_ORDER if f'{stage}_at' in record}
+        stages = sorted(started, key=started.get)
+        end_time = started.get(record['status']) if record['status'] in FINAL_STATES else time.time()
+        durations = {}
+        for index, stage in enumerate(stages):
+            if stage in FINAL_STATES:
+                continue
+            finished = started[stages[index + 1]] if index + 1 < len(stages) else end_time
+            durations[stage] = round(finished - started[stage], 3)
+        return {
+            'job_id': job_id,
+            'status': record['status'],
+            'username': record.get('username', ''),
+            'error': record.get('error'),
+            'durations': durations,
+            'total_duration': round(end_time - started[TrainingStatus.QUEUED.value], 3),
+        }
+
+
+def _set_stage(redis_client, job_id: str, stage: TrainingStatus, **fields):
+    key = JOB_KEY.format(job_id=job_id)
+    mapping = {'status': stage.value, f'{stage.value}_at': time.time()}
+    mapping.update({name: value for name, value in fields.items() if value is not None})
+    pipe = redis_client.pipeline()
+    pipe.hset(key, mapping=mapping)
+    pipe.expire(key, JOB_RECORD_TTL)
+    pipe.execute()
+
+
+def _heartbeat(redis_client, job_id: str, stop: threading.Event):
+    while not stop.wait(HEARTBEAT_INTERVAL):
+        try:
+            if not redis_client.eval(RENEW_LOCK_SCRIPT, 1, LOCK_KEY, job_id, LOCK_TTL):
+                logger.error(f'Training lock was lost job_id={job_id}')
+                return
+        except Exception as exc:
+            logger.warning(f'Failed to renew training lock job_id={job_id} : {exc}')
+
+
+def run_training_job(job_id: str, train_kwargs: Dict):
+    """
+    Entry point of the training process: runs train_data while keeping the lock alive.
+    Args:
+        job_id: id of the queued job, also the value held in the training lock.
+        train_kwargs: forwarded to MovieReviewClassifier.train_data.
+    """
+    from classifier import MovieReviewClassifier
+
+    configure_logging()
+    redis_client = get_redis_client()
+    stop = threading.Event()
+    heartbeat = threading.Thread(target=_heartbeat, args=(redis_client, job_id, stop), daemon=True)
+    heartbeat.start()
+    try:
+        MovieReviewClassifier().train_data(
+            progress=lambda stage: _set_stage(redis_client, job_id, TrainingStatus(stage)),
+            **train_kwargs)
+        _set_stage(redis_client, job_id, TrainingStatus.DONE)
+    except Exception as exc:
+        _set_stage(redis_client, job_id, TrainingStatus.FAILED, error=str(exc))
+    finally:
+        stop.set()
+        heartbeat.join()
+        redis_client.eval(RELEASE_LOCK_SCRIPT, 1, LOCK_KEY, job_id)
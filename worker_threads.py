@@ -0,0 +1,33 @@
+import os
+import threading
+from typing import Callable, Optional, Tuple
+
+
+class WorkerThread:
+    def __init__(self, target: Callable[..., None], make_args: Callable[[], Tuple] = tuple,
+                 name: Optional[str] = None):
+        """
+        Background daemon thread started on first use, once per process. Threads do not survive a
+        fork, so each gunicorn worker starts its own rather than relying on one of the master.
+        Args:
+            target: function run by the thread.
+            make_args: called before the thread starts in a new process, returns the arguments of
+                target, e.g. a queue that must not be shared with the parent process.
+            name: name of the thread.
+        """
+        self.target = target
+        self.make_args = make_args
+        self.name = name
+        self._pid = None
+        self._start_lock = threading.Lock()
+
+    def start(self):
+        """
+        Starts the thread unless it already runs in this process. Cheap enough to call per request.
+        """
+        if self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid != os.getpid():
+                threading.Thread(target=self.target, args=self.make_args(), name=self.name, daemon=True).start()
+                self._pid = os.getpid()